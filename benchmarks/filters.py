@@ -0,0 +1,77 @@
+"""
+Time each kind of filter in PathFilter against the per-entry checks it
+replaced, which called fnmatch() once for every pattern.
+
+    python benchmarks/filters.py [number_of_patterns]
+"""
+
+import sys
+import time
+from fnmatch import fnmatch
+
+from files_to_prompt.filters import PathFilter
+
+NAMES = [f"module_{i}.{('py', 'txt', 'md', 'json')[i % 4]}" for i in range(20_000)]
+NAMES += [f".hidden_{i}" for i in range(2_000)]
+PATHS = [f"src/package_{i % 50}/{name}" for i, name in enumerate(NAMES)]
+
+
+def fnmatch_filter(extensions, ignore_patterns, include_patterns):
+    "The previous approach, extended to path and --include patterns"
+
+    def skip(name, rel_path):
+        if name.startswith("."):
+            return True
+        if extensions and not name.endswith(extensions):
+            return True
+        for pattern in ignore_patterns:
+            if fnmatch(rel_path if "/" in pattern else name, pattern):
+                return True
+        if include_patterns:
+            return not any(
+                fnmatch(rel_path if "/" in pattern else name, pattern)
+                for pattern in include_patterns
+            )
+        return False
+
+    return skip
+
+
+def measure(skip):
+    start = time.perf_counter()
+    kept = sum(1 for name, path in zip(NAMES, PATHS) if not skip(name, path))
+    return kept, time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    name_patterns = [f"generated_{i}_*.py" for i in range(count)]
+    path_patterns = [f"src/package_{i}/*_1*" for i in range(count)]
+    cases = {
+        "hidden": {},
+        "extension": {"extensions": ("py", "md")},
+        "--ignore names": {"ignore_patterns": name_patterns},
+        "--ignore paths": {"ignore_patterns": path_patterns},
+        "--include": {"include_patterns": name_patterns + ["*.json"]},
+    }
+    print(f"{len(NAMES)} names, {count} patterns per filter")
+    print(f"{'filter':>16}  {'kept':>6}  {'fnmatch':>8}  {'compiled':>8}")
+    for label, options in cases.items():
+        extensions = tuple(options.get("extensions", ()))
+        ignore_patterns = options.get("ignore_patterns", ())
+        include_patterns = options.get("include_patterns", ())
+        kept, before = measure(
+            fnmatch_filter(extensions, ignore_patterns, include_patterns)
+        )
+        path_filter = PathFilter(
+            extensions,
+            ignore_patterns=ignore_patterns,
+            include_patterns=include_patterns,
+        )
+        compiled_kept, after = measure(path_filter.skip_file)
+        assert kept == compiled_kept, "filters disagree"
+        print(f"{label:>16}  {kept:>6}  {before:>8.3f}  {after:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare the compiled gitignore matcher against a linear fnmatch scan as the
+number of rules grows.
+
+    python benchmarks/gitignore_matching.py
+"""
+
+import time
+from fnmatch import fnmatch
+
+from files_to_prompt.cli import Gitignore
+
+PATHS = [f"src/module_{i}/file_{i}.py" for i in range(2000)]
+# Paths matched by the "*gen{i}*" and "**/tmp{i}/*.bak" rules of make_rules()
+PATHS += [f"src/regen{i}.py" for i in range(4, 10000, 600)]
+PATHS += [f"src/tmp{i}/old.bak" for i in range(5, 10000, 600)]
+
+
+def make_rules(count):
+    """
+    A mix of literal names, extensions, anchored paths and globs, including
+    globs with no literal prefix, which cannot be grouped by prefix
+    """
+    rules = []
+    for i in range(count):
+        kind = i % 6
+        if kind == 0:
+            rules.append(f"generated_{i}")
+        elif kind == 1:
+            rules.append(f"*.ext{i}")
+        elif kind == 2:
+            rules.append(f"/build_{i}/output")
+        elif kind == 3:
+            rules.append(f"cache_{i}_*.tmp")
+        elif kind == 4:
+            rules.append(f"*gen{i}*")
+        else:
+            rules.append(f"**/tmp{i}/*.bak")
+    return rules
+
+
+def linear_scan(path, rules):
+    name = path.rsplit("/", 1)[-1]
+    return any(
+        fnmatch(path if "/" in rule else name, rule.replace("**/", "*"))
+        for rule in rules
+    )
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'rules':>6}  {'fnmatch (s)':>12}  {'compiled (s)':>12}")
+    for count in (10, 100, 1000, 10000):
+        rules = make_rules(count)
+        gitignore = Gitignore(rules)
+        linear = timed(lambda: [linear_scan(p, rules) for p in PATHS])
+        compiled = timed(lambda: [gitignore.match(p, False) for p in PATHS])
+        print(f"{count:>6}  {linear:>12.4f}  {compiled:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
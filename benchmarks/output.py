@@ -0,0 +1,68 @@
+"""
+Compare writing many small files through click.echo() against the buffered
+OutputWriter, with output going to /dev/null.
+
+    python benchmarks/output.py [number_of_files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import click
+
+from files_to_prompt.cli import RunContext, process_path
+from files_to_prompt.output import OutputWriter
+
+
+def make_tree(root, file_count):
+    for i in range(file_count):
+        directory = os.path.join(root, f"dir_{i // 500}")
+        if i % 500 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f"file_{i}.txt"), "w") as f:
+            f.write(f"Small file number {i}\n")
+
+
+def run(root, writer, claude_xml):
+    process_path(
+        root,
+        (),
+        False,
+        False,
+        True,
+        (),
+        (),
+        writer,
+        claude_xml,
+        False,
+        context=RunContext(),
+    )
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, file_count)
+        print(f"{file_count} files")
+        for claude_xml in (False, True):
+            with open(os.devnull, "w") as devnull:
+                start = time.perf_counter()
+                run(root, lambda s, nl=True: click.echo(s, devnull, nl), claude_xml)
+                echo = time.perf_counter() - start
+            with open(os.devnull, "wb") as devnull:
+                writer = OutputWriter(devnull)
+                start = time.perf_counter()
+                run(root, writer, claude_xml)
+                writer.close()
+                buffered = time.perf_counter() - start
+            label = "--cxml" if claude_xml else "default"
+            print(
+                f"{label:>8}  click.echo: {echo:.3f}s  "
+                f"OutputWriter: {buffered:.3f}s  ({echo / buffered:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Compare copying a large file straight to the --output file (the default
+format, which can pass the bytes through) against decoding and encoding it
+again (--markdown, which cannot).
+
+    python benchmarks/passthrough.py [size_in_mb]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from click.testing import CliRunner
+
+from files_to_prompt.cli import cli
+
+
+def make_file(path, size):
+    line = "".join(chr(ord("a") + i % 26) for i in range(79)) + "\n"
+    block = (line * (1024 * 1024 // len(line) + 1)).encode("utf-8")[: 1024 * 1024]
+    with open(path, "wb") as f:
+        for _ in range(size):
+            f.write(block)
+        f.write(b"\n")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "large.txt")
+        output = os.path.join(root, "out.txt")
+        make_file(path, size)
+        print(f"{size} MB file")
+        for label, args in (("passthrough", []), ("--markdown", ["--markdown"])):
+            start = time.perf_counter()
+            result = runner.invoke(cli, [path, "-o", output] + args)
+            elapsed = time.perf_counter() - start
+            assert result.exit_code == 0, result.output
+            print(f"{label:>12}  {elapsed:.3f}s  {size / elapsed:,.0f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Run files-to-prompt against synthetic trees in every output format, and
+record wall time, files/sec, MB/sec and peak RSS for each run as JSON.
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --scale 0.1 --scenario small_files
+    python benchmarks/suite.py --output new.json --compare results.json
+
+Each run is a separate files-to-prompt process, so peak RSS is measured
+for that run alone. --scale multiplies the number and size of the files
+in every tree. Peak RSS is only available on Unix.
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+FORMATS = {
+    "default": [],
+    "default-n": ["--line-numbers"],
+    "cxml": ["--cxml"],
+    "cxml-n": ["--cxml", "--line-numbers"],
+    "markdown": ["--markdown"],
+    "markdown-n": ["--markdown", "--line-numbers"],
+}
+
+LINE = "    result = compute(value, other_value)  # a line of source code\n"
+
+
+def write_text(path, size):
+    with open(path, "w") as f:
+        f.write((LINE * (size // len(LINE) + 1))[:size])
+
+
+def small_files(root, scale):
+    "Many small source files spread over a few hundred directories"
+    for i in range(int(20_000 * scale)):
+        directory = os.path.join(root, f"pkg_{i // 1000}", f"mod_{i // 100}")
+        os.makedirs(directory, exist_ok=True)
+        write_text(os.path.join(directory, f"file_{i}.py"), 200 + i % 800)
+
+
+def huge_files(root, scale):
+    "A few very large files, which are streamed"
+    for i in range(4):
+        write_text(os.path.join(root, f"huge_{i}.txt"), int(64 * 1024 * 1024 * scale))
+
+
+def deep_nesting(root, scale):
+    "Chains of directories a hundred levels deep with a file at each level"
+    for chain in range(int(40 * scale) or 1):
+        directory = os.path.join(root, f"chain_{chain}")
+        for depth in range(100):
+            directory = os.path.join(directory, f"d{depth}")
+            os.makedirs(directory)
+            write_text(os.path.join(directory, "file.py"), 500)
+
+
+def gitignore_heavy(root, scale):
+    "Many .gitignore files with many rules, ignoring about half the files"
+    for d in range(int(200 * scale) or 1):
+        directory = os.path.join(root, f"dir_{d}", "src")
+        os.makedirs(directory)
+        with open(os.path.join(os.path.dirname(directory), ".gitignore"), "w") as f:
+            for rule in range(200):
+                f.write(f"generated_{rule}_*.py\n/build_{rule}/\n*.ext{rule}\n")
+            f.write("*.log\n!keep.log\nsrc/cache/\n")
+        os.makedirs(os.path.join(directory, "cache"))
+        for i in range(50):
+            write_text(os.path.join(directory, f"file_{i}.py"), 1000)
+            write_text(os.path.join(directory, f"file_{i}.log"), 1000)
+            write_text(os.path.join(directory, "cache", f"file_{i}.py"), 1000)
+        write_text(os.path.join(directory, "keep.log"), 1000)
+
+
+def binary_heavy(root, scale):
+    "Mostly binary files such as images and archives, with some text files"
+    rng = random.Random(0)
+    signatures = [b"\x89PNG\r\n\x1a\n", b"PK\x03\x04", b"\x7fELF", b"GIF89a"]
+    for i in range(int(5_000 * scale)):
+        directory = os.path.join(root, f"assets_{i // 500}")
+        os.makedirs(directory, exist_ok=True)
+        if i % 5 == 0:
+            write_text(os.path.join(directory, f"notes_{i}.txt"), 2000)
+        else:
+            with open(os.path.join(directory, f"blob_{i}.bin"), "wb") as f:
+                f.write(
+                    signatures[i % 4] + rng.getrandbits(160_000).to_bytes(20_000, "big")
+                )
+
+
+SCENARIOS = {
+    scenario.__name__: scenario
+    for scenario in (
+        small_files,
+        huge_files,
+        deep_nesting,
+        gitignore_heavy,
+        binary_heavy,
+    )
+}
+
+
+def tree_size(root):
+    files = total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return files, total
+
+
+def run_cli(tree, output, args):
+    "Run files-to-prompt in a subprocess, returning wall time and peak RSS in KB"
+    command = [sys.executable, "-m", "files_to_prompt", tree, "-o", output, *args]
+    # Warnings for skipped files go to a file rather than the terminal
+    stderr = open(output + ".stderr", "w+")
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stderr=stderr)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        # As subprocess does: the exit code, or minus the signal that killed it
+        if hasattr(os, "waitstatus_to_exitcode"):
+            process.returncode = os.waitstatus_to_exitcode(status)
+        elif os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        peak_rss = usage.ru_maxrss
+        if sys.platform == "darwin":
+            # macOS reports bytes rather than kilobytes
+            peak_rss //= 1024
+    else:
+        process.wait()
+        peak_rss = None
+    elapsed = time.perf_counter() - start
+    with stderr:
+        if process.returncode != 0:
+            if process.returncode < 0:
+                reason = f"was killed by signal {-process.returncode}"
+            else:
+                reason = f"failed with exit code {process.returncode}"
+            stderr.seek(0)
+            raise click.ClickException(
+                f"{' '.join(command)} {reason}:\n{stderr.read()[-2000:]}"
+            )
+    return elapsed, peak_rss
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = {(r["scenario"], r["format"]): r for r in json.load(f)["results"]}
+    click.echo(f"\nCompared with {previous_path}:")
+    for result in results:
+        before = previous.get((result["scenario"], result["format"]))
+        if before is None:
+            continue
+        change = result["wall_time"] / before["wall_time"] - 1
+        click.echo(
+            f"  {result['scenario']:<16} {result['format']:<11} "
+            f"{before['wall_time']:>8.3f}s -> {result['wall_time']:>8.3f}s  "
+            f"{change:+.1%}"
+        )
+
+
+@click.command()
+@click.option("--scale", type=float, default=1.0, help="Multiply tree sizes by this")
+@click.option(
+    "scenarios",
+    "--scenario",
+    type=click.Choice(list(SCENARIOS)),
+    multiple=True,
+    help="Scenarios to run, defaults to all of them",
+)
+@click.option(
+    "formats",
+    "--format",
+    type=click.Choice(list(FORMATS)),
+    multiple=True,
+    help="Formats to run, defaults to all of them",
+)
+@click.option("--repeat", type=int, default=1, help="Keep the fastest of N runs")
+@click.option("output", "--output", type=click.Path(), help="Save results as JSON")
+@click.option(
+    "previous", "--compare", type=click.Path(exists=True), help="Earlier JSON results"
+)
+def main(scale, scenarios, formats, repeat, output, previous):
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        for name in scenarios or SCENARIOS:
+            tree = os.path.join(root, name)
+            os.makedirs(tree)
+            SCENARIOS[name](tree, scale)
+            files, size = tree_size(tree)
+            click.echo(f"{name}: {files} files, {size / 1024 / 1024:.1f} MB")
+            for format_name in formats or FORMATS:
+                output_path = os.path.join(root, "output.txt")
+                runs = [
+                    run_cli(tree, output_path, FORMATS[format_name])
+                    for _ in range(repeat)
+                ]
+                elapsed = min(run[0] for run in runs)
+                peak_rss = max((run[1] for run in runs if run[1]), default=None)
+                result = {
+                    "scenario": name,
+                    "format": format_name,
+                    "files": files,
+                    "bytes": size,
+                    "output_bytes": os.path.getsize(output_path),
+                    "wall_time": elapsed,
+                    "files_per_sec": files / elapsed,
+                    "mb_per_sec": size / 1024 / 1024 / elapsed,
+                    "peak_rss_kb": peak_rss,
+                }
+                results.append(result)
+                click.echo(
+                    f"  {format_name:<11} {elapsed:>8.3f}s "
+                    f"{result['files_per_sec']:>10,.0f} files/s "
+                    f"{result['mb_per_sec']:>8,.1f} MB/s "
+                    f"{(peak_rss or 0) / 1024:>7,.1f} MB peak RSS"
+                )
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "scale": scale,
+                    "repeat": repeat,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the os.scandir() based walker against the previous os.walk() based
+one on a synthetic tree, counting stat and directory listing calls.
+
+    python benchmarks/walker.py [number_of_files]
+
+Calls are counted by wrapping the os module functions, so stat calls made
+inside os.DirEntry methods (which only happen when the file type is unknown,
+or for symlinks) are not included. Run under "strace -c -f" for exact
+syscall counts.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from fnmatch import fnmatch
+
+from files_to_prompt.cli import gitignore_scopes_for, should_ignore, walk_directory
+from files_to_prompt.filters import PathFilter
+
+COUNTED = ("stat", "lstat", "scandir")
+
+
+def make_tree(root, file_count):
+    per_dir = 100
+    for i in range(file_count):
+        directory = os.path.join(root, f"pkg_{i // (per_dir * 10)}", f"mod_{i // per_dir}")
+        if i % per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, ".gitignore"), "w") as f:
+                f.write("*.pyc\n")
+        name = f"file_{i}.pyc" if i % 10 == 0 else f"file_{i}.py"
+        with open(os.path.join(directory, name), "w") as f:
+            f.write("")
+    os.makedirs(os.path.join(root, ".hidden"))
+
+
+def os_walk_walker(path, extensions, ignore_patterns):
+    "The os.walk() based walker this benchmark compares against"
+    scopes_by_dir = {path: ()}
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        files = [f for f in files if not f.startswith(".")]
+        scopes = gitignore_scopes_for(root, scopes_by_dir.pop(root, ()))
+        dirs[:] = [
+            d for d in dirs if not should_ignore(os.path.join(root, d), True, scopes)
+        ]
+        files = [
+            f for f in files if not should_ignore(os.path.join(root, f), False, scopes)
+        ]
+        for d in dirs:
+            scopes_by_dir[os.path.join(root, d)] = scopes
+        if ignore_patterns:
+            dirs[:] = [
+                d for d in dirs if not any(fnmatch(d, p) for p in ignore_patterns)
+            ]
+            files = [
+                f for f in files if not any(fnmatch(f, p) for p in ignore_patterns)
+            ]
+        if extensions:
+            files = [f for f in files if f.endswith(extensions)]
+        for file in sorted(files):
+            yield os.path.join(root, file)
+
+
+def scandir_walker(path, extensions, ignore_patterns):
+    path_filter = PathFilter(extensions, ignore_patterns=ignore_patterns)
+    return walk_directory(path, path_filter, False, ())
+
+
+def measure(walker, root):
+    counts = dict.fromkeys(COUNTED, 0)
+    originals = {name: getattr(os, name) for name in COUNTED}
+
+    def counting(name):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return originals[name](*args, **kwargs)
+
+        return wrapper
+
+    for name in COUNTED:
+        setattr(os, name, counting(name))
+    try:
+        start = time.perf_counter()
+        paths = list(walker(root, ("py",), ["*_7.py"]))
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return paths, elapsed, counts
+
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, file_count)
+        print(f"{file_count} files")
+        print(f"{'walker':>8}  {'files':>7}  {'seconds':>8}  " + "  ".join(COUNTED))
+        results = []
+        for name, walker in (("os.walk", os_walk_walker), ("scandir", scandir_walker)):
+            paths, elapsed, counts = measure(walker, root)
+            results.append(paths)
+            print(
+                f"{name:>8}  {len(paths):>7}  {elapsed:>8.3f}  "
+                + "  ".join(f"{counts[c]:>{len(c)}}" for c in COUNTED)
+            )
+        assert results[0] == results[1], "walkers disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Time how long --watch takes to rewrite the --output file after one file in
+a large tree changes, against running files-to-prompt again from scratch.
+
+    python benchmarks/watch.py [number_of_files]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from files_to_prompt.cli import watch_paths
+from files_to_prompt.filters import PathFilter
+
+
+def make_tree(root, count):
+    for i in range(count):
+        directory = os.path.join(root, f"package_{i // 500}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"module_{i}.py"), "w") as f:
+            f.write(f"def function_{i}():\n    return {i}\n" * 10)
+
+
+def wait_for_rewrite(output, previous):
+    while True:
+        try:
+            stat = os.stat(output)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_ino != previous:
+            return stat.st_ino
+        time.sleep(0.0005)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    with tempfile.TemporaryDirectory() as root:
+        tree = os.path.join(root, "tree")
+        output = os.path.join(root, "out.txt")
+        make_tree(tree, count)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=watch_paths,
+            args=([tree], PathFilter(), False, output, True, False),
+            kwargs={"stop": stop},
+        )
+        start = time.perf_counter()
+        thread.start()
+        inode = wait_for_rewrite(output, None)
+        print(f"{count} files, initial run {time.perf_counter() - start:.3f}s")
+        target = os.path.join(tree, "package_0", "module_0.py")
+        try:
+            for attempt in range(5):
+                time.sleep(0.5)
+                start = time.perf_counter()
+                with open(target, "a") as f:
+                    f.write(f"# change {attempt}\n")
+                inode = wait_for_rewrite(output, inode)
+                print(f"single file change {time.perf_counter() - start:.3f}s")
+        finally:
+            stop.set()
+            thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+__all__ = ["Document", "iter_documents"]
+
+
+def __getattr__(name):
+    # Imported on first use, so the command line client starts quickly
+    if name in __all__:
+        from . import cli
+
+        return getattr(cli, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,101 @@
+import io
+import os
+import shutil
+import tempfile
+
+ARCHIVE_SUFFIXES = (
+    ".zip",
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+)
+
+
+def is_archive(path):
+    "Whether path is a zip or tar file, going by its name"
+    return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def iter_archive(path, max_in_memory=1024 * 1024):
+    """
+    Yield (name, size, open) for each regular file in the zip or tar archive
+    at path, in the order they are stored. Calling open() returns a new
+    binary file object for the contents of that member, and can be done any
+    number of times before the next member is yielded.
+
+    Nothing is extracted to disk, except that tar members larger than
+    max_in_memory bytes are copied to a temporary file when first opened.
+    Tar files are read as a stream, so each member is decompressed at most
+    once, and only if it is opened.
+
+    Raises one of archive_errors() if the archive cannot be read.
+    """
+    if path.lower().endswith(".zip"):
+        import zipfile
+
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                yield info.filename, info.file_size, lambda: archive.open(info)
+    else:
+        import tarfile
+
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = member.name[2:] if member.name.startswith("./") else member.name
+                contents = TarMember(archive, member, max_in_memory)
+                try:
+                    yield name, member.size, contents.open
+                finally:
+                    contents.close()
+
+
+class TarMember:
+    """
+    Opens a member of a tar file that is being read as a stream, which can
+    only be read once, by keeping its contents in memory or, if it is larger
+    than max_in_memory bytes, in a temporary file.
+    """
+
+    def __init__(self, archive, member, max_in_memory):
+        self.archive = archive
+        self.member = member
+        self.max_in_memory = max_in_memory
+        self.data = None
+        self.temp_path = None
+
+    def open(self):
+        if self.member.size <= self.max_in_memory:
+            if self.data is None:
+                self.data = self.archive.extractfile(self.member).read()
+            return io.BytesIO(self.data)
+        if self.temp_path is None:
+            fd, self.temp_path = tempfile.mkstemp(prefix="files-to-prompt-")
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(self.archive.extractfile(self.member), f)
+        return open(self.temp_path, "rb")
+
+    def close(self):
+        if self.temp_path is not None:
+            os.unlink(self.temp_path)
+            self.temp_path = None
+
+
+def archive_errors():
+    """
+    The exceptions that mean an archive, or a member of it, could not be
+    read: it is not a valid archive, is truncated, or a zip member is
+    encrypted, which zipfile reports as a RuntimeError
+    """
+    import tarfile
+    import zipfile
+    import zlib
+
+    return (zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError, RuntimeError)
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+def is_cacheable(rendered):
+    """
+    Whether rendered is a fully rendered list of plain strings. Lists with
+    placeholders such as LicenseHeader are not, as joining them would lose
+    the placeholders.
+    """
+    return isinstance(rendered, list) and all(type(text) is str for text in rendered)
+
+
+def ignore(rendered):
+    "The store function lookup() returns when there is nothing to store"
+
+
+class RenderCache:
+    """
+    An on-disk cache of rendered files, stored in a SQLite database.
+
+    Entries are keyed by the file's path, st_mtime_ns and st_size plus the
+    output variant (format and line number setting), so any change to a file
+    is a cache miss. Once the cache grows beyond max_size bytes the least
+    recently used entries are evicted.
+
+    Each new entry is committed as soon as it is stored, and the database
+    uses write-ahead logging, so several runs can share a cache directory.
+    If the database is busy for longer than timeout seconds, a lookup is
+    treated as a miss and a new entry is not stored.
+    """
+
+    def __init__(self, cache_dir, max_size, timeout=5.0):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (last_used, *key) for each hit, saved by close()
+        self._used = []
+        # Autocommit, so no transaction is left open between writes
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "files-to-prompt.db"),
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.execute("pragma journal_mode = wal")
+        self._conn.execute("pragma synchronous = normal")
+        self._conn.execute(
+            """
+            create table if not exists blocks (
+                abspath text,
+                path text,
+                variant text,
+                mtime_ns integer,
+                size integer,
+                block text,
+                bytes integer,
+                last_used real,
+                primary key (abspath, path, variant)
+            )
+            """
+        )
+
+    def get_or_render(self, path, variant, render):
+        """
+        Return the cached rendering of path, or call render() and cache its
+        result. Only fully rendered lists of plain strings are cached, not
+        streamed renderings or skipped files.
+        """
+        rendered, store = self.lookup(path, variant)
+        if rendered is None:
+            rendered = render()
+            store(rendered)
+        return rendered
+
+    def lookup(self, path, variant):
+        """
+        Return (rendered, store): the cached rendering of path or None, and
+        a function to call with the rendering on a miss to cache it, for
+        files that are rendered somewhere else, such as a worker process
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, ignore
+        key = (os.path.abspath(path), path, variant)
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "select mtime_ns, size, block from blocks"
+                    " where abspath = ? and path = ? and variant = ?",
+                    key,
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # Locked by another run for too long
+                row = None
+            if row and row[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.hits += 1
+                self._used.append((time.time(), *key))
+                return [row[2]], ignore
+            self.misses += 1
+        return None, lambda rendered: self._store(key, stat, rendered)
+
+    def _store(self, key, stat, rendered):
+        if not is_cacheable(rendered):
+            return
+        block = "".join(rendered)
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "insert or replace into blocks values (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        *key,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                        block,
+                        len(block.encode("utf-8")),
+                        time.time(),
+                    ),
+                )
+            except sqlite3.OperationalError:
+                pass
+
+    def close(self):
+        """
+        Record when the entries that were hit were used, evict least recently
+        used entries down to max_size and close the cache, in one transaction
+        """
+        with self._lock:
+            try:
+                self._conn.execute("begin immediate")
+                try:
+                    self._save_usage()
+                    self._conn.execute("commit")
+                except BaseException:
+                    self._conn.execute("rollback")
+                    raise
+            except sqlite3.OperationalError:
+                # Another run kept the cache busy, leave it as it is
+                pass
+            finally:
+                self._conn.close()
+
+    def _save_usage(self):
+        self._conn.executemany(
+            "update blocks set last_used = ?"
+            " where abspath = ? and path = ? and variant = ?",
+            self._used,
+        )
+        self._used = []
+        total = self._conn.execute(
+            "select coalesce(sum(bytes), 0) from blocks"
+        ).fetchone()[0]
+        if total > self.max_size:
+            evict = []
+            for rowid, size in self._conn.execute(
+                "select rowid, bytes from blocks order by last_used"
+            ):
+                if total <= self.max_size:
+                    break
+                evict.append((rowid,))
+                total -= size
+            self._conn.executemany("delete from blocks where rowid = ?", evict)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import subprocess
+
+import click
+
+
+def run_git(directory, *args):
+    try:
+        result = subprocess.run(
+            ["git", "-C", directory, *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise click.ClickException("git is not installed")
+    if result.returncode != 0:
+        raise click.ClickException(
+            f"git {' '.join(args)} failed: {result.stderr.decode().strip()}"
+        )
+    return [
+        p for p in result.stdout.decode("utf-8", "surrogateescape").split("\0") if p
+    ]
+
+
+def git_files(path, *args):
+    """
+    Run a git command that lists files under path (a file or directory) and
+    return the paths it outputs, joined onto path's directory.
+    """
+    if os.path.isdir(path):
+        base, pathspec = path, "."
+    else:
+        base, pathspec = os.path.dirname(path), os.path.basename(path)
+    files = run_git(base or ".", *args, "-z", "--", pathspec)
+    return {os.path.join(base, p) for p in files}
+
+
+def git_changed_files(path, ref):
+    """
+    Return the files under path that differ from the git ref, including
+    untracked files that are not ignored.
+    """
+    changed = git_files(path, "diff", "--name-only", "--relative", ref)
+    untracked = git_files(path, "ls-files", "--others", "--exclude-standard")
+    return changed | untracked
+
+
+def git_ls_files(path, include_untracked=False):
+    """
+    Return the files under path that are in the git index, and optionally
+    untracked files that are not ignored.
+    """
+    args = ["ls-files", "--cached"]
+    if include_untracked:
+        args += ["--others", "--exclude-standard"]
+    return git_files(path, *args)
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Records the (st_mtime_ns, st_size, hash) of every file seen in a run, so
+    the next run can output only files that were added or modified.
+
+    Files whose mtime and size are unchanged are not read at all. Files that
+    were touched but have the same content are not treated as modified.
+
+    A changed file is only recorded once record_written() says it was
+    written, so files that are skipped, for example by --max-tokens, are
+    still treated as changed by the next run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.previous = json.load(f)
+        self.current = {}
+        # Changed files that have not been written yet
+        self.pending = {}
+
+    def is_changed(self, file_path):
+        stat = os.stat(file_path)
+        previous = self.previous.get(file_path)
+        if previous and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+            self.current[file_path] = previous
+            return False
+        digest = hash_file(file_path)
+        entry = [stat.st_mtime_ns, stat.st_size, digest]
+        if previous and previous[2] == digest:
+            self.current[file_path] = entry
+            return False
+        self.pending[file_path] = entry
+        return True
+
+    def record_written(self, file_path):
+        entry = self.pending.pop(file_path, None)
+        if entry is not None:
+            self.current[file_path] = entry
+
+    def deleted(self):
+        "Files recorded in the previous run that were not seen in this one"
+        seen = self.current.keys() | self.pending.keys()
+        return sorted(set(self.previous) - seen)
+
+    def save(self, complete=True):
+        """
+        Save the files written or unchanged in this run. Files that were not
+        written keep their previous entry, if they had one, as do files that
+        were never reached if the run was not complete.
+        """
+        entries = dict(self.current)
+        for file_path, entry in self.previous.items():
+            if file_path in self.pending or not complete:
+                entries.setdefault(file_path, entry)
+        with open(self.path, "w") as f:
+            json.dump(entries, f, indent=0)
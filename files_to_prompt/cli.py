@@ -1,10 +1,57 @@
+import codecs
+import functools
+import io
+import mmap
 import os
+import re
+import struct
 import sys
-from fnmatch import fnmatch
+import threading
+import time
+from collections import deque
 
-import click
+from .archives import archive_errors, is_archive, iter_archive
+from .compact import Compaction, LicenseHeader
+from .encoding import Decoding, detect_bom, is_wide_text
+from .filters import PathFilter
+from .output import DEFAULT_BUFFER_SIZE, OutputWriter
 
-global_index = 1
+# Files larger than this are streamed in chunks of CHUNK_SIZE characters
+STREAM_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Large files are checked for valid UTF-8 in chunks of this many bytes
+PASSTHROUGH_CHUNK_SIZE = 1024 * 1024
+
+# Files are classified as binary or text from this many leading bytes
+SNIFF_SIZE = 8192
+
+# Signatures of common binary formats
+BINARY_SIGNATURES = (
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # JPEG
+    b"GIF8",
+    b"%PDF-",
+    b"PK\x03\x04",  # ZIP and formats built on it
+    b"\x1f\x8b",  # gzip
+    b"\xfd7zXZ",
+    b"7z\xbc\xaf",
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"Rar!",
+    b"\x7fELF",
+    b"\xca\xfe\xba\xbe",  # Java class / Mach-O universal
+    b"\xcf\xfa\xed\xfe",  # Mach-O
+    b"\x00asm",
+    b"SQLite format 3\x00",
+)
+
+# Bytes that may appear in text: printable characters, anything above 0x7f
+# (for multi-byte encodings) and common whitespace and control characters
+TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7F})
+
+# Characters that str.splitlines() treats as line boundaries, other than
+# \r which universal newlines mode never returns
+LINE_BOUNDARIES = "\n\v\f\x1c\x1d\x1e\x85\u2028\u2029"
 
 EXT_TO_LANG = {
     "py": "python",
@@ -24,23 +71,233 @@ EXT_TO_LANG = {
 }
 
 
-def should_ignore(path, gitignore_rules):
-    for rule in gitignore_rules:
-        if fnmatch(os.path.basename(path), rule):
-            return True
-        if os.path.isdir(path) and fnmatch(os.path.basename(path) + "/", rule):
-            return True
-    return False
+def _translate_gitignore_pattern(pattern):
+    "Translate a single gitignore glob (without ! or trailing /) to a regex"
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            at_boundary = i == 0 or pattern[i - 1] == "/"
+            if at_boundary and pattern.startswith("**", i):
+                if i + 2 == n:
+                    # Trailing "/**" matches everything inside
+                    res.append(".*")
+                    i += 2
+                    continue
+                if pattern[i + 2] == "/":
+                    # "**/" matches zero or more directories
+                    res.append("(?:.*/)?")
+                    i += 3
+                    continue
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                res.append(re.escape(c))
+            else:
+                stuff = pattern[i + 1 : j].replace("\\", "\\\\")
+                if stuff[0] in "!^":
+                    stuff = "^" + stuff[1:]
+                res.append(f"[{stuff}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res)
+
+
+_GLOB_CHARS = re.compile(r"[*?[\\]")
+
+
+class _GitignoreRules:
+    """
+    Rules from one .gitignore that apply to either files or directories.
+
+    Literal names, literal paths and "*.ext" patterns are looked up in
+    dictionaries. Other globs are grouped by their literal prefix, so only
+    the groups whose prefix matches the path are ever run. Each group is
+    compiled into a combined regular expression that says whether any of
+    its rules match; only then are its rules tried one at a time, last
+    first, to find which. Every lookup returns the index of the last rule to
+    match, which resolves "last match wins".
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.paths = {}
+        self.suffixes = {}
+        self.name_globs = {}
+        self.path_globs = {}
+
+    def add(self, index, pattern, anchored):
+        if not _GLOB_CHARS.search(pattern):
+            (self.paths if anchored else self.names)[pattern] = index
+        elif (
+            not anchored
+            and pattern.startswith("*.")
+            and not _GLOB_CHARS.search(pattern[1:])
+        ):
+            self.suffixes[pattern[1:]] = index
+        else:
+            globs = self.path_globs if anchored else self.name_globs
+            prefix = pattern[: _GLOB_CHARS.search(pattern).start()]
+            globs.setdefault(prefix, []).append(
+                (index, _translate_gitignore_pattern(pattern))
+            )
+
+    def compile(self):
+        self.name_globs, self.name_prefix_lengths = self._combine(self.name_globs)
+        self.path_globs, self.path_prefix_lengths = self._combine(self.path_globs)
+
+    @staticmethod
+    def _combine(globs):
+        combined = {}
+        for prefix, patterns in globs.items():
+            # Capturing groups to tell which rule matched would make the
+            # combined regex slower with every rule, so it is only a yes/no
+            # check and the rules are then tried last first
+            any_match = re.compile(
+                "|".join(f"(?:{pattern})" for _, pattern in patterns)
+            )
+            rules = [(index, re.compile(pattern)) for index, pattern in patterns[::-1]]
+            combined[prefix] = (any_match, rules)
+        return combined, sorted({len(prefix) for prefix in combined})
+
+    @staticmethod
+    def _last_glob_match(globs, prefix_lengths, value, best):
+        for length in prefix_lengths:
+            if length > len(value):
+                break
+            group = globs.get(value[:length])
+            if group is None or group[1][0][0] <= best:
+                continue
+            any_match, rules = group
+            if any_match.fullmatch(value) is None:
+                continue
+            for index, regex in rules:
+                if index <= best:
+                    break
+                if regex.fullmatch(value) is not None:
+                    best = index
+                    break
+        return best
+
+    def last_match(self, rel_path):
+        name = rel_path.rpartition("/")[2]
+        best = max(self.names.get(name, -1), self.paths.get(rel_path, -1))
+        if self.suffixes:
+            dot = name.find(".")
+            while dot != -1:
+                best = max(best, self.suffixes.get(name[dot:], -1))
+                dot = name.find(".", dot + 1)
+        best = self._last_glob_match(
+            self.name_globs, self.name_prefix_lengths, name, best
+        )
+        return self._last_glob_match(
+            self.path_globs, self.path_prefix_lengths, rel_path, best
+        )
+
+
+class Gitignore:
+    """
+    A single .gitignore file compiled once for fast matching.
+
+    Patterns are matched against paths relative to the directory containing
+    the .gitignore file. As in git, the last matching pattern wins.
+    """
+
+    def __init__(self, lines):
+        self._negated = []
+        self._file_rules = _GitignoreRules()
+        self._dir_rules = _GitignoreRules()
+        for line in lines:
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            elif line.startswith("\\!") or line.startswith("\\#"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line.startswith("**/") and "/" not in line[3:]:
+                line = line[3:]
+            if not line:
+                continue
+            # Patterns containing a slash are anchored to this directory
+            anchored = "/" in line
+            line = line.lstrip("/")
+            index = len(self._negated)
+            self._negated.append(negated)
+            self._dir_rules.add(index, line, anchored)
+            if not dir_only:
+                self._file_rules.add(index, line, anchored)
+        self._file_rules.compile()
+        self._dir_rules.compile()
+
+    def match(self, rel_path, is_dir):
+        """
+        Returns True if rel_path is ignored, False if it was re-included
+        by a negated pattern and None if no pattern matched.
+        """
+        rules = self._dir_rules if is_dir else self._file_rules
+        index = rules.last_match(rel_path)
+        if index == -1:
+            return None
+        return not self._negated[index]
 
 
 def read_gitignore(path):
     gitignore_path = os.path.join(path, ".gitignore")
-    if os.path.isfile(gitignore_path):
+    try:
         with open(gitignore_path, "r") as f:
             return [
                 line.strip() for line in f if line.strip() and not line.startswith("#")
             ]
-    return []
+    except OSError:
+        return []
+
+
+def gitignore_scopes_for(directory, parent_scopes=()):
+    """
+    Returns parent_scopes extended with the .gitignore in directory, if any.
+
+    Each scope is an (offset, Gitignore) pair where offset is the length of
+    the directory prefix to strip from a path to make it relative to the
+    .gitignore that applies to it.
+    """
+    rules = read_gitignore(directory)
+    if not rules:
+        return parent_scopes
+    if not directory:
+        offset = 0
+    elif directory.endswith(os.sep):
+        offset = len(directory)
+    else:
+        offset = len(directory) + 1
+    return parent_scopes + ((offset, Gitignore(rules)),)
+
+
+def should_ignore(path, is_dir, gitignore_scopes):
+    # Deeper .gitignore files take precedence over their parents
+    for offset, gitignore in reversed(gitignore_scopes):
+        rel_path = path[offset:]
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        ignored = gitignore.match(rel_path, is_dir)
+        if ignored is not None:
+            return ignored
+    return False
 
 
 def add_line_numbers(content):
@@ -52,9 +309,44 @@ def add_line_numbers(content):
     return "\n".join(numbered_lines)
 
 
-def print_path(writer, path, content, cxml, markdown, line_numbers):
+class RunContext:
+    """
+    State for a single run, passed through process_path() and the print_*
+    functions so that concurrent runs in one process stay independent.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        budget=None,
+        manifest=None,
+        dedupe=None,
+        stats=None,
+        decoding=None,
+        listings=None,
+        compaction=None,
+    ):
+        self.index = 1
+        self.cache = cache
+        self.budget = budget
+        self.manifest = manifest
+        self.dedupe = dedupe
+        self.stats = stats
+        self.decoding = decoding if decoding is not None else Decoding()
+        self.listings = listings
+        self.compaction = compaction
+        # Keys of the license headers written so far, with --compact
+        self.license_headers = set()
+
+    def next_index(self):
+        index = self.index
+        self.index += 1
+        return index
+
+
+def print_path(writer, path, content, cxml, markdown, line_numbers, context=None):
     if cxml:
-        print_as_xml(writer, path, content, line_numbers)
+        print_as_xml(writer, path, content, line_numbers, context)
     elif markdown:
         print_as_markdown(writer, path, content, line_numbers)
     else:
@@ -71,9 +363,41 @@ def print_default(writer, path, content, line_numbers):
     writer("---")
 
 
-def print_as_xml(writer, path, content, line_numbers):
-    global global_index
-    writer(f'<document index="{global_index}">')
+def print_as_xml(writer, path, content, line_numbers, context):
+    writer(f'<document index="{context.next_index()}">')
+    print_xml_content(writer, path, content, line_numbers)
+
+
+def print_deleted(writer, path, claude_xml, markdown, context):
+    if claude_xml:
+        writer(f'<document index="{context.next_index()}">')
+        writer(f"<source>{path}</source>")
+        writer("<deleted />")
+        writer("</document>")
+    elif markdown:
+        writer(path)
+        writer("(deleted)")
+    else:
+        writer(path)
+        writer("---")
+        writer("(deleted)")
+        writer("---")
+
+
+def render_duplicate(path, original, original_index, claude_xml, markdown):
+    "Render a reference to the earlier document original, in place of path"
+    if claude_xml:
+        return [
+            f"<source>{path}</source>\n"
+            f'<duplicate_of index="{original_index}">{original}</duplicate_of>\n'
+            "</document>\n"
+        ]
+    elif markdown:
+        return [f"{path}\n(duplicate of {original})\n"]
+    return [f"{path}\n---\n(duplicate of {original})\n---\n"]
+
+
+def print_xml_content(writer, path, content, line_numbers):
     writer(f"<source>{path}</source>")
     writer("<document_content>")
     if line_numbers:
@@ -81,7 +405,6 @@ def print_as_xml(writer, path, content, line_numbers):
     writer(content)
     writer("</document_content>")
     writer("</document>")
-    global_index += 1
 
 
 def print_as_markdown(writer, path, content, line_numbers):
@@ -98,237 +421,1625 @@ def print_as_markdown(writer, path, content, line_numbers):
     writer(f"{backticks}")
 
 
+class SkippedFile:
+    "Returned by render_file() for a file that should be skipped with a warning"
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
+class DuplicateFile:
+    """
+    Stands in for the rendering of a file with the same content as an
+    earlier one. render() renders the file itself, for when the earlier
+    file was not written.
+    """
+
+    def __init__(self, original, render):
+        self.original = original
+        self.render = render
+
+
+def is_binary(prefix):
+    """
+    Guess whether a file is binary from the first SNIFF_SIZE bytes, using
+    NUL bytes, well known signatures and the proportion of control bytes.
+    """
+    if not prefix:
+        return False
+    if b"\0" in prefix or prefix.startswith(BINARY_SIGNATURES):
+        return True
+    return len(prefix.translate(None, TEXT_BYTES)) / len(prefix) > 0.3
+
+
+def looks_binary(prefix):
+    """
+    Whether prefix, the start of a file, is mostly NUL and control bytes.
+    UTF-16 and UTF-32 text does too, unless it has a byte order mark, so
+    such files are only decoded with one of those encodings.
+    """
+    return detect_bom(prefix) is None and is_binary(prefix)
+
+
+def undecodable(decoding, binary):
+    "The SkippedFile for a file that could not be decoded with any attempt"
+    if binary:
+        return SkippedFile("as it appears to be binary")
+    decoding.record(recovered=False)
+    return SkippedFile("due to UnicodeDecodeError")
+
+
+def render_file(
+    path,
+    claude_xml,
+    markdown,
+    line_numbers,
+    max_file_size=None,
+    stats=None,
+    decoding=None,
+    compaction=None,
+    on_decoded=None,
+):
+    """
+    Read and render a single file, returning a SkippedFile if it is too large,
+    looks binary or could not be decoded.
+
+    Files are decoded as UTF-8 unless decoding, a Decoding, says otherwise.
+    A byte order mark at the start of a file overrides the encoding, and
+    on_decoded(encoding, errors) is called with the settings that worked. If
+    compaction, a Compaction, is given the decoded text is compacted as it is
+    read, and a license header is rendered as a separate LicenseHeader.
+
+    The result is an iterable of strings that together make up the rendered
+    document. Files larger than STREAM_THRESHOLD are checked in a first pass
+    and then streamed in chunks, so they are never held in memory in full.
+    Where their bytes can be copied to the output unchanged, the file's
+    contents are represented by a FileContents placeholder instead.
+
+    For --cxml the opening <document index="..."> tag is left out, so that
+    files can be rendered in any order and numbered when they are written.
+    """
+    if stats is not None:
+        started = time.perf_counter()
+    if decoding is None:
+        decoding = Decoding()
+    size = os.stat(path).st_size
+    if max_file_size is not None and size > max_file_size:
+        return SkippedFile(f"as it is larger than {max_file_size} bytes")
+    with open(path, "rb") as raw:
+        prefix = raw.read(SNIFF_SIZE)
+        binary = looks_binary(prefix)
+        for attempt, (encoding, errors) in enumerate(decoding.attempts(prefix)):
+            if binary and not is_wide_text(prefix, encoding):
+                continue
+            raw.seek(0)
+            f = io.TextIOWrapper(raw, encoding=encoding, errors=errors)
+            try:
+                if size <= STREAM_THRESHOLD:
+                    content = f.read()
+                elif (
+                    compaction is None
+                    and not line_numbers
+                    and not markdown
+                    and encoding == "utf-8"
+                    and errors == "strict"
+                    and is_passthrough_safe(raw)
+                ):
+                    rendered = stream_file(
+                        path, claude_xml, markdown, False, passthrough=True
+                    )
+                else:
+                    line_count, backtick_run = scan_text(f)
+                    rendered = stream_file(
+                        path,
+                        claude_xml,
+                        markdown,
+                        line_numbers,
+                        line_count,
+                        backtick_run,
+                        encoding=encoding,
+                        errors=errors,
+                        compaction=compaction,
+                    )
+            except UnicodeDecodeError:
+                continue
+            finally:
+                # Leave raw open for the next attempt
+                f.detach()
+            if attempt:
+                decoding.record(recovered=True)
+            if on_decoded is not None:
+                on_decoded(encoding, errors)
+            break
+        else:
+            return undecodable(decoding, binary)
+    if compaction is not None:
+        compaction.record(files=1, bytes_read=size)
+    if size > STREAM_THRESHOLD:
+        return rendered
+    if stats is not None:
+        read = time.perf_counter()
+        stats.add_time("read", read - started)
+        stats.count("bytes_read", size)
+    rendered = format_content(
+        path, content, claude_xml, markdown, line_numbers, compaction
+    )
+    if stats is not None:
+        stats.add_time("format", time.perf_counter() - read)
+    return rendered
+
+
+def format_content(path, content, claude_xml, markdown, line_numbers, compaction=None):
+    """
+    Render the decoded content of a file as a list with a single string, or
+    if compaction finds a license header, as the text before the header, the
+    header as a LicenseHeader and the text after it
+    """
+    header = None
+    if compaction is not None:
+        content, header, header_line = compaction.compact(
+            content, EXT_TO_LANG.get(path.split(".")[-1])
+        )
+    lines = []
+    if claude_xml:
+        print_xml_content(lines.append, path, content, line_numbers)
+    else:
+        print_path(lines.append, path, content, False, markdown, line_numbers)
+    rendered = "\n".join(lines) + "\n"
+    if header is None:
+        return [rendered]
+    # The content starts after two lines: the path, or <source>, and then
+    # ---, <document_content> or the opening fence
+    first_line = len(f"<source>{path}</source>" if claude_xml else path)
+    start = line_offset(rendered, first_line + 1, header_line + 1)
+    # A file can end with its header, in which case formatting added the
+    # newline after its last line
+    lines = header.count("\n") + (not header.endswith("\n"))
+    end = line_offset(rendered, start, lines)
+    return [
+        rendered[:start],
+        LicenseHeader(rendered[start:end], header.key),
+        rendered[end:],
+    ]
+
+
+def line_offset(text, start, count):
+    "The offset in text of the start of the line count lines after start"
+    for _ in range(count):
+        start = text.index("\n", start) + 1
+    return start
+
+
+def render_bytes(
+    path, data, claude_xml, markdown, line_numbers, decoding=None, compaction=None
+):
+    """
+    Render the contents of a file that has already been read into memory,
+    such as an archive member, in the same way as render_file()
+    """
+    if decoding is None:
+        decoding = Decoding()
+    prefix = data[:SNIFF_SIZE]
+    binary = looks_binary(prefix)
+    for attempt, (encoding, errors) in enumerate(decoding.attempts(prefix)):
+        if binary and not is_wide_text(prefix, encoding):
+            continue
+        f = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors=errors)
+        try:
+            content = f.read()
+        except UnicodeDecodeError:
+            continue
+        if attempt:
+            decoding.record(recovered=True)
+        if compaction is not None:
+            compaction.record(files=1, bytes_read=len(data))
+        return format_content(
+            path, content, claude_xml, markdown, line_numbers, compaction
+        )
+    return undecodable(decoding, binary)
+
+
+class StreamedMember:
+    """
+    The rendered chunks of an archive member that is too large to read into
+    memory. Unlike a streamed file, its size cannot be found from its path.
+    """
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+def render_stream(
+    path,
+    size,
+    open_member,
+    claude_xml,
+    markdown,
+    line_numbers,
+    decoding=None,
+    compaction=None,
+):
+    """
+    Render an archive member larger than STREAM_THRESHOLD in the same way as
+    render_file() renders a large file: it is checked in a first pass and
+    then streamed in chunks. open_member() returns a new binary file object
+    for its contents each time it is called.
+    """
+    if decoding is None:
+        decoding = Decoding()
+    with open_member() as raw:
+        prefix = raw.read(SNIFF_SIZE)
+    binary = looks_binary(prefix)
+    for attempt, (encoding, errors) in enumerate(decoding.attempts(prefix)):
+        if binary and not is_wide_text(prefix, encoding):
+            continue
+        with io.TextIOWrapper(open_member(), encoding=encoding, errors=errors) as f:
+            try:
+                line_count, backtick_run = scan_text(f)
+            except UnicodeDecodeError:
+                continue
+        if attempt:
+            decoding.record(recovered=True)
+        if compaction is not None:
+            compaction.record(files=1, bytes_read=size)
+        chunks = stream_file(
+            path,
+            claude_xml,
+            markdown,
+            line_numbers,
+            line_count,
+            backtick_run,
+            encoding=encoding,
+            errors=errors,
+            compaction=compaction,
+            opener=open_member,
+        )
+        return StreamedMember(chunks, size)
+    return undecodable(decoding, binary)
+
+
+def iter_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def scan_text(f):
+    """
+    Decode f in chunks without keeping it, returning the number of lines it
+    has (as counted by str.splitlines) and its longest run of backticks.
+    """
+    line_count = 0
+    longest_run = run = 0
+    last_char = ""
+    for chunk in iter_chunks(f):
+        line_count += sum(chunk.count(boundary) for boundary in LINE_BOUNDARIES)
+        last_char = chunk[-1]
+        for m in re.finditer("`+", chunk):
+            length = m.end() - m.start()
+            if m.start() == 0:
+                length += run
+            longest_run = max(longest_run, length)
+            run = length if m.end() == len(chunk) else 0
+        if not chunk.endswith("`"):
+            run = 0
+    if last_char and last_char not in LINE_BOUNDARIES:
+        line_count += 1
+    return line_count, longest_run
+
+
+def iter_numbered_lines(chunks, line_count):
+    """
+    Streaming equivalent of add_line_numbers(), with a trailing newline. A
+    LicenseHeader chunk, which --compact puts on line boundaries, is numbered
+    and yielded as a LicenseHeader.
+    """
+    padding = len(str(line_count))
+    number = 1
+    carry = ""
+    for chunk in chunks:
+        if isinstance(chunk, LicenseHeader) and not carry:
+            numbered = []
+            for line in chunk.splitlines():
+                numbered.append(f"{number:{padding}}  {line}\n")
+                number += 1
+            yield LicenseHeader("".join(numbered), chunk.key)
+            continue
+        lines = (carry + chunk).splitlines(True)
+        carry = ""
+        if lines[-1][-1] not in LINE_BOUNDARIES:
+            carry = lines.pop()
+        numbered = []
+        for line in lines:
+            numbered.append(f"{number:{padding}}  {line[:-1]}\n")
+            number += 1
+        yield "".join(numbered)
+    if carry:
+        yield f"{number:{padding}}  {carry}\n"
+    elif number == 1:
+        yield "\n"
+
+
+def is_passthrough_safe(raw):
+    """
+    Check the binary file raw is valid UTF-8 with no carriage returns, so
+    that decoding it in universal newlines mode and encoding it as UTF-8
+    again gives exactly the same bytes.
+
+    The file is memory-mapped, and only chunks that are not pure ASCII are
+    run through a decoder. Raises UnicodeDecodeError for invalid UTF-8.
+    """
+    if not os.fstat(raw.fileno()).st_size:
+        # Empty files cannot be memory-mapped
+        return True
+    with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm.find(b"\r") != -1:
+            return False
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for start in range(0, len(mm), PASSTHROUGH_CHUNK_SIZE):
+            chunk = mm[start : start + PASSTHROUGH_CHUNK_SIZE]
+            # An ASCII chunk is valid unless it follows an incomplete sequence
+            if not chunk.isascii() or decoder.getstate()[0]:
+                decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    return True
+
+
+class FileContents:
+    """
+    Stands in for the unmodified contents of a file in rendered output, so a
+    writer with a write_file() method can copy its bytes directly.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_text(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            yield from iter_chunks(f)
+
+    def write_to(self, writer):
+        write_file = getattr(writer, "write_file", None)
+        if write_file is not None:
+            write_file(self.path)
+        else:
+            for chunk in self.iter_text():
+                writer(chunk, nl=False)
+
+
+def stream_file(
+    path,
+    claude_xml,
+    markdown,
+    line_numbers,
+    line_count=0,
+    backtick_run=0,
+    passthrough=False,
+    encoding="utf-8",
+    errors="strict",
+    compaction=None,
+    opener=None,
+):
+    "Yield the rendered chunks of path, or of the binary file opener() returns"
+    if claude_xml:
+        prefix = f"<source>{path}</source>\n<document_content>\n"
+        suffix = "</document_content>\n</document>\n"
+    elif markdown:
+        lang = EXT_TO_LANG.get(path.split(".")[-1], "")
+        backticks = "`" * (backtick_run + 1 if backtick_run >= 3 else 3)
+        prefix = f"{path}\n{backticks}{lang}\n"
+        suffix = f"{backticks}\n"
+    else:
+        prefix = f"{path}\n---\n"
+        suffix = "\n---\n"
+    yield prefix
+    if passthrough:
+        yield FileContents(path)
+        yield "\n"
+        yield suffix
+        return
+    if opener is not None:
+        f = io.TextIOWrapper(opener(), encoding=encoding, errors=errors)
+    else:
+        f = open(path, "r", encoding=encoding, errors=errors)
+    with f:
+        chunks = iter_chunks(f)
+        if compaction is not None:
+            chunks = compaction.iter_chunks(
+                chunks, EXT_TO_LANG.get(path.split(".")[-1]), CHUNK_SIZE
+            )
+        if line_numbers:
+            # line_count is from before compaction, which only matters for
+            # the width of the numbers
+            yield from iter_numbered_lines(chunks, line_count)
+        else:
+            newline = "\n"
+            for chunk in chunks:
+                if isinstance(chunk, LicenseHeader) and not chunk.endswith("\n"):
+                    # The file ends with its header, so the newline after
+                    # it is left out along with it, as in format_content()
+                    chunk = LicenseHeader(chunk + "\n", chunk.key)
+                    newline = ""
+                yield chunk
+            if newline:
+                yield newline
+    yield suffix
+
+
+def echo_err(message):
+    "Write a line to stderr, like click.echo(message, err=True)"
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+def warn(message):
+    "Write a warning to stderr, in red if stderr is a terminal"
+    if sys.stderr.isatty():
+        message = f"\x1b[31m{message}\x1b[0m"
+    echo_err(message)
+
+
+def write_rendered(writer, path, rendered, claude_xml, context, markdown=False):
+    if isinstance(rendered, DuplicateFile):
+        if rendered.original in context.dedupe.written:
+            rendered = render_duplicate(
+                path,
+                rendered.original,
+                context.dedupe.written[rendered.original],
+                claude_xml,
+                markdown,
+            )
+        else:
+            rendered = rendered.render()
+    stats = context.stats
+    if isinstance(rendered, SkippedFile):
+        warn(f"Warning: Skipping file {path} {rendered.reason}")
+        if stats is not None:
+            stats.skip(rendered.reason)
+        return
+    if context.budget is not None and not context.budget.admit(path, rendered):
+        if stats is not None:
+            stats.skip("over --max-tokens")
+        return
+    index = None
+    if claude_xml:
+        index = context.next_index()
+        writer(f'<document index="{index}">')
+    if context.dedupe is not None:
+        context.dedupe.record_written(path, index)
+    if context.manifest is not None:
+        context.manifest.record_written(path)
+    if stats is not None:
+        stats.count("files_written")
+        if not isinstance(rendered, list):
+            # Streamed files are read while they are written
+            started = time.perf_counter()
+            write_time = stats.timings["write"]
+            if isinstance(rendered, StreamedMember):
+                stats.count("bytes_read", rendered.size)
+            else:
+                stats.count("bytes_read", os.path.getsize(path))
+    for text in rendered:
+        if isinstance(text, FileContents):
+            text.write_to(writer)
+        elif isinstance(text, LicenseHeader):
+            if text.key in context.license_headers:
+                if context.compaction is not None:
+                    context.compaction.record(
+                        bytes_saved=len(text.encode("utf-8", "surrogatepass"))
+                    )
+                continue
+            context.license_headers.add(text.key)
+            writer(text, nl=False)
+        else:
+            writer(text, nl=False)
+    if stats is not None and not isinstance(rendered, list):
+        elapsed = time.perf_counter() - started
+        stats.add_time("read", elapsed - (stats.timings["write"] - write_time))
+
+
+def walk_directory(
+    path,
+    path_filter,
+    ignore_gitignore,
+    gitignore_scopes,
+    follow_symlinks=False,
+    stats=None,
+    directories=None,
+):
+    """
+    Yield the paths of files below the directory path that pass path_filter,
+    a PathFilter, and the .gitignore rules. Each directory that is visited is
+    added to directories, if that is a set.
+
+    Directories are visited in the same order as os.walk(), with the files
+    in each directory sorted by name. Entries are filtered by name, using the
+    file type os.scandir() already knows, so hidden and ignored entries are
+    never stat'ed. The .gitignore rules are checked last, as they are the
+    most expensive. With follow_symlinks, symlinked directories are followed
+    and each directory is visited at most once, to avoid symlink loops.
+    """
+    ignored = should_ignore
+    scopes_for = gitignore_scopes_for
+    if stats is not None:
+        ignored = stats.timed("gitignore", should_ignore)
+        scopes_for = stats.timed("gitignore", gitignore_scopes_for)
+    skip_file = path_filter.skip_file
+    skip_dir = path_filter.skip_dir
+    uses_paths = path_filter.uses_paths
+    prefix_length = len(os.path.join(path, ""))
+    visited = set()
+    if follow_symlinks:
+        stat = os.stat(path)
+        visited.add((stat.st_dev, stat.st_ino))
+    # Stack of (directory, inherited .gitignore scopes), popped from the end
+    stack = [(path, gitignore_scopes)]
+    while stack:
+        directory, scopes = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if directories is not None:
+            directories.add(directory)
+        if not ignore_gitignore and any(e.name == ".gitignore" for e in entries):
+            scopes = scopes_for(directory, scopes)
+        files = []
+        dirs = []
+        considered = 0
+        for entry in entries:
+            name = entry.name
+            rel_path = None
+            if uses_paths:
+                rel_path = entry.path[prefix_length:].replace(os.sep, "/")
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                reason = skip_dir(name, rel_path)
+                if reason is not None:
+                    if stats is not None and reason == "hidden":
+                        stats.skip(reason)
+                    continue
+                if scopes and ignored(entry.path, True, scopes):
+                    continue
+                if entry.is_symlink():
+                    if not follow_symlinks:
+                        continue
+                    stat = entry.stat()
+                    if (stat.st_dev, stat.st_ino) in visited:
+                        continue
+                    visited.add((stat.st_dev, stat.st_ino))
+                elif follow_symlinks:
+                    stat = entry.stat(follow_symlinks=False)
+                    visited.add((stat.st_dev, stat.st_ino))
+                dirs.append((entry.path, scopes))
+            else:
+                reason = skip_file(name, rel_path)
+                if reason is None and scopes and ignored(entry.path, False, scopes):
+                    reason = ".gitignore"
+                if reason != "hidden":
+                    considered += 1
+                if reason is not None:
+                    if stats is not None:
+                        stats.skip(reason)
+                    continue
+                files.append(entry.path)
+        if stats is not None:
+            stats.count("directories")
+            stats.count("files_considered", considered)
+        yield from sorted(files)
+        stack.extend(reversed(dirs))
+
+
+def filter_file_paths(
+    path,
+    candidates,
+    path_filter,
+    ignore_gitignore,
+    gitignore_scopes,
+):
+    """
+    Yield the existing files from candidates, a list of file paths below the
+    directory path, that walk_directory() would have yielded - without
+    walking the tree. Each directory on the way is only checked once.
+
+    Files are yielded sorted by directory and then by name.
+    """
+    root = os.path.dirname(os.path.join(path, ""))
+    prefix_length = len(os.path.join(root, ""))
+    if ignore_gitignore:
+        root_scopes = ()
+    else:
+        root_scopes = gitignore_scopes_for(path, gitignore_scopes)
+    dir_scopes = {root: root_scopes}
+    excluded = set()
+
+    def relative(file_path):
+        return file_path[prefix_length:].replace(os.sep, "/")
+
+    def scopes_for(directory):
+        # Returns None if the directory itself is filtered out
+        if directory in dir_scopes:
+            return dir_scopes[directory]
+        if directory in excluded or directory == os.path.dirname(directory):
+            return None
+        parent_scopes = scopes_for(os.path.dirname(directory))
+        if (
+            parent_scopes is None
+            or path_filter.skip_dir(os.path.basename(directory), relative(directory))
+            or (parent_scopes and should_ignore(directory, True, parent_scopes))
+        ):
+            excluded.add(directory)
+            return None
+        if ignore_gitignore:
+            scopes = ()
+        else:
+            scopes = gitignore_scopes_for(directory, parent_scopes)
+        dir_scopes[directory] = scopes
+        return scopes
+
+    def sort_key(file_path):
+        directory, name = os.path.split(file_path)
+        return directory.split(os.sep), name
+
+    for file_path in sorted(candidates, key=sort_key):
+        if path_filter.skip_file(os.path.basename(file_path), relative(file_path)):
+            continue
+        scopes = scopes_for(os.path.dirname(file_path))
+        if scopes is None or (scopes and should_ignore(file_path, False, scopes)):
+            continue
+        if os.path.isfile(file_path):
+            yield file_path
+
+
+def iter_file_paths(
+    path,
+    path_filter,
+    ignore_gitignore,
+    gitignore_scopes,
+    follow_symlinks=False,
+    candidates=None,
+    stats=None,
+    directories=None,
+):
+    """
+    Yield the files to include for path. If candidates is a list of file
+    paths, only those are considered and the directory is not walked.
+    Otherwise the directories walked are added to directories, if given.
+
+    A path to a file is always included, without being filtered.
+    """
+    if os.path.isfile(path):
+        if stats is not None:
+            stats.count("files_considered")
+        if candidates is None or path in candidates:
+            yield path
+    elif os.path.isdir(path):
+        if candidates is not None:
+            if stats is not None:
+                stats.count("files_considered", len(candidates))
+            yield from filter_file_paths(
+                path, candidates, path_filter, ignore_gitignore, gitignore_scopes
+            )
+            return
+        yield from walk_directory(
+            path,
+            path_filter,
+            ignore_gitignore,
+            gitignore_scopes,
+            follow_symlinks,
+            stats,
+            directories,
+        )
+
+
+def render_in_order(executor, file_paths, render, window):
+    """
+    Submit render(path) for each path to executor, keeping at most window
+    files in flight, and yield (path, result) pairs in the original order.
+    """
+    pending = deque()
+    for file_path in file_paths:
+        pending.append((file_path, executor.submit(render, file_path)))
+        if len(pending) >= window:
+            file_path, future = pending.popleft()
+            yield file_path, future.result()
+    while pending:
+        file_path, future = pending.popleft()
+        yield file_path, future.result()
+
+
+# Result kinds in the bytes returned by render_shard()
+SHARD_RENDERED = 0
+SHARD_RECOVERED = 1
+SHARD_SKIPPED = 2
+SHARD_UNDECODABLE = 3
+SHARD_IN_PARENT = 4
+SHARD_HEADER = struct.Struct("<BQ")
+
+# With --compact, rendered results are followed by the bytes read and saved,
+# and the offset and length in the result of any license header and its key
+SHARD_COMPACTION = struct.Struct("<QQQQQ")
+
+# Number of files sent to a worker process at a time with --processes
+SHARD_SIZE = 32
+
+
+def render_shard(
+    file_paths,
+    claude_xml,
+    markdown,
+    line_numbers,
+    max_file_size,
+    encoding,
+    fallback_encodings,
+    compact=False,
+    strip_comments=False,
+):
+    """
+    Render a shard of files in a worker process for --processes, returning
+    the results packed into bytes so that no Python objects have to be
+    pickled on the way back.
+
+    Each result is a SHARD_HEADER of (kind, length) followed by that many
+    bytes: the rendered text, or the reason a file was skipped, encoded as
+    UTF-8. With compact, rendered text is followed by a SHARD_COMPACTION and
+    the key of its license header. Paths given as None, and files too large
+    to render in memory, are left for the parent process with
+    SHARD_IN_PARENT.
+    """
+    decoding = Decoding(encoding, fallback_encodings)
+    compaction = Compaction(strip_comments) if compact else None
+    packed = bytearray()
+    for file_path in file_paths:
+        kind, text = SHARD_IN_PARENT, ""
+        header = None
+        if file_path is not None and os.path.getsize(file_path) <= STREAM_THRESHOLD:
+            recovered, skipped = decoding.recovered, decoding.skipped
+            if compaction is not None:
+                read, saved = compaction.bytes_read, compaction.bytes_saved
+            rendered = render_file(
+                file_path,
+                claude_xml,
+                markdown,
+                line_numbers,
+                max_file_size,
+                decoding=decoding,
+                compaction=compaction,
+            )
+            if isinstance(rendered, SkippedFile):
+                kind = (
+                    SHARD_UNDECODABLE if decoding.skipped > skipped else SHARD_SKIPPED
+                )
+                text = rendered.reason
+            else:
+                kind = (
+                    SHARD_RECOVERED
+                    if decoding.recovered > recovered
+                    else SHARD_RENDERED
+                )
+                text = "".join(rendered)
+                if len(rendered) == 3 and isinstance(rendered[1], LicenseHeader):
+                    header = rendered
+        data = text.encode("utf-8", "surrogatepass")
+        packed += SHARD_HEADER.pack(kind, len(data))
+        packed += data
+        if compaction is not None and kind in (SHARD_RENDERED, SHARD_RECOVERED):
+            header_start = header_length = 0
+            key = b""
+            if header is not None:
+                before, license_header, _ = (
+                    part.encode("utf-8", "surrogatepass") for part in header
+                )
+                header_start, header_length = len(before), len(license_header)
+                key = header[1].key.encode("utf-8", "surrogatepass")
+            packed += SHARD_COMPACTION.pack(
+                compaction.bytes_read - read,
+                compaction.bytes_saved - saved,
+                header_start,
+                header_length,
+                len(key),
+            )
+            packed += key
+    return bytes(packed)
+
+
+def unpack_shard(packed, decoding, compaction=None):
+    """
+    Yield the rendered result for each file packed by render_shard(), or None
+    for files left to the parent process
+    """
+    offset = 0
+    while offset < len(packed):
+        kind, length = SHARD_HEADER.unpack_from(packed, offset)
+        offset += SHARD_HEADER.size
+        data = packed[offset : offset + length]
+        text = data.decode("utf-8", "surrogatepass")
+        offset += length
+        if kind == SHARD_IN_PARENT:
+            yield None
+        elif kind in (SHARD_SKIPPED, SHARD_UNDECODABLE):
+            if kind == SHARD_UNDECODABLE:
+                decoding.record(recovered=False)
+            yield SkippedFile(text)
+        else:
+            if kind == SHARD_RECOVERED:
+                decoding.record(recovered=True)
+            if compaction is None:
+                yield [text]
+                continue
+            read, saved, header_start, header_length, key_length = (
+                SHARD_COMPACTION.unpack_from(packed, offset)
+            )
+            offset += SHARD_COMPACTION.size
+            compaction.record(files=1, bytes_read=read, bytes_saved=saved)
+            key = packed[offset : offset + key_length]
+            offset += key_length
+            if not header_length:
+                yield [text]
+                continue
+            end = header_start + header_length
+            yield [
+                data[:header_start].decode("utf-8", "surrogatepass"),
+                LicenseHeader(
+                    data[header_start:end].decode("utf-8", "surrogatepass"),
+                    key.decode("utf-8", "surrogatepass"),
+                ),
+                data[end:].decode("utf-8", "surrogatepass"),
+            ]
+
+
+def render_sharded(
+    executor,
+    file_paths,
+    shard,
+    render,
+    in_parent,
+    decoding,
+    window,
+    compaction=None,
+    lookup=None,
+):
+    """
+    Render file_paths in worker processes, SHARD_SIZE at a time, with at most
+    window shards in flight, and yield (path, result) pairs in order.
+
+    shard is render_shard() with its options bound. Files for which
+    in_parent(path) is true, and any that the workers leave to the parent,
+    are rendered here with render(). If lookup is given, lookup(path)
+    returns (rendered, store) as a cache's lookup() does, or (None, None)
+    to leave the file uncached: files it finds are not sent to the workers,
+    and the others are passed to store() once rendered.
+    """
+
+    def results(batch, cached, future):
+        unpacked = unpack_shard(future.result(), decoding, compaction)
+        for file_path, (rendered, store), result in zip(batch, cached, unpacked):
+            if rendered is not None:
+                yield file_path, rendered
+            elif result is None:
+                yield file_path, render(file_path)
+            else:
+                if store is not None:
+                    store(result)
+                yield file_path, result
+
+    def submit(batch):
+        cached = [
+            (None, None) if lookup is None or in_parent(p) else lookup(p) for p in batch
+        ]
+        worker_paths = [
+            None if in_parent(p) or rendered is not None else p
+            for p, (rendered, _) in zip(batch, cached)
+        ]
+        pending.append((batch, cached, executor.submit(shard, worker_paths)))
+
+    pending = deque()
+    batch = []
+    for file_path in file_paths:
+        batch.append(file_path)
+        if len(batch) < SHARD_SIZE:
+            continue
+        submit(batch)
+        batch = []
+        if len(pending) >= window:
+            yield from results(*pending.popleft())
+    if batch:
+        submit(batch)
+    while pending:
+        yield from results(*pending.popleft())
+
+
 def process_path(
     path,
     extensions,
     include_hidden,
     ignore_files_only,
     ignore_gitignore,
-    gitignore_rules,
+    gitignore_scopes,
     ignore_patterns,
     writer,
     claude_xml,
     markdown,
     line_numbers=False,
+    jobs=1,
+    max_file_size=None,
+    follow_symlinks=False,
+    context=None,
+    candidates=None,
+    use_async=False,
+    processes=1,
+    include_patterns=(),
+    process_pool=None,
 ):
-    if os.path.isfile(path):
+    if context is None:
+        context = RunContext()
+    path_filter = PathFilter(
+        extensions, include_hidden, ignore_patterns, ignore_files_only, include_patterns
+    )
+    if context.listings is not None and candidates is None:
+        file_paths = context.listings.list_files(
+            path, path_filter, ignore_gitignore, gitignore_scopes, follow_symlinks
+        )
+    else:
+        file_paths = iter_file_paths(
+            path,
+            path_filter,
+            ignore_gitignore,
+            gitignore_scopes,
+            follow_symlinks,
+            candidates,
+            context.stats,
+        )
+    if context.stats is not None:
+        file_paths = context.stats.timed_iter("walk", file_paths)
+    if context.manifest is not None:
+        file_paths = (p for p in file_paths if context.manifest.is_changed(p))
+    if context.dedupe is not None:
+        file_paths = context.dedupe.filter(file_paths)
+
+    def render(file_path):
+        return render_file(
+            file_path,
+            claude_xml,
+            markdown,
+            line_numbers,
+            max_file_size,
+            context.stats,
+            context.decoding,
+            context.compaction,
+        )
+
+    lookup = None
+    if context.cache is not None:
+        variant = f"{claude_xml}:{markdown}:{line_numbers}:{context.decoding.key}"
+        if context.compaction is not None:
+            variant += f":{context.compaction.key}"
+        uncached_render = render
+
+        def lookup(file_path):
+            # For --processes. Files that render() streams or skips are left
+            # to it, so that each file is looked up once
+            size = os.path.getsize(file_path)
+            if size > STREAM_THRESHOLD or (
+                max_file_size is not None and size > max_file_size
+            ):
+                return None, None
+            return context.cache.lookup(file_path, variant)
+
+        def render(file_path):
+            if max_file_size is not None and os.path.getsize(file_path) > max_file_size:
+                # Cached entries do not record the size limit they were
+                # rendered under, so check it before looking one up
+                return uncached_render(file_path)
+            return context.cache.get_or_render(
+                file_path, variant, lambda: uncached_render(file_path)
+            )
+
+    if context.dedupe is not None:
+        duplicate_of = context.dedupe.duplicate_of
+        render_content = render
+
+        def render(file_path):
+            if file_path in duplicate_of:
+                return DuplicateFile(
+                    duplicate_of[file_path], lambda: render_content(file_path)
+                )
+            return render_content(file_path)
+
+    if processes > 1:
+        shard = functools.partial(
+            render_shard,
+            claude_xml=claude_xml,
+            markdown=markdown,
+            line_numbers=line_numbers,
+            max_file_size=max_file_size,
+            encoding=context.decoding.encoding,
+            fallback_encodings=context.decoding.fallbacks,
+            compact=context.compaction is not None,
+            strip_comments=context.compaction is not None
+            and context.compaction.comments,
+        )
+        duplicate_of = context.dedupe.duplicate_of if context.dedupe else {}
+        executor = process_pool
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = ProcessPoolExecutor(max_workers=processes)
         try:
-            with open(path, "r") as f:
-                print_path(writer, path, f.read(), claude_xml, markdown, line_numbers)
-        except UnicodeDecodeError:
-            warning_message = f"Warning: Skipping file {path} due to UnicodeDecodeError"
-            click.echo(click.style(warning_message, fg="red"), err=True)
-    elif os.path.isdir(path):
-        for root, dirs, files in os.walk(path):
-            if not include_hidden:
-                dirs[:] = [d for d in dirs if not d.startswith(".")]
-                files = [f for f in files if not f.startswith(".")]
+            for file_path, result in render_sharded(
+                executor,
+                file_paths,
+                shard,
+                render,
+                # Duplicates are written as references without being read
+                duplicate_of.__contains__,
+                context.decoding,
+                window=processes * 2,
+                compaction=context.compaction,
+                lookup=lookup,
+            ):
+                if context.budget is not None and context.budget.exhausted:
+                    return
+                write_rendered(writer, file_path, result, claude_xml, context, markdown)
+        finally:
+            if process_pool is None:
+                executor.shutdown()
+        return
+    if use_async:
+        import asyncio
 
-            if not ignore_gitignore:
-                gitignore_rules.extend(read_gitignore(root))
-                dirs[:] = [
-                    d
-                    for d in dirs
-                    if not should_ignore(os.path.join(root, d), gitignore_rules)
-                ]
-                files = [
-                    f
-                    for f in files
-                    if not should_ignore(os.path.join(root, f), gitignore_rules)
-                ]
-
-            if ignore_patterns:
-                if not ignore_files_only:
-                    dirs[:] = [
-                        d
-                        for d in dirs
-                        if not any(fnmatch(d, pattern) for pattern in ignore_patterns)
-                    ]
-                files = [
-                    f
-                    for f in files
-                    if not any(fnmatch(f, pattern) for pattern in ignore_patterns)
-                ]
-
-            if extensions:
-                files = [f for f in files if f.endswith(extensions)]
-
-            for file in sorted(files):
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, "r") as f:
-                        print_path(
-                            writer,
-                            file_path,
-                            f.read(),
-                            claude_xml,
-                            markdown,
-                            line_numbers,
-                        )
-                except UnicodeDecodeError:
-                    warning_message = (
-                        f"Warning: Skipping file {file_path} due to UnicodeDecodeError"
-                    )
-                    click.echo(click.style(warning_message, fg="red"), err=True)
+        from .pipeline import run_pipeline
 
+        def write(file_path, result):
+            if context.budget is not None and context.budget.exhausted:
+                return False
+            write_rendered(writer, file_path, result, claude_xml, context, markdown)
 
-def read_paths_from_stdin(use_null_separator):
-    if sys.stdin.isatty():
-        # No ready input from stdin, don't block for input
-        return []
+        asyncio.run(run_pipeline(file_paths, render, write, concurrency=jobs))
+        return
+    if jobs <= 1:
+        for file_path in file_paths:
+            if context.budget is not None and context.budget.exhausted:
+                return
+            write_rendered(
+                writer, file_path, render(file_path), claude_xml, context, markdown
+            )
+        return
+    from concurrent.futures import ThreadPoolExecutor
 
-    stdin_content = sys.stdin.read()
-    if use_null_separator:
-        paths = stdin_content.split("\0")
-    else:
-        paths = stdin_content.split()  # split on whitespace
-    return [p for p in paths if p]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for file_path, result in render_in_order(
+            executor, file_paths, render, window=jobs * 4
+        ):
+            if context.budget is not None and context.budget.exhausted:
+                return
+            write_rendered(writer, file_path, result, claude_xml, context, markdown)
 
 
-@click.command()
-@click.argument("paths", nargs=-1, type=click.Path(exists=True))
-@click.option("extensions", "-e", "--extension", multiple=True)
-@click.option(
-    "--include-hidden",
-    is_flag=True,
-    help="Include files and folders starting with .",
-)
-@click.option(
-    "--ignore-files-only",
-    is_flag=True,
-    help="--ignore option only ignores files",
-)
-@click.option(
-    "--ignore-gitignore",
-    is_flag=True,
-    help="Ignore .gitignore files and include all files",
-)
-@click.option(
-    "ignore_patterns",
-    "--ignore",
-    multiple=True,
-    default=[],
-    help="List of patterns to ignore",
-)
-@click.option(
-    "output_file",
-    "-o",
-    "--output",
-    type=click.Path(writable=True),
-    help="Output to a file instead of stdout",
-)
-@click.option(
-    "claude_xml",
-    "-c",
-    "--cxml",
-    is_flag=True,
-    help="Output in XML-ish format suitable for Claude's long context window.",
-)
-@click.option(
-    "markdown",
-    "-m",
-    "--markdown",
-    is_flag=True,
-    help="Output Markdown with fenced code blocks",
-)
-@click.option(
-    "line_numbers",
-    "-n",
-    "--line-numbers",
-    is_flag=True,
-    help="Add line numbers to the output",
-)
-@click.option(
-    "--null",
-    "-0",
-    is_flag=True,
-    help="Use NUL character as separator when reading from stdin",
-)
-@click.version_option()
-def cli(
-    paths,
+def process_archive(
+    path,
     extensions,
     include_hidden,
     ignore_files_only,
-    ignore_gitignore,
     ignore_patterns,
-    output_file,
+    writer,
+    claude_xml,
+    markdown,
+    line_numbers=False,
+    max_file_size=None,
+    context=None,
+    include_patterns=(),
+):
+    """
+    Write the files in the zip or tar archive at path without extracting it,
+    reading one member at a time. Members are written as path/member in the
+    order they are stored, and filtered like the files in a directory,
+    except that .gitignore files in the archive are not applied. Members
+    larger than STREAM_THRESHOLD are streamed in chunks.
+
+    An archive that cannot be read is skipped with a warning, as is a member
+    that cannot be read, such as an encrypted member of a zip file.
+    """
+    if context is None:
+        context = RunContext()
+    stats = context.stats
+    path_filter = PathFilter(
+        extensions, include_hidden, ignore_patterns, ignore_files_only, include_patterns
+    )
+    errors = archive_errors()
+    try:
+        for name, size, open_member in iter_archive(path, STREAM_THRESHOLD):
+            parts = name.split("/")
+            if any(
+                path_filter.skip_dir(part, "/".join(parts[: i + 1]))
+                for i, part in enumerate(parts[:-1])
+            ) or path_filter.skip_file(parts[-1], name):
+                continue
+            if context.budget is not None and context.budget.exhausted:
+                return
+            member_path = f"{path}/{name}"
+            try:
+                rendered = render_member(
+                    member_path,
+                    size,
+                    open_member,
+                    claude_xml,
+                    markdown,
+                    line_numbers,
+                    max_file_size,
+                    context,
+                )
+            except RuntimeError:
+                # What zipfile raises for an encrypted member
+                rendered = SkippedFile("as it is encrypted")
+            except errors as e:
+                rendered = SkippedFile(f"as it could not be read: {e}")
+            write_rendered(writer, member_path, rendered, claude_xml, context, markdown)
+    except errors as e:
+        warn(f"Warning: Skipping archive {path} as it could not be read: {e}")
+        if stats is not None:
+            stats.skip("unreadable archive")
+
+
+def render_member(
+    member_path,
+    size,
+    open_member,
     claude_xml,
     markdown,
     line_numbers,
-    null,
+    max_file_size,
+    context,
+):
+    "Render an archive member, streaming it if it is larger than STREAM_THRESHOLD"
+    if max_file_size is not None and size > max_file_size:
+        return SkippedFile(f"as it is larger than {max_file_size} bytes")
+    if size > STREAM_THRESHOLD:
+        # Counted as it is written
+        return render_stream(
+            member_path,
+            size,
+            open_member,
+            claude_xml,
+            markdown,
+            line_numbers,
+            context.decoding,
+            context.compaction,
+        )
+    with open_member() as f:
+        data = f.read()
+    if context.stats is not None:
+        context.stats.count("bytes_read", size)
+    return render_bytes(
+        member_path,
+        data,
+        claude_xml,
+        markdown,
+        line_numbers,
+        context.decoding,
+        context.compaction,
+    )
+
+
+def process_paths(
+    paths,
+    writer,
+    claude_xml,
+    markdown,
+    line_numbers=False,
+    context=None,
+    extensions=(),
+    include_hidden=False,
+    ignore_files_only=False,
+    ignore_gitignore=False,
+    ignore_patterns=(),
+    include_patterns=(),
+    jobs=1,
+    max_file_size=None,
+    follow_symlinks=False,
+    use_async=False,
+    processes=1,
+    candidates_for=None,
 ):
     """
-    Takes one or more paths to files or directories and outputs every file,
-    recursively, each one preceded with its filename like this:
-
-    \b
-        path/to/file.py
-        ----
-        Contents of file.py goes here
-        ---
-        path/to/file2.py
-        ---
-        ...
-
-    If the `--cxml` flag is provided, the output will be structured as follows:
-
-    \b
-        <documents>
-        <document path="path/to/file1.txt">
-        Contents of file1.txt
-        </document>
-        <document path="path/to/file2.txt">
-        Contents of file2.txt
-        </document>
-        ...
-        </documents>
-
-    If the `--markdown` flag is provided, the output will be structured as follows:
-
-    \b
-        path/to/file1.py
-        ```python
-        Contents of file1.py
-        ```
-    """
-    # Reset global_index for pytest
-    global global_index
-    global_index = 1
-
-    # Read paths from stdin if available
-    stdin_paths = read_paths_from_stdin(use_null_separator=null)
-
-    # Combine paths from arguments and stdin
-    paths = [*paths, *stdin_paths]
-
-    gitignore_rules = []
-    writer = click.echo
-    fp = None
-    if output_file:
-        fp = open(output_file, "w", encoding="utf-8")
-        writer = lambda s: print(s, file=fp)
-    for path in paths:
-        if not os.path.exists(path):
-            raise click.BadArgumentUsage(f"Path does not exist: {path}")
-        if not ignore_gitignore:
-            gitignore_rules.extend(read_gitignore(os.path.dirname(path)))
-        if claude_xml and path == paths[0]:
+    Write every file under paths, which must exist, with process_archive()
+    or process_path(). candidates_for(path) can return the only files to
+    consider for a directory, or None to walk it. The <documents> wrapper
+    for claude_xml is left to the caller. With processes, one pool of
+    worker processes is shared by every path.
+    """
+    if context is None:
+        context = RunContext()
+    process_pool = None
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        process_pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        for path in paths:
+            if is_archive(path):
+                process_archive(
+                    path,
+                    extensions,
+                    include_hidden,
+                    ignore_files_only,
+                    ignore_patterns,
+                    writer,
+                    claude_xml,
+                    markdown,
+                    line_numbers,
+                    max_file_size,
+                    context,
+                    include_patterns,
+                )
+                continue
+            gitignore_scopes = ()
+            if not ignore_gitignore:
+                gitignore_scopes = gitignore_scopes_for(os.path.dirname(path))
+            process_path(
+                path,
+                extensions,
+                include_hidden,
+                ignore_files_only,
+                ignore_gitignore,
+                gitignore_scopes,
+                ignore_patterns,
+                writer,
+                claude_xml,
+                markdown,
+                line_numbers,
+                jobs,
+                max_file_size,
+                follow_symlinks,
+                context,
+                candidates_for(path) if candidates_for is not None else None,
+                use_async,
+                processes,
+                include_patterns,
+                process_pool,
+            )
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+
+def render_paths(paths, output_file=None, claude_xml=False, markdown=False, **options):
+    """
+    Write every file under paths to output_file, or to stdout, as the
+    command line tool would with the given options. options are passed to
+    process_paths().
+    """
+    fp = open(output_file, "wb") if output_file else None
+    writer = OutputWriter(fp) if fp else OutputWriter.for_stdout()
+    try:
+        if claude_xml and paths:
             writer("<documents>")
-        process_path(
-            path,
-            extensions,
-            include_hidden,
-            ignore_files_only,
-            ignore_gitignore,
-            gitignore_rules,
-            ignore_patterns,
-            writer,
+        process_paths(paths, writer, claude_xml, markdown, **options)
+        if claude_xml:
+            writer("</documents>")
+    finally:
+        writer.close()
+        if fp:
+            fp.close()
+
+
+def watch_paths(
+    paths,
+    path_filter,
+    ignore_gitignore,
+    output_file,
+    claude_xml,
+    markdown,
+    line_numbers=False,
+    max_file_size=None,
+    follow_symlinks=False,
+    decoding=None,
+    make_budget=None,
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    stop=None,
+    poll_interval=1.0,
+    compaction=None,
+):
+    """
+    Write the output for paths to output_file, then keep it up to date as
+    files change until interrupted, or until stop (a threading.Event) is set.
+
+    Only changed files are read and rendered again. The rendered result for
+    every other file is kept in a DocumentIndex, so each update rewrites the
+    output from memory, numbering the --cxml documents from 1 again. The
+    output is written to a temporary file that is renamed over output_file.
+    Changes are found with inotify on Linux, falling back to checking every
+    file each poll_interval seconds elsewhere.
+    """
+    from .watch import DocumentIndex, make_watcher, watch_changes
+
+    if decoding is None:
+        decoding = Decoding()
+    output_path = os.path.abspath(output_file)
+    directories = set()
+
+    def list_files():
+        directories.clear()
+        for path in paths:
+            if os.path.isfile(path):
+                directories.add(os.path.dirname(path))
+            gitignore_scopes = ()
+            if not ignore_gitignore:
+                gitignore_scopes = gitignore_scopes_for(os.path.dirname(path))
+            for file_path in iter_file_paths(
+                path,
+                path_filter,
+                ignore_gitignore,
+                gitignore_scopes,
+                follow_symlinks,
+                directories=directories,
+            ):
+                if os.path.abspath(file_path) != output_path:
+                    yield file_path
+
+    def render(file_path):
+        rendered = render_file(
+            file_path,
             claude_xml,
             markdown,
             line_numbers,
+            max_file_size,
+            decoding=decoding,
+            compaction=compaction,
         )
-    if claude_xml:
-        writer("</documents>")
-    if fp:
-        fp.close()
+        if isinstance(rendered, SkippedFile):
+            warn(f"Warning: Skipping file {file_path} {rendered.reason}")
+            return None
+        if (
+            isinstance(rendered, list)
+            and make_budget is None
+            # License headers are left out of all but the first file
+            and not any(isinstance(text, LicenseHeader) for text in rendered)
+        ):
+            # Kept encoded, so that rewriting the output only copies bytes
+            return "".join(rendered).encode("utf-8")
+        return rendered
+
+    def write_documents(fp, items):
+        writer = OutputWriter(fp, buffer_size)
+        budget = make_budget() if make_budget is not None else None
+        context = RunContext(budget=budget, decoding=decoding, compaction=compaction)
+        if claude_xml:
+            writer("<documents>")
+        for file_path, rendered in items:
+            if isinstance(rendered, bytes):
+                if claude_xml:
+                    writer(f'<document index="{context.next_index()}">')
+                writer.write_bytes(rendered)
+            else:
+                write_rendered(
+                    writer, file_path, rendered, claude_xml, context, markdown
+                )
+        if claude_xml:
+            writer("</documents>")
+        writer.close()
+
+    def on_update(count, seconds):
+        echo_err(
+            f"Updated {output_file}: {count} file{'' if count == 1 else 's'} "
+            f"changed in {seconds * 1000:.1f}ms"
+        )
+
+    index = DocumentIndex(list_files, render, claude_xml)
+    index.update()
+    index.write(output_file, write_documents)
+    watcher = make_watcher(directories, [output_file], poll_interval)
+    count = len(index.paths)
+    echo_err(
+        f"Wrote {count} file{'' if count == 1 else 's'} to {output_file}, "
+        "watching for changes"
+    )
+    try:
+        watch_changes(
+            index,
+            watcher,
+            output_file,
+            write_documents,
+            lambda: directories,
+            on_update,
+            stop or threading.Event(),
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+class Document:
+    """
+    A rendered file yielded by iter_documents().
+
+    Large files are streamed, in which case iter_rendered() reads the file
+    as it goes and can only be consumed once. open() decodes the file with
+    the encoding and error handling it was rendered with.
+    """
+
+    def __init__(
+        self,
+        path,
+        index,
+        rendered,
+        claude_xml,
+        encoding="utf-8",
+        errors="strict",
+        license_headers=None,
+    ):
+        self.path = path
+        self.index = index
+        self.encoding = encoding
+        self.errors = errors
+        self._rendered = rendered
+        self._claude_xml = claude_xml
+        # Keys of the license headers already rendered by this run
+        self._license_headers = license_headers
+
+    def __repr__(self):
+        return f"<Document {self.index}: {self.path}>"
+
+    @property
+    def size(self):
+        return os.stat(self.path).st_size
+
+    def open(self):
+        "Open the file as a text stream"
+        return open(self.path, "r", encoding=self.encoding, errors=self.errors)
+
+    @property
+    def content(self):
+        with self.open() as f:
+            return f.read()
+
+    def iter_rendered(self):
+        if self._claude_xml:
+            yield f'<document index="{self.index}">\n'
+        for text in self._rendered:
+            if isinstance(text, FileContents):
+                yield from text.iter_text()
+            elif isinstance(text, LicenseHeader):
+                if self._license_headers is not None:
+                    if text.key in self._license_headers:
+                        continue
+                    self._license_headers.add(text.key)
+                yield str(text)
+            else:
+                yield text
+
+    @property
+    def rendered(self):
+        return "".join(self.iter_rendered())
+
+
+def iter_documents(
+    paths,
+    extensions=(),
+    include_hidden=False,
+    ignore_files_only=False,
+    ignore_gitignore=False,
+    ignore_patterns=(),
+    claude_xml=False,
+    markdown=False,
+    line_numbers=False,
+    max_file_size=None,
+    follow_symlinks=False,
+    jobs=1,
+    on_skip=None,
+    encoding="utf-8",
+    fallback_encodings=(),
+    include_patterns=(),
+    compact=False,
+    strip_comments=False,
+):
+    """
+    Lazily yield a Document for every file under paths, using the file
+    selection, formatting and decoding options of the command line tool.
+
+    Each call keeps its own document numbering, so several can run at once.
+    With compact or strip_comments, a license header is left out of every
+    document rendered after the first one to include it. Files that are skipped
+    are not yielded; pass on_skip(path, reason) to be told about them.
+    Archives are not supported and are skipped. The <documents> wrapper for
+    claude_xml is left to the caller.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    path_filter = PathFilter(
+        extensions, include_hidden, ignore_patterns, ignore_files_only, include_patterns
+    )
+    context = RunContext(
+        decoding=Decoding(encoding, fallback_encodings),
+        compaction=Compaction(strip_comments) if compact or strip_comments else None,
+    )
+
+    def render(file_path):
+        decoded = []
+        result = render_file(
+            file_path,
+            claude_xml,
+            markdown,
+            line_numbers,
+            max_file_size,
+            decoding=context.decoding,
+            compaction=context.compaction,
+            on_decoded=lambda *settings: decoded.extend(settings),
+        )
+        return result, decoded
+
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for path in paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            if is_archive(path):
+                if on_skip is not None:
+                    on_skip(path, "as archives are not supported")
+                continue
+            gitignore_scopes = ()
+            if not ignore_gitignore:
+                gitignore_scopes = gitignore_scopes_for(os.path.dirname(path))
+            file_paths = iter_file_paths(
+                path, path_filter, ignore_gitignore, gitignore_scopes, follow_symlinks
+            )
+            if executor is None:
+                rendered = ((file_path, render(file_path)) for file_path in file_paths)
+            else:
+                rendered = render_in_order(
+                    executor, file_paths, render, window=jobs * 4
+                )
+            for file_path, (result, decoded) in rendered:
+                if isinstance(result, SkippedFile):
+                    if on_skip is not None:
+                        on_skip(file_path, result.reason)
+                    continue
+                yield Document(
+                    file_path,
+                    context.next_index(),
+                    result,
+                    claude_xml,
+                    *decoded,
+                    license_headers=context.license_headers,
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def read_paths_from_stdin(use_null_separator):
+    if sys.stdin.isatty():
+        # No ready input from stdin, don't block for input
+        return []
+
+    stdin_content = sys.stdin.read()
+    if use_null_separator:
+        paths = stdin_content.split("\0")
+    else:
+        paths = stdin_content.split()  # split on whitespace
+    return [p for p in paths if p]
+
+
+def __getattr__(name):
+    # The click command is imported on first use, so that the fast path in
+    # client.main() can render files without importing click
+    if name == "cli":
+        from .command import cli
+
+        return cli
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
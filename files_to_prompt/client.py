@@ -0,0 +1,187 @@
+import io
+import os
+import struct
+import sys
+
+SERVER_VARIABLE = "FILES_TO_PROMPT_SERVER"
+
+# Matches FRAME_HEADER in server.py
+FRAME_HEADER = struct.Struct(">cI")
+
+
+# Options the fast path handles without importing click, by the name of the
+# keyword argument to render_paths(). Any other option, or a path that does
+# not exist, goes through the click command instead.
+FLAGS = {
+    "-c": "claude_xml",
+    "--cxml": "claude_xml",
+    "-m": "markdown",
+    "--markdown": "markdown",
+    "-n": "line_numbers",
+    "--line-numbers": "line_numbers",
+    "--include-hidden": "include_hidden",
+    "--ignore-files-only": "ignore_files_only",
+    "--ignore-gitignore": "ignore_gitignore",
+}
+MULTIPLE = {
+    "-e": "extensions",
+    "--extension": "extensions",
+    "--ignore": "ignore_patterns",
+    "--include": "include_patterns",
+}
+SINGLE = {"-o": "output_file", "--output": "output_file"}
+
+
+def parse_simple_args(args):
+    """
+    Parse a command line that only uses FLAGS, MULTIPLE and SINGLE options
+    and existing paths, returning keyword arguments for render_paths(), or
+    None if the command line needs the click command
+    """
+    options = {"paths": [], "output_file": None}
+    options.update(dict.fromkeys(FLAGS.values(), False))
+    options.update((name, []) for name in MULTIPLE.values())
+    args = iter(args)
+    for arg in args:
+        if arg in FLAGS:
+            options[FLAGS[arg]] = True
+        elif arg in MULTIPLE or arg in SINGLE:
+            value = next(args, None)
+            if value is None:
+                return None
+            if arg in MULTIPLE:
+                options[MULTIPLE[arg]].append(value)
+            else:
+                options[SINGLE[arg]] = value
+        elif arg.startswith("-") or not os.path.exists(arg):
+            return None
+        else:
+            options["paths"].append(arg)
+    return options
+
+
+def run_simple(options):
+    "Run a command line parsed by parse_simple_args(), returning the exit code"
+    from .cli import read_paths_from_stdin, render_paths
+
+    stdin_paths = read_paths_from_stdin(use_null_separator=False)
+    if not all(os.path.exists(path) for path in stdin_paths):
+        # Leave the click command to report the missing path
+        sys.stdin = io.StringIO("\n".join(stdin_paths))
+        return None
+    paths = options.pop("paths") + stdin_paths
+    try:
+        render_paths(paths, **options)
+    except BrokenPipeError:
+        # As click does, exit quietly when the reader of stdout goes away
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except KeyboardInterrupt:
+        sys.stderr.write("\nAborted!\n")
+        return 1
+    return 0
+
+
+def connect(address):
+    """
+    Connect to the server at address, a Unix socket path or an http:// URL,
+    returning a function that sends a request and returns a binary stream of
+    the response frames
+    """
+    import socket
+
+    if address.startswith("http://"):
+        import http.client
+        from urllib.parse import urlsplit
+
+        url = urlsplit(address)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80)
+        connection.connect()
+
+        def send(body):
+            connection.request(
+                "POST",
+                url.path or "/",
+                body,
+                {"Content-Type": "application/json"},
+            )
+            response = connection.getresponse()
+            if response.status != 200:
+                raise ConnectionError(f"Server responded with {response.status}")
+            return response
+
+        return send
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+
+    def send(body):
+        sock.sendall(body + b"\n")
+        return sock.makefile("rb")
+
+    return send
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ConnectionError("Connection to the server closed early")
+    return data
+
+
+def run_remote(send, args):
+    "Send args to the server and copy its output, returning the exit code"
+    import json
+
+    stdin = None if sys.stdin.isatty() else sys.stdin.read()
+    body = json.dumps({"args": args, "cwd": os.getcwd(), "stdin": stdin})
+    stream = send(body.encode("utf-8"))
+    outputs = {b"o": sys.stdout.buffer, b"e": sys.stderr.buffer}
+    while True:
+        kind, length = FRAME_HEADER.unpack(read_exactly(stream, FRAME_HEADER.size))
+        payload = read_exactly(stream, length)
+        if kind == b"x":
+            sys.stdout.buffer.flush()
+            return int(payload)
+        outputs[kind].write(payload)
+        if kind == b"e":
+            sys.stderr.buffer.flush()
+
+
+def main():
+    """
+    The files-to-prompt command. Runs "files-to-prompt serve", or sends the
+    command line to a running server if FILES_TO_PROMPT_SERVER is set, or
+    runs the command in this process - without importing click, if it only
+    uses the options in FLAGS, MULTIPLE and SINGLE.
+    """
+    args = sys.argv[1:]
+    if args[:1] == ["serve"] and not os.path.exists("serve"):
+        from .server import serve
+
+        serve.main(args[1:], prog_name="files-to-prompt serve")
+        return
+    address = os.environ.get(SERVER_VARIABLE)
+    if address:
+        try:
+            send = connect(address)
+        except OSError:
+            # No server running, so run the command here instead
+            pass
+        else:
+            try:
+                sys.exit(run_remote(send, args))
+            except ConnectionError as e:
+                sys.stderr.write(f"Error: {e}\n")
+                sys.exit(1)
+    options = parse_simple_args(args)
+    if options is not None:
+        exit_code = run_simple(options)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    from .cli import cli
+
+    cli()
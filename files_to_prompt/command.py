@@ -0,0 +1,472 @@
+import json
+import os
+
+import click
+
+from .archives import is_archive
+from .cli import (
+    RunContext,
+    print_deleted,
+    process_paths,
+    read_paths_from_stdin,
+    watch_paths,
+)
+from .compact import Compaction
+from .encoding import Decoding, validate_encoding
+from .filters import PathFilter
+from .output import DEFAULT_BUFFER_SIZE, OutputWriter
+from .stats import Stats
+from .tokens import TOKENIZERS, TokenBudget
+
+
+@click.command()
+@click.argument("paths", nargs=-1, type=click.Path(exists=True))
+@click.option("extensions", "-e", "--extension", multiple=True)
+@click.option(
+    "--include-hidden",
+    is_flag=True,
+    help="Include files and folders starting with .",
+)
+@click.option(
+    "--ignore-files-only",
+    is_flag=True,
+    help="--ignore option only ignores files",
+)
+@click.option(
+    "--ignore-gitignore",
+    is_flag=True,
+    help="Ignore .gitignore files and include all files",
+)
+@click.option(
+    "ignore_patterns",
+    "--ignore",
+    multiple=True,
+    default=[],
+    help="List of patterns to ignore",
+)
+@click.option(
+    "include_patterns",
+    "--include",
+    multiple=True,
+    help="Only include files matching these patterns",
+)
+@click.option(
+    "output_file",
+    "-o",
+    "--output",
+    type=click.Path(writable=True),
+    help="Output to a file instead of stdout",
+)
+@click.option(
+    "claude_xml",
+    "-c",
+    "--cxml",
+    is_flag=True,
+    help="Output in XML-ish format suitable for Claude's long context window.",
+)
+@click.option(
+    "markdown",
+    "-m",
+    "--markdown",
+    is_flag=True,
+    help="Output Markdown with fenced code blocks",
+)
+@click.option(
+    "line_numbers",
+    "-n",
+    "--line-numbers",
+    is_flag=True,
+    help="Add line numbers to the output",
+)
+@click.option(
+    "use_git",
+    "--git",
+    is_flag=True,
+    help="List files with git ls-files instead of walking directories",
+)
+@click.option(
+    "--include-untracked",
+    is_flag=True,
+    help="With --git, also include untracked files that are not ignored",
+)
+@click.option(
+    "--since",
+    metavar="REF",
+    help="Only include files that differ from this git ref, or are untracked",
+)
+@click.option(
+    "manifest_path",
+    "--manifest",
+    type=click.Path(dir_okay=False),
+    help="Only include files added or modified since the run that wrote this "
+    "manifest file, and list deleted files",
+)
+@click.option(
+    "--follow-symlinks",
+    is_flag=True,
+    help="Follow symlinks to directories, visiting each directory once",
+)
+@click.option(
+    "max_file_size",
+    "--max-file-size",
+    type=click.IntRange(min=0),
+    help="Skip files larger than this many bytes",
+)
+@click.option(
+    "--encoding",
+    default="utf-8",
+    show_default=True,
+    callback=validate_encoding,
+    help="Decode files with this encoding, unless they start with a byte order mark",
+)
+@click.option(
+    "fallback_encodings",
+    "--fallback-encoding",
+    multiple=True,
+    callback=validate_encoding,
+    help="Encoding to try for files that do not decode, such as cp1252 - can be "
+    "used multiple times. Use 'replace' to replace undecodable bytes instead",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Strip trailing whitespace, collapse runs of blank lines and output "
+    "repeated license headers once",
+)
+@click.option(
+    "--strip-comments",
+    is_flag=True,
+    help="Remove comments, and Python docstrings, from source code - implies "
+    "--compact",
+)
+@click.option(
+    "--dedupe",
+    is_flag=True,
+    help="Output files with the same content once, and visit each path only once",
+)
+@click.option(
+    "max_tokens",
+    "--max-tokens",
+    type=click.IntRange(min=0),
+    help="Skip files that would take the estimated token count over this budget",
+)
+@click.option(
+    "--stop-at-max-tokens",
+    is_flag=True,
+    help="Stop at the first file that does not fit in --max-tokens",
+)
+@click.option(
+    "--tokenizer",
+    type=click.Choice(list(TOKENIZERS)),
+    default="heuristic",
+    show_default=True,
+    help="How to estimate tokens for --max-tokens",
+)
+@click.option(
+    "cache_dir",
+    "--cache-dir",
+    type=click.Path(file_okay=False, writable=True),
+    help="Cache rendered files in this directory to speed up repeat runs",
+)
+@click.option(
+    "cache_size",
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=256,
+    show_default=True,
+    help="Maximum size of the --cache-dir cache in MB",
+)
+@click.option(
+    "jobs",
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Read and render files using this many threads",
+)
+@click.option(
+    "use_async",
+    "--async",
+    is_flag=True,
+    help="Walk directories and read files concurrently in an asyncio pipeline, "
+    "with up to --jobs files being read at once",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Render files in this many worker processes",
+)
+@click.option(
+    "buffer_size",
+    "--buffer-size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_BUFFER_SIZE,
+    show_default=True,
+    help="Buffer this many bytes of output between writes",
+)
+@click.option(
+    "--stats",
+    is_flag=True,
+    help="Print counts and per-phase timings for the run to stderr",
+)
+@click.option(
+    "stats_json",
+    "--stats-json",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Save counts and per-phase timings for the run as JSON to this file",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="After writing --output, keep it up to date as files change",
+)
+@click.option(
+    "--null",
+    "-0",
+    is_flag=True,
+    help="Use NUL character as separator when reading from stdin",
+)
+@click.version_option()
+def cli(
+    paths,
+    extensions,
+    include_hidden,
+    ignore_files_only,
+    ignore_gitignore,
+    ignore_patterns,
+    include_patterns,
+    output_file,
+    claude_xml,
+    markdown,
+    line_numbers,
+    use_git,
+    include_untracked,
+    since,
+    manifest_path,
+    follow_symlinks,
+    max_file_size,
+    encoding,
+    fallback_encodings,
+    compact,
+    strip_comments,
+    dedupe,
+    max_tokens,
+    stop_at_max_tokens,
+    tokenizer,
+    cache_dir,
+    cache_size,
+    jobs,
+    use_async,
+    processes,
+    buffer_size,
+    stats,
+    stats_json,
+    watch,
+    null,
+):
+    """
+    Takes one or more paths to files, directories or zip and tar archives and
+    outputs every file, recursively, each one preceded with its filename like
+    this:
+
+    \b
+        path/to/file.py
+        ----
+        Contents of file.py goes here
+        ---
+        path/to/file2.py
+        ---
+        ...
+
+    If the `--cxml` flag is provided, the output will be structured as follows:
+
+    \b
+        <documents>
+        <document path="path/to/file1.txt">
+        Contents of file1.txt
+        </document>
+        <document path="path/to/file2.txt">
+        Contents of file2.txt
+        </document>
+        ...
+        </documents>
+
+    If the `--markdown` flag is provided, the output will be structured as follows:
+
+    \b
+        path/to/file1.py
+        ```python
+        Contents of file1.py
+        ```
+    """
+    if use_git:
+        # git has already applied .gitignore, and tracked files are included
+        ignore_gitignore = True
+
+    # Read paths from stdin if available
+    stdin_paths = read_paths_from_stdin(use_null_separator=null)
+
+    # Combine paths from arguments and stdin
+    paths = [*paths, *stdin_paths]
+    for path in paths:
+        if not os.path.exists(path):
+            raise click.BadArgumentUsage(f"Path does not exist: {path}")
+
+    # Set by "files-to-prompt serve" to keep files warm between requests
+    warm = click.get_current_context().obj
+
+    compaction = Compaction(strip_comments) if compact or strip_comments else None
+
+    def make_budget():
+        return TokenBudget(max_tokens, TOKENIZERS[tokenizer](), stop=stop_at_max_tokens)
+
+    if watch:
+        if not output_file:
+            raise click.UsageError("--watch requires --output")
+        if warm is not None:
+            raise click.UsageError("--watch cannot be used with files-to-prompt serve")
+        if use_git or since or manifest_path or dedupe:
+            raise click.UsageError(
+                "--watch cannot be used with --git, --since, --manifest or --dedupe"
+            )
+        for path in paths:
+            if is_archive(path):
+                raise click.BadArgumentUsage(f"--watch cannot watch archives: {path}")
+        watch_paths(
+            paths,
+            PathFilter(
+                extensions,
+                include_hidden,
+                ignore_patterns,
+                ignore_files_only,
+                include_patterns,
+            ),
+            ignore_gitignore,
+            output_file,
+            claude_xml,
+            markdown,
+            line_numbers,
+            max_file_size,
+            follow_symlinks,
+            Decoding(encoding, fallback_encodings),
+            make_budget if max_tokens is not None else None,
+            buffer_size,
+            compaction=compaction,
+        )
+        return
+
+    def candidates_for(path):
+        if not (use_git or since):
+            return None
+        from .changes import git_changed_files, git_ls_files
+
+        candidates = None
+        if use_git:
+            candidates = git_ls_files(path, include_untracked)
+        if since:
+            changed = git_changed_files(path, since)
+            candidates = changed if candidates is None else candidates & changed
+        return candidates
+
+    budget = make_budget() if max_tokens is not None else None
+    cache = None
+    if cache_dir:
+        from .cache import RenderCache
+
+        cache = RenderCache(cache_dir, cache_size * 1024 * 1024)
+    manifest = None
+    if manifest_path:
+        from .changes import Manifest
+
+        manifest = Manifest(manifest_path)
+    deduplicator = None
+    if dedupe:
+        from .dedupe import Deduplicator
+
+        deduplicator = Deduplicator()
+    run_stats = Stats() if stats or stats_json else None
+    decoding = Decoding(encoding, fallback_encodings)
+    context = RunContext(
+        cache,
+        budget,
+        manifest,
+        deduplicator,
+        run_stats,
+        decoding,
+        compaction=compaction,
+    )
+    if warm is not None:
+        if cache is None:
+            context.cache = warm.cache
+        if run_stats is None:
+            # Walking again keeps the --stats counts complete
+            context.listings = warm.listings
+    fp = None
+    if output_file:
+        fp = open(output_file, "wb")
+        output = OutputWriter(fp, buffer_size)
+    else:
+        output = OutputWriter.for_stdout(buffer_size)
+    writer = output
+    if run_stats:
+        writer = run_stats.timed("write", output)
+        writer.write_file = run_stats.timed("write", output.write_file)
+    try:
+        if claude_xml and paths:
+            writer("<documents>")
+        process_paths(
+            paths,
+            writer,
+            claude_xml,
+            markdown,
+            line_numbers,
+            context,
+            extensions,
+            include_hidden,
+            ignore_files_only,
+            ignore_gitignore,
+            ignore_patterns,
+            include_patterns,
+            jobs,
+            max_file_size,
+            follow_symlinks,
+            use_async,
+            processes,
+            candidates_for,
+        )
+        # --stop-at-max-tokens can end the run before every file was seen
+        complete = budget is None or not budget.exhausted
+        if manifest and complete:
+            for deleted_path in manifest.deleted():
+                print_deleted(writer, deleted_path, claude_xml, markdown, context)
+        if claude_xml:
+            writer("</documents>")
+        if manifest:
+            manifest.save(complete)
+    finally:
+        if run_stats:
+            run_stats.timed("write", output.close)()
+        else:
+            output.close()
+        if fp:
+            fp.close()
+        if cache:
+            cache.close()
+    if cache:
+        click.echo(f"Cache: {cache.hits} hits, {cache.misses} misses", err=True)
+    if deduplicator:
+        click.echo(deduplicator.summary(), err=True)
+    if fallback_encodings:
+        click.echo(decoding.summary(), err=True)
+    if compaction:
+        click.echo(compaction.summary(), err=True)
+    if budget:
+        click.echo(budget.summary(), err=True)
+    if run_stats:
+        run_stats.finish(output.bytes_written)
+        if stats:
+            click.echo(run_stats.report(), err=True)
+        if stats_json:
+            with open(stats_json, "w") as f:
+                json.dump(run_stats.as_dict(), f, indent=2)
@@ -0,0 +1,621 @@
+import io
+import re
+import threading
+from collections import deque
+
+# A leading comment block is a license header if it matches this
+LICENSE_WORDS = re.compile(r"copyright|licen[cs]e|spdx-license-identifier", re.I)
+
+# Longer leading comment blocks are not treated as license headers
+MAX_HEADER_LINES = 200
+
+# Comment syntax for finding license headers, by language in EXT_TO_LANG
+LINE_COMMENTS = {
+    "python": "#",
+    "bash": "#",
+    "ruby": "#",
+    "yaml": "#",
+    "c": "//",
+    "cpp": "//",
+    "java": "//",
+    "javascript": "//",
+    "typescript": "//",
+}
+BLOCK_COMMENTS = {
+    "c": ("/*", "*/"),
+    "cpp": ("/*", "*/"),
+    "java": ("/*", "*/"),
+    "javascript": ("/*", "*/"),
+    "typescript": ("/*", "*/"),
+    "css": ("/*", "*/"),
+    "html": ("<!--", "-->"),
+    "xml": ("<!--", "-->"),
+}
+
+# Tokens after which a / in JavaScript starts a regular expression literal
+REGEX_AFTER = set("(,=:[!&|?{};+-*%<>~^")
+REGEX_AFTER_WORDS = {
+    "return",
+    "typeof",
+    "instanceof",
+    "in",
+    "of",
+    "new",
+    "delete",
+    "void",
+    "throw",
+    "case",
+    "do",
+    "else",
+    "yield",
+    "await",
+}
+WORD = re.compile(r"[\w$]+")
+
+# The start of a tag, declaration or processing instruction in markup, with
+# the name of an opening tag
+MARKUP_TAG = re.compile(r"<(?:([A-Za-z][^\s/>]*)|/|!|\?)")
+CDATA_END = re.compile(re.escape("]]>"))
+# Elements whose contents are not markup, and what ends them
+RAW_TEXT_END = {
+    name: re.compile(rf"</{name}(?![^\s/>])", re.I) for name in ("script", "style")
+}
+
+
+class LicenseHeader(str):
+    """
+    The license header at the start of a file, as it appears in the rendered
+    output, so that write_rendered() can leave out headers it has already
+    written. key is the header's text without line numbers or indentation.
+    """
+
+    def __new__(cls, text, key):
+        header = super().__new__(cls, text)
+        header.key = key
+        return header
+
+
+def iter_lines(chunks):
+    "Split an iterable of strings into lines, each ending in \\n but the last"
+    carry = ""
+    for chunk in chunks:
+        lines = (carry + chunk).split("\n")
+        carry = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if carry:
+        yield carry
+
+
+def removed(text, saved):
+    "Add the size of text, which is being left out, to saved"
+    if text:
+        saved[0] += len(text.encode("utf-8", "surrogatepass"))
+
+
+def squeeze_whitespace(lines, saved):
+    """
+    Remove trailing whitespace, collapse runs of blank lines to a single
+    blank line, and drop blank lines at the start and end
+    """
+    started = False
+    pending_blank = False
+    for line in lines:
+        newline = "\n" if line.endswith("\n") else ""
+        body = line[: len(line) - len(newline)]
+        stripped = body.rstrip()
+        removed(body[len(stripped) :], saved)
+        if not stripped:
+            if started and not pending_blank and newline:
+                pending_blank = True
+            else:
+                removed(newline, saved)
+            continue
+        if pending_blank:
+            yield "\n"
+            pending_blank = False
+        started = True
+        yield stripped + newline
+    if pending_blank:
+        removed("\n", saved)
+
+
+def mark_license_header(lines, lang):
+    """
+    Yield lines, except that a comment block at the start of the file (after
+    any #! line) that mentions a copyright or license is yielded as a single
+    LicenseHeader
+    """
+    line_comment = LINE_COMMENTS.get(lang)
+    block_comment = BLOCK_COMMENTS.get(lang)
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is not None and first.startswith("#!"):
+        yield first
+        first = next(lines, None)
+    if first is None:
+        return
+    header = [first]
+    rest = []
+    start = first.strip()
+    is_comment = False
+    if block_comment and start.startswith(block_comment[0]):
+        opening, closing = block_comment
+        closed = closing in start[len(opening) :]
+        while not closed and len(header) < MAX_HEADER_LINES:
+            line = next(lines, None)
+            if line is None:
+                break
+            header.append(line)
+            closed = closing in line
+        is_comment = closed and header[-1].rstrip().endswith(closing)
+    elif line_comment and start.startswith(line_comment):
+        for line in lines:
+            if not line.lstrip().startswith(line_comment):
+                rest.append(line)
+                break
+            header.append(line)
+            if len(header) == MAX_HEADER_LINES:
+                break
+        is_comment = len(header) < MAX_HEADER_LINES
+    text = "".join(header)
+    if is_comment and LICENSE_WORDS.search(text):
+        key = "\n".join(line.strip() for line in header)
+        yield LicenseHeader(text, key)
+    else:
+        yield from header
+    yield from rest
+    yield from lines
+
+
+def cut_line(line, cuts, saved):
+    """
+    Remove the (start, end, replacement) column ranges in cuts from line,
+    where an end of None is the end of the line. Returns the line, or None
+    if nothing but whitespace is left.
+    """
+    newline = "\n" if line.endswith("\n") else ""
+    body = line[: len(line) - len(newline)]
+    pieces = []
+    position = 0
+    for start, end, replacement in sorted(cuts, key=lambda cut: cut[0]):
+        pieces.append(body[position:start])
+        pieces.append(replacement)
+        position = len(body) if end is None else end
+    pieces.append(body[position:])
+    result = "".join(pieces)
+    if not result.strip():
+        removed(line, saved)
+        return None
+    saved[0] += len(body.encode("utf-8", "surrogatepass")) - len(
+        result.encode("utf-8", "surrogatepass")
+    )
+    return result + newline
+
+
+def strip_python(lines, saved):
+    """
+    Remove comments and docstrings from Python source with tokenize, keeping
+    a #! line. A docstring that is the only statement in its block is
+    replaced with "...". If the tokenizer fails, the rest of the file is
+    left as it is.
+    """
+    import tokenize
+
+    lines = iter(lines)
+    # Lines read by the tokenizer and not yet yielded, with their numbers
+    buffered = deque()
+    cuts = {}
+    row = 0
+
+    def readline():
+        nonlocal row
+        line = next(lines, "")
+        if line:
+            row += 1
+            buffered.append((row, line))
+        return line
+
+    def cut(start, end, replacement=""):
+        (start_row, start_col), (end_row, end_col) = start, end
+        if start_row == end_row:
+            cuts.setdefault(start_row, []).append((start_col, end_col, replacement))
+            return
+        cuts.setdefault(start_row, []).append((start_col, None, replacement))
+        for middle in range(start_row + 1, end_row):
+            cuts.setdefault(middle, []).append((0, None, ""))
+        cuts.setdefault(end_row, []).append((0, end_col, ""))
+
+    def flush(before_row):
+        while buffered and buffered[0][0] < before_row:
+            number, line = buffered.popleft()
+            if number in cuts:
+                line = cut_line(line, cuts.pop(number), saved)
+            if line is not None:
+                yield line
+
+    skip = {tokenize.NL, tokenize.COMMENT, tokenize.ENCODING}
+    expect_docstring = True
+    in_block = False
+    # A docstring waiting for the token after it to be read
+    docstring = None
+    after_docstring = False
+    try:
+        for token in tokenize.generate_tokens(readline):
+            kind = token.type
+            if kind == tokenize.COMMENT and not (
+                token.start == (1, 0) and token.string.startswith("#!")
+            ):
+                cut(token.start, (token.start[0], None))
+            if docstring is not None:
+                if kind in skip:
+                    pass
+                elif after_docstring:
+                    empty = kind in (tokenize.DEDENT, tokenize.ENDMARKER)
+                    start, end, block = docstring
+                    cut(start, end, "..." if empty and block else "")
+                    docstring = None
+                elif kind == tokenize.NEWLINE:
+                    after_docstring = True
+                else:
+                    # Not a docstring on its own, such as "..." + x
+                    docstring = None
+            if kind == tokenize.INDENT:
+                expect_docstring = True
+                in_block = True
+            elif kind == tokenize.STRING and expect_docstring:
+                docstring = (token.start, token.end, in_block)
+                after_docstring = False
+                expect_docstring = False
+            elif kind not in skip and kind != tokenize.DEDENT:
+                expect_docstring = False
+            limit = token.start[0] if docstring is None else docstring[0][0]
+            if buffered and buffered[0][0] < limit:
+                yield from flush(limit)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    yield from flush(row + 1)
+    yield from lines
+
+
+def strip_comments(
+    lines, saved, opening, closing, line_comment=None, quotes="", javascript=False
+):
+    """
+    Remove opening ... closing comments, and line_comment to the end of the
+    line if given, skipping over string literals delimited by quotes. With
+    javascript=True, template literals and regular expression literals are
+    skipped over too.
+    """
+    in_comment = False
+    # Brace depth within each ${ } of the template literals being read
+    templates = []
+    in_template = False
+    last = None
+    for line in lines:
+        newline = "\n" if line.endswith("\n") else ""
+        body = line[: len(line) - len(newline)]
+        pieces = []
+        position = 0
+        index = 0
+        changed = in_comment
+        # Strings end with the line, unless they are template literals
+        quote = None
+        while index < len(body):
+            char = body[index]
+            if in_comment:
+                end = body.find(closing, index)
+                if end == -1:
+                    index = position = len(body)
+                    break
+                index = position = end + len(closing)
+                in_comment = False
+                if pieces and WORD.match(pieces[-1][-1:]) and WORD.match(body, index):
+                    # Keep words on either side of the comment apart
+                    pieces.append(" ")
+                continue
+            if in_template or quote:
+                if char == "\\":
+                    index += 2
+                    continue
+                if in_template and body.startswith("${", index):
+                    in_template = False
+                    templates.append(0)
+                    last = "{"
+                    index += 2
+                    continue
+                if char == ("`" if in_template else quote):
+                    in_template = False
+                    quote = None
+                    last = ")"
+                index += 1
+                continue
+            if char in quotes:
+                quote = char
+            elif javascript and char == "`":
+                in_template = True
+            elif body.startswith(opening, index):
+                pieces.append(body[position:index])
+                in_comment = changed = True
+                index += len(opening)
+                continue
+            elif line_comment is not None and body.startswith(line_comment, index):
+                pieces.append(body[position:index])
+                position = len(body)
+                changed = True
+                break
+            elif not javascript:
+                pass
+            elif char == "/" and (last is None or last in REGEX_AFTER):
+                end = regex_end(body, index)
+                if end is not None:
+                    index = end
+                    last = ")"
+                    continue
+            elif char == "{" and templates:
+                templates[-1] += 1
+            elif char == "}" and templates:
+                if templates[-1] == 0:
+                    templates.pop()
+                    in_template = True
+                    index += 1
+                    continue
+                templates[-1] -= 1
+            if javascript and not char.isspace():
+                # Remember enough of the last token to tell a regular
+                # expression literal from a division
+                match = WORD.match(body, index)
+                if match:
+                    last = "(" if match.group() in REGEX_AFTER_WORDS else ")"
+                    index = match.end()
+                    continue
+                last = char
+            index += 1
+        if not in_comment:
+            pieces.append(body[position:])
+        if not changed:
+            yield line
+            continue
+        yield from rebuild_line(line, pieces, saved)
+
+
+def rebuild_line(line, pieces, saved):
+    """
+    Yield line with only the pieces of it that were kept, unless that
+    leaves it blank
+    """
+    newline = "\n" if line.endswith("\n") else ""
+    body = line[: len(line) - len(newline)]
+    result = "".join(pieces)
+    if not result.strip():
+        removed(line, saved)
+        return
+    saved[0] += len(body.encode("utf-8", "surrogatepass")) - len(
+        result.encode("utf-8", "surrogatepass")
+    )
+    yield result + newline
+
+
+def regex_end(body, start):
+    "The end of the regular expression literal at start, or None"
+    index = start + 1
+    in_class = False
+    while index < len(body):
+        char = body[index]
+        if char == "\\":
+            index += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+        elif char == "/":
+            return index + 1
+        index += 1
+    return None
+
+
+def strip_c_like(lines, saved):
+    return strip_comments(lines, saved, "/*", "*/", "//", quotes="\"'")
+
+
+def strip_javascript(lines, saved):
+    return strip_comments(lines, saved, "/*", "*/", "//", quotes="\"'", javascript=True)
+
+
+def strip_css(lines, saved):
+    return strip_comments(lines, saved, "/*", "*/", quotes="\"'")
+
+
+def strip_markup(lines, saved):
+    """
+    Remove <!-- ... --> comments from HTML or XML. Comments can only start
+    in text, so tags, whose quoted attribute values may contain "<!--",
+    CDATA sections and the contents of <script> and <style> elements are
+    skipped over.
+    """
+    in_comment = False
+    in_tag = False
+    # The quote around the attribute value being read, in a tag
+    quote = None
+    # The name of the tag being read, if it is an opening tag
+    tag_name = None
+    # What ends the CDATA section, script or style being skipped over
+    raw_end = None
+    for line in lines:
+        body = line[:-1] if line.endswith("\n") else line
+        pieces = []
+        position = 0
+        index = 0
+        changed = in_comment
+        while index < len(body):
+            if in_comment:
+                end = body.find("-->", index)
+                if end == -1:
+                    index = position = len(body)
+                    break
+                index = position = end + 3
+                in_comment = False
+                continue
+            if raw_end is not None:
+                match = raw_end.search(body, index)
+                if match is None:
+                    break
+                # The closing tag of a script or style is read as a tag
+                index = match.start() if raw_end is not CDATA_END else match.end()
+                raw_end = None
+                continue
+            if in_tag:
+                char = body[index]
+                if quote:
+                    if char == quote:
+                        quote = None
+                elif char in "\"'":
+                    quote = char
+                elif char == ">":
+                    in_tag = False
+                    if tag_name in RAW_TEXT_END and body[index - 1] != "/":
+                        raw_end = RAW_TEXT_END[tag_name]
+                index += 1
+                continue
+            index = body.find("<", index)
+            if index == -1:
+                break
+            if body.startswith("<!--", index):
+                pieces.append(body[position:index])
+                in_comment = changed = True
+                index += 4
+            elif body.startswith("<![CDATA[", index):
+                raw_end = CDATA_END
+                index += 9
+            else:
+                match = MARKUP_TAG.match(body, index)
+                if match is None:
+                    index += 1
+                    continue
+                in_tag = True
+                tag_name = match.group(1)
+                tag_name = tag_name.lower() if tag_name else None
+                index = match.end()
+        if not in_comment:
+            pieces.append(body[position:])
+        if not changed:
+            yield line
+            continue
+        yield from rebuild_line(line, pieces, saved)
+
+
+# Languages in EXT_TO_LANG that --strip-comments supports. The others have
+# no comments (JSON) or need a full parser to find them reliably, such as
+# heredocs in shell scripts and Ruby or block scalars in YAML.
+COMMENT_STRIPPERS = {
+    "python": strip_python,
+    "c": strip_c_like,
+    "cpp": strip_c_like,
+    "java": strip_c_like,
+    "javascript": strip_javascript,
+    "typescript": strip_javascript,
+    "css": strip_css,
+    "html": strip_markup,
+    "xml": strip_markup,
+}
+
+
+class Compaction:
+    """
+    Makes file contents smaller before they are formatted, for --compact:
+    trailing whitespace is removed, runs of blank lines are collapsed to
+    one, and a license header at the start of a file is marked with
+    LicenseHeader so that write_rendered() can write each header only once.
+
+    With comments=True, for --strip-comments, comments are also removed from
+    the languages in COMMENT_STRIPPERS, along with Python docstrings. Lines
+    left empty by removing a comment are dropped.
+
+    Each file is compacted in a single pass over its lines, as they are read.
+    Counts the bytes read and the bytes left out.
+    """
+
+    def __init__(self, comments=False):
+        self.comments = comments
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        "Identifies these settings, for caching rendered files"
+        return "compact+comments" if self.comments else "compact"
+
+    def record(self, files=0, bytes_read=0, bytes_saved=0):
+        with self._lock:
+            self.files += files
+            self.bytes_read += bytes_read
+            self.bytes_saved += bytes_saved
+
+    def iter_lines(self, lines, lang):
+        """
+        Compact lines, each ending in \\n but the last, from a file in lang,
+        the language from EXT_TO_LANG or None. A license header is yielded
+        as one LicenseHeader holding all of its lines.
+        """
+        saved = [0]
+        try:
+            strip = COMMENT_STRIPPERS.get(lang) if self.comments else None
+            if strip is not None:
+                lines = strip(lines, saved)
+            lines = squeeze_whitespace(lines, saved)
+            if strip is None:
+                lines = mark_license_header(lines, lang)
+            yield from lines
+        finally:
+            self.record(bytes_saved=saved[0])
+
+    def compact(self, content, lang):
+        """
+        Compact the decoded content of a file, returning the new content, the
+        LicenseHeader in it or None, and the number of lines before the header
+        """
+        lines = []
+        header = None
+        header_line = 0
+        for line in self.iter_lines(io.StringIO(content, newline="\n"), lang):
+            if isinstance(line, LicenseHeader):
+                header = line
+                header_line = len(lines)
+            lines.append(line)
+        return "".join(lines), header, header_line
+
+    def iter_chunks(self, chunks, lang, chunk_size):
+        """
+        Compact a file read as chunks of text, yielding chunks of about
+        chunk_size characters that end on line boundaries, with any license
+        header as a separate LicenseHeader
+        """
+        batch = []
+        size = 0
+        for line in self.iter_lines(iter_lines(chunks), lang):
+            if isinstance(line, LicenseHeader):
+                if batch:
+                    yield "".join(batch)
+                    batch = []
+                    size = 0
+                yield line
+                continue
+            batch.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield "".join(batch)
+                batch = []
+                size = 0
+        if batch:
+            yield "".join(batch)
+
+    def summary(self):
+        percent = self.bytes_saved * 100 / self.bytes_read if self.bytes_read else 0
+        return (
+            f"Compaction: {self.bytes_saved:,} of {self.bytes_read:,} bytes saved "
+            f"({percent:.1f}%) in {self.files} file{'' if self.files == 1 else 's'}"
+        )
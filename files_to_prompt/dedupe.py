@@ -0,0 +1,67 @@
+import os
+
+from .changes import hash_file
+
+
+class Deduplicator:
+    """
+    Tracks the files seen in a run so that each file is visited only once,
+    even when path arguments overlap, and so that files with the same content
+    as an earlier file can be written as a reference to it.
+
+    A file is only hashed once another file of the same size has been seen,
+    so a run without duplicates hashes very little. Empty files are never
+    treated as duplicates.
+    """
+
+    def __init__(self):
+        self.visited = set()
+        self.repeated_paths = 0
+        self.duplicate_of = {}
+        self.written = {}
+        self._unhashed_by_size = {}
+        self._by_hash = {}
+
+    def filter(self, file_paths):
+        """
+        Yield the paths that have not been visited before, recording in
+        duplicate_of the earlier path for any with duplicate content.
+        """
+        for file_path in file_paths:
+            key = os.path.abspath(file_path)
+            if key in self.visited:
+                self.repeated_paths += 1
+                continue
+            self.visited.add(key)
+            original = self.find_original(file_path)
+            if original is not None:
+                self.duplicate_of[file_path] = original
+            yield file_path
+
+    def find_original(self, file_path):
+        "Return the first path seen with the same content, or None"
+        try:
+            size = os.stat(file_path).st_size
+        except OSError:
+            return None
+        if not size:
+            return None
+        if size not in self._unhashed_by_size:
+            self._unhashed_by_size[size] = file_path
+            return None
+        unhashed = self._unhashed_by_size[size]
+        if unhashed is not None:
+            self._by_hash.setdefault(hash_file(unhashed), unhashed)
+            self._unhashed_by_size[size] = None
+        original = self._by_hash.setdefault(hash_file(file_path), file_path)
+        return None if original == file_path else original
+
+    def record_written(self, file_path, index):
+        self.written[file_path] = index
+
+    def summary(self):
+        duplicates = len(self.duplicate_of)
+        return (
+            f"Dedupe: {duplicates} duplicate file{'' if duplicates == 1 else 's'}, "
+            f"{self.repeated_paths} repeated path{'' if self.repeated_paths == 1 else 's'}"
+        )
@@ -0,0 +1,108 @@
+import codecs
+import threading
+
+# Checked in order, as the UTF-32 LE byte order mark starts with UTF-16 LE's
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# A fallback that decodes with the main encoding, replacing invalid bytes
+REPLACE = "replace"
+
+
+def detect_bom(prefix):
+    "Return the encoding given by a byte order mark at the start of prefix"
+    for bom, encoding in BOMS:
+        if prefix.startswith(bom):
+            return encoding
+    return None
+
+
+def decodes(prefix, encoding):
+    "Whether prefix, the start of a file, is valid in encoding"
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(prefix)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def is_wide_text(prefix, encoding):
+    """
+    Whether prefix, the start of a file full of NUL bytes, is text in
+    encoding: a UTF-16 or UTF-32 encoding that decodes it without any NULs
+    """
+    if not codecs.lookup(encoding).name.startswith(("utf-16", "utf-32")):
+        return False
+    try:
+        text = codecs.getincrementaldecoder(encoding)().decode(prefix)
+    except UnicodeDecodeError:
+        return False
+    return "\0" not in text
+
+
+def validate_encoding(ctx, param, value):
+    "Click callback that checks encoding names are known to Python"
+    import click
+
+    names = value if isinstance(value, tuple) else (value,)
+    for name in names:
+        if param.name == "fallback_encodings" and name == REPLACE:
+            continue
+        try:
+            codecs.lookup(name)
+        except LookupError:
+            raise click.BadParameter(f"Unknown encoding: {name}")
+    return value
+
+
+class Decoding:
+    """
+    How files are decoded: with the encoding given by a byte order mark if
+    there is one, or encoding otherwise, then each of fallbacks in turn.
+
+    A fallback encoding is only tried on the whole file if the first
+    SNIFF_SIZE bytes decode with it. The fallback "replace" decodes with the
+    main encoding, replacing invalid bytes with U+FFFD, and always succeeds.
+
+    Counts the files that needed a fallback and those that were skipped.
+    """
+
+    def __init__(self, encoding="utf-8", fallbacks=()):
+        self.encoding = codecs.lookup(encoding).name
+        self.fallbacks = tuple(fallbacks)
+        self.recovered = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        "Identifies these settings, for caching rendered files"
+        return ",".join((self.encoding,) + self.fallbacks)
+
+    def attempts(self, prefix):
+        "Yield (encoding, errors) pairs to try in turn for a file"
+        encoding = detect_bom(prefix) or self.encoding
+        yield encoding, "strict"
+        for fallback in self.fallbacks:
+            if fallback == REPLACE:
+                yield encoding, "replace"
+            elif decodes(prefix, fallback):
+                yield fallback, "strict"
+
+    def record(self, recovered):
+        with self._lock:
+            if recovered:
+                self.recovered += 1
+            else:
+                self.skipped += 1
+
+    def summary(self):
+        return (
+            f"Encoding: {self.recovered} file{'' if self.recovered == 1 else 's'} "
+            f"recovered with a fallback, {self.skipped} skipped"
+        )
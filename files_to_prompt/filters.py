@@ -0,0 +1,93 @@
+import os
+import re
+from fnmatch import translate
+
+# fnmatch() compares names with os.path.normcase(), which folds case on Windows
+_FLAGS = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+
+def compile_globs(patterns):
+    """
+    Compile fnmatch patterns into a single regular expression, returning its
+    match method, or None if there are no patterns
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(translate(p) for p in patterns), _FLAGS).match
+
+
+class PathFilter:
+    """
+    The hidden file, --extension, --ignore and --include filters, compiled
+    once and applied cheapest first.
+
+    Patterns containing a "/" are matched against the path relative to the
+    directory being processed, and other patterns against the file or
+    directory name. All the --ignore patterns of each kind are combined into
+    one regular expression, as are the --include patterns. A file must match
+    at least one --include pattern, if there are any. Directories are only
+    checked against --ignore patterns, and only without ignore_files_only.
+
+    The skip_*() methods return the reason an entry is filtered out, which
+    is used for --stats, or None if it is kept.
+    """
+
+    def __init__(
+        self,
+        extensions=(),
+        include_hidden=False,
+        ignore_patterns=(),
+        ignore_files_only=False,
+        include_patterns=(),
+    ):
+        # Identifies the filter's settings, for reusing directory listings
+        self.key = (
+            tuple(extensions),
+            include_hidden,
+            tuple(ignore_patterns),
+            ignore_files_only,
+            tuple(include_patterns),
+        )
+        self.extensions = tuple(extensions)
+        self.include_hidden = include_hidden
+        self.ignore_files_only = ignore_files_only
+        self._ignore_name = compile_globs([p for p in ignore_patterns if "/" not in p])
+        self._ignore_path = compile_globs([p for p in ignore_patterns if "/" in p])
+        self._include_name = compile_globs(
+            [p for p in include_patterns if "/" not in p]
+        )
+        self._include_path = compile_globs([p for p in include_patterns if "/" in p])
+        self.uses_paths = bool(self._ignore_path or self._include_path)
+
+    def skip_file(self, name, rel_path=None):
+        """
+        Check a file by its name and, if uses_paths is true, its path
+        relative to the directory being processed with "/" separators
+        """
+        if not self.include_hidden and name.startswith("."):
+            return "hidden"
+        if self.extensions and not name.endswith(self.extensions):
+            return "extension"
+        if self._ignore_name is not None and self._ignore_name(name):
+            return "--ignore"
+        if self._ignore_path is not None and self._ignore_path(rel_path):
+            return "--ignore"
+        if self._include_name is not None or self._include_path is not None:
+            if not (
+                (self._include_name is not None and self._include_name(name))
+                or (self._include_path is not None and self._include_path(rel_path))
+            ):
+                return "--include"
+        return None
+
+    def skip_dir(self, name, rel_path=None):
+        "Check a directory, with the same arguments as skip_file()"
+        if not self.include_hidden and name.startswith("."):
+            return "hidden"
+        if self.ignore_files_only:
+            return None
+        if self._ignore_name is not None and self._ignore_name(name):
+            return "--ignore"
+        if self._ignore_path is not None and self._ignore_path(rel_path):
+            return "--ignore"
+        return None
@@ -0,0 +1,164 @@
+import codecs
+import io
+import mmap
+import os
+import sys
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, OSError, ValueError):
+    IOV_MAX = 1024
+
+
+class OutputWriter:
+    """
+    A writer that encodes output and sends it to a binary stream in large
+    batches, rather than making a separate write for every line.
+
+    When the stream has a real file descriptor the buffered pieces are
+    written with a single os.writev() call, so they are never joined into
+    one large bytes object. Call it like click.echo: writer(s, nl=True).
+    """
+
+    def __init__(
+        self, stream, buffer_size=DEFAULT_BUFFER_SIZE, encoding="utf-8", errors="strict"
+    ):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.errors = errors
+        self.bytes_written = 0
+        self._parts = []
+        self._size = 0
+        self._fd = None
+        if hasattr(os, "writev"):
+            try:
+                self._fd = stream.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+        # Anything already buffered by the stream must go out first
+        stream.flush()
+
+    @classmethod
+    def for_stdout(cls, buffer_size=DEFAULT_BUFFER_SIZE):
+        stdout = sys.stdout
+        stdout.flush()
+        # An io.StringIO, for example, has no encoding
+        encoding = getattr(stdout, "encoding", None) or "utf-8"
+        errors = getattr(stdout, "errors", None) or "strict"
+        stream = getattr(stdout, "buffer", None)
+        if stream is None:
+            # sys.stdout has been replaced, as by contextlib.redirect_stdout()
+            stream = TextStream(stdout, encoding, errors)
+        return cls(stream, buffer_size, encoding, errors)
+
+    def __call__(self, s, nl=True):
+        data = s.encode(self.encoding, self.errors)
+        self._parts.append(data)
+        self._size += len(data)
+        if nl:
+            self._parts.append(b"\n")
+            self._size += 1
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def write_bytes(self, data):
+        "Write data, which is already encoded, without copying it"
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def write_parts(self, parts):
+        """
+        Write a list of bytes objects, which are already encoded, straight
+        to the stream after anything that is buffered
+        """
+        self.flush()
+        self._write(parts, sum(map(len, parts)))
+
+    def flush(self):
+        parts = self._parts
+        if not parts:
+            return
+        size = self._size
+        self._parts = []
+        self._size = 0
+        self._write(parts, size)
+
+    def _write(self, parts, size):
+        self.bytes_written += size
+        if self._fd is None:
+            self.stream.write(b"".join(parts))
+            self.stream.flush()
+            return
+        for start in range(0, len(parts), IOV_MAX):
+            batch = parts[start : start + IOV_MAX]
+            written = os.writev(self._fd, batch)
+            if written < sum(map(len, batch)):
+                # Partial write, for example after a signal: write the rest
+                rest = memoryview(b"".join(parts[start:]))[written:]
+                while rest:
+                    rest = rest[os.write(self._fd, rest) :]
+                return
+
+    def write_file(self, path):
+        """
+        Copy the bytes of the UTF-8 file at path to the output without
+        decoding them, using os.sendfile() or a memory map where possible.
+        """
+        self.flush()
+        if codecs.lookup(self.encoding).name != "utf-8":
+            with open(path, "r", encoding="utf-8") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                    self(chunk, nl=False)
+            self.flush()
+            return
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            if self._fd is not None and hasattr(os, "sendfile"):
+                try:
+                    while offset < size:
+                        sent = os.sendfile(self._fd, f.fileno(), offset, size - offset)
+                        if not sent:
+                            break
+                        offset += sent
+                except OSError:
+                    # Not supported for this pair of files, copy the rest
+                    pass
+            if offset < size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    rest = memoryview(mm)[offset:size]
+                    try:
+                        if self._fd is not None:
+                            while rest:
+                                rest = rest[os.write(self._fd, rest) :]
+                        else:
+                            self.stream.write(rest)
+                            self.stream.flush()
+                    finally:
+                        rest.release()
+            self.bytes_written += size
+
+    def close(self):
+        self.flush()
+
+
+class TextStream:
+    """
+    Lets OutputWriter write to a text stream with no binary buffer, such as
+    an io.StringIO, by decoding what it writes again.
+    """
+
+    def __init__(self, stream, encoding="utf-8", errors="strict"):
+        self.stream = stream
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def write(self, data):
+        self.stream.write(self._decoder.decode(data))
+
+    def flush(self):
+        self.stream.flush()
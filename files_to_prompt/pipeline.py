@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+
+async def run_pipeline(file_paths, render, write, concurrency, window=None):
+    """
+    Render every path from file_paths and call write(path, result) for each
+    one in the original order, stopping early if write() returns False.
+
+    The pipeline has three stages. The enumerator pulls paths from the
+    file_paths iterator, the readers call the blocking render(path) with at
+    most concurrency calls running at once, and the writer calls write() as
+    each result becomes next in line. No more than window paths (default
+    concurrency * 4) are taken from the enumerator before being written, so
+    a slow writer holds back the other stages instead of filling memory.
+
+    Enumerating and rendering both run in worker threads, so walking a slow
+    filesystem overlaps with reading files from it.
+    """
+    if window is None:
+        window = concurrency * 4
+    loop = asyncio.get_running_loop()
+    # One extra thread so enumerating never waits behind the readers
+    executor = ThreadPoolExecutor(max_workers=concurrency + 1)
+    readers = asyncio.Semaphore(concurrency)
+    slots = asyncio.Semaphore(window)
+    pending = asyncio.Queue()
+
+    async def read(file_path):
+        async with readers:
+            return await loop.run_in_executor(executor, render, file_path)
+
+    async def enumerate_paths():
+        iterator = iter(file_paths)
+        try:
+            while True:
+                await slots.acquire()
+                file_path = await loop.run_in_executor(executor, next, iterator, _END)
+                if file_path is _END:
+                    return
+                await pending.put((file_path, asyncio.ensure_future(read(file_path))))
+        finally:
+            pending.put_nowait(None)
+
+    enumerator = asyncio.ensure_future(enumerate_paths())
+    task = None
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            file_path, task = item
+            result = await task
+            slots.release()
+            if write(file_path, result) is False:
+                return
+        # Raise any exception from the enumerator
+        await enumerator
+    finally:
+        enumerator.cancel()
+        if task is not None:
+            task.cancel()
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[1].cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,335 @@
+import contextlib
+import hmac
+import http.server
+import io
+import json
+import os
+import secrets
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+import click
+
+from .cache import ignore, is_cacheable
+from .cli import cli, iter_file_paths
+
+# Each response frame is a kind byte and a payload length, then the payload
+FRAME_HEADER = struct.Struct(">cI")
+STDOUT = b"o"
+STDERR = b"e"
+EXIT = b"x"
+
+
+class MemoryCache:
+    """
+    Rendered files kept in memory between requests, with the same interface
+    as RenderCache. Entries are keyed by path and output variant and are
+    only used while the file's st_mtime_ns and st_size are unchanged. Once
+    the cache holds more than max_size bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, path, variant, render):
+        rendered, store = self.lookup(path, variant)
+        if rendered is None:
+            rendered = render()
+            store(rendered)
+        return rendered
+
+    def lookup(self, path, variant):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, ignore
+        key = (os.path.abspath(path), path, variant)
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.hits += 1
+                self._blocks.move_to_end(key)
+                return [entry[2]], ignore
+            self.misses += 1
+        return None, lambda rendered: self._store(key, stat, rendered)
+
+    def _store(self, key, stat, rendered):
+        if not is_cacheable(rendered):
+            return
+        block = "".join(rendered)
+        with self._lock:
+            previous = self._blocks.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self._blocks[key] = (stat.st_mtime_ns, stat.st_size, block)
+            self.size += len(block)
+            while self.size > self.max_size and self._blocks:
+                self.size -= len(self._blocks.popitem(last=False)[1][2])
+
+    def close(self):
+        pass
+
+
+class TreeIndex:
+    """
+    The files listed under each directory path, kept between requests.
+
+    A listing is reused while the st_mtime_ns of every directory that was
+    walked, and of the .gitignore files that applied, is unchanged. Adding,
+    removing or renaming a file changes its directory's mtime, so checking
+    a listing only needs one stat() per directory and .gitignore.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _snapshot(self, paths):
+        snapshot = {}
+        for path in paths:
+            try:
+                snapshot[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def list_files(
+        self, path, path_filter, ignore_gitignore, gitignore_scopes, follow_symlinks
+    ):
+        "Return the same paths as iter_file_paths(), as a list"
+        if not os.path.isdir(path):
+            return list(
+                iter_file_paths(
+                    path,
+                    path_filter,
+                    ignore_gitignore,
+                    gitignore_scopes,
+                    follow_symlinks,
+                )
+            )
+        key = (
+            os.path.abspath(path),
+            path,
+            path_filter.key,
+            ignore_gitignore,
+            follow_symlinks,
+        )
+        with self._lock:
+            listing = self._listings.get(key)
+        if listing is not None:
+            snapshot, file_paths = listing
+            if self._snapshot(snapshot) == snapshot:
+                self.hits += 1
+                return file_paths
+        self.misses += 1
+        directories = set()
+        file_paths = list(
+            iter_file_paths(
+                path,
+                path_filter,
+                ignore_gitignore,
+                gitignore_scopes,
+                follow_symlinks,
+                directories=directories,
+            )
+        )
+        watched = set(directories)
+        if not ignore_gitignore:
+            watched.update(
+                os.path.join(directory, ".gitignore")
+                for directory in directories | {os.path.dirname(path)}
+            )
+        with self._lock:
+            self._listings[key] = (self._snapshot(watched), file_paths)
+        return file_paths
+
+
+class WarmState:
+    """
+    Passed to cli() as the click context object by the server, so that
+    every request shares the same MemoryCache and TreeIndex
+    """
+
+    def __init__(self, cache_size):
+        self.cache = MemoryCache(cache_size)
+        self.listings = TreeIndex()
+
+
+class FrameStream(io.RawIOBase):
+    "A binary stream that sends everything written to it as frames of kind"
+
+    def __init__(self, send, kind):
+        self._send = send
+        self._kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self._send(FRAME_HEADER.pack(self._kind, len(data)) + bytes(data))
+        return len(data)
+
+
+class NoInput(io.StringIO):
+    "Stands in for stdin when the client's stdin was a terminal"
+
+    def isatty(self):
+        return True
+
+
+def run_request(request, send, state):
+    """
+    Run cli() for a request, a dictionary with the command line "args", the
+    client's "cwd" and the "stdin" text or None, sending stdout and stderr
+    back as frames followed by an exit frame
+    """
+    stdout = io.TextIOWrapper(FrameStream(send, STDOUT), "utf-8", write_through=True)
+    stderr = io.TextIOWrapper(FrameStream(send, STDERR), "utf-8", write_through=True)
+    stdin = request.get("stdin")
+    exit_code = 0
+    previous_cwd = os.getcwd()
+    try:
+        os.chdir(request["cwd"])
+    except OSError as e:
+        message = f"Error: {e}\n".encode("utf-8")
+        send(FRAME_HEADER.pack(STDERR, len(message)) + message)
+        send(FRAME_HEADER.pack(EXIT, 1) + b"1")
+        return
+    saved_stdin = sys.stdin
+    sys.stdin = NoInput() if stdin is None else io.StringIO(stdin)
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                cli.main(list(request["args"]), prog_name="files-to-prompt", obj=state)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    exit_code = e.code
+                elif e.code is not None:
+                    exit_code = 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            stdout.flush()
+            stderr.flush()
+    finally:
+        sys.stdin = saved_stdin
+        os.chdir(previous_cwd)
+    code = str(exit_code).encode("ascii")
+    send(FRAME_HEADER.pack(EXIT, len(code)) + code)
+
+
+class UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        run_request(request, self.wfile.write, self.server.state)
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Accepts requests POSTed as application/json to the server's secret path.
+    Web pages can send simple cross-origin POSTs to localhost, so requests
+    with an Origin header or another Content-Type are rejected, and a
+    request without the token is rejected whoever sends it.
+    """
+
+    def do_POST(self):
+        if not hmac.compare_digest(self.path, f"/{self.server.token}"):
+            self.send_error(403)
+            return
+        if self.headers.get("Origin") is not None:
+            self.send_error(403)
+            return
+        content_type = self.headers.get("Content-Type", "").split(";")[0]
+        if content_type.strip().lower() != "application/json":
+            self.send_error(415)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        run_request(json.loads(body), self.wfile.write, self.server.state)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@click.command()
+@click.option(
+    "socket_path",
+    "--socket",
+    type=click.Path(dir_okay=False),
+    help="Listen on this Unix socket",
+)
+@click.option(
+    "--port",
+    type=click.IntRange(1, 65535),
+    help="Listen for HTTP requests on this port on localhost",
+)
+@click.option(
+    "cache_size",
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=256,
+    show_default=True,
+    help="Maximum size in MB of the rendered files kept in memory",
+)
+def serve(socket_path, port, cache_size):
+    """
+    Run files-to-prompt as a server, keeping directory listings and rendered
+    files in memory between requests. Set FILES_TO_PROMPT_SERVER to the
+    address the server prints - the socket path, or with --port an
+    http://localhost:PORT/TOKEN URL - and the files-to-prompt command sends
+    its arguments to the server instead of running them itself.
+
+    Requests are handled one at a time.
+    """
+    if (socket_path is None) == (port is None):
+        raise click.UsageError("Provide exactly one of --socket or --port")
+    state = WarmState(cache_size * 1024 * 1024)
+    if socket_path is not None:
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise click.UsageError(f"{socket_path} exists and is not a socket")
+            os.unlink(socket_path)
+        # Requests can read any file the server can, so the socket is only
+        # accessible to this user from the moment it is created
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.UnixStreamServer(socket_path, UnixHandler)
+        finally:
+            os.umask(umask)
+        address = socket_path
+    else:
+        server = http.server.HTTPServer(("127.0.0.1", port), HTTPHandler)
+        # Any local user, or web page, can connect to the port, so requests
+        # must know this token
+        server.token = secrets.token_urlsafe(24)
+        address = f"http://localhost:{port}/{server.token}"
+    server.state = state
+    click.echo(f"Listening on {address}", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import Counter
+
+PHASES = ("walk", "gitignore", "read", "format", "write")
+
+COUNTS = (
+    "directories",
+    "files_considered",
+    "files_written",
+    "bytes_read",
+    "bytes_written",
+)
+
+
+class Stats:
+    """
+    Counts and per-phase timings for a run, reported by --stats.
+
+    With --jobs or --async the read and format phases run in several threads
+    at once, and their timings are summed across threads, so the phases can
+    add up to more than the wall time.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wall_time = None
+        self.counts = Counter(dict.fromkeys(COUNTS, 0))
+        self.skipped = Counter()
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def skip(self, reason):
+        with self._lock:
+            self.skipped[reason] += 1
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.timings[phase] += seconds
+
+    def timed(self, phase, function):
+        "Wrap function so the time spent in it is added to phase"
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(phase, time.perf_counter() - start)
+
+        return wrapper
+
+    def timed_iter(self, phase, iterable):
+        "Yield from iterable, adding the time spent producing items to phase"
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.perf_counter() - start)
+                return
+            self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def finish(self, bytes_written):
+        self.counts["bytes_written"] = bytes_written
+        self.wall_time = time.perf_counter() - self.started
+
+    def as_dict(self):
+        timings = dict(self.timings)
+        # Matching .gitignore rules happens while walking
+        timings["walk"] = max(timings["walk"] - timings["gitignore"], 0.0)
+        timings["total"] = self.wall_time
+        return {
+            "counts": dict(self.counts),
+            "skipped": dict(self.skipped),
+            "timings": timings,
+        }
+
+    def report(self):
+        data = self.as_dict()
+        lines = ["Stats:"]
+        for name, value in data["counts"].items():
+            lines.append(
+                f"  {name.replace('_', ' ').capitalize() + ':':<20}{value:>14,}"
+            )
+        if data["skipped"]:
+            lines.append("  Skipped:")
+            for reason, value in sorted(data["skipped"].items()):
+                lines.append(f"    {reason:<22}{value:>10,}")
+        lines.append("  Time:")
+        for phase, seconds in data["timings"].items():
+            lines.append(f"    {phase:<20}{seconds:>11.3f}s")
+        return "\n".join(lines)
@@ -0,0 +1,82 @@
+import os
+
+
+def estimate_tokens_heuristic(text):
+    "Roughly four characters per token, which is close for English and code"
+    return (len(text) + 3) // 4
+
+
+def tiktoken_estimator():
+    try:
+        import tiktoken
+    except ImportError:
+        import click
+
+        raise click.ClickException(
+            "--tokenizer tiktoken requires tiktoken: pip install tiktoken"
+        )
+    encoding = tiktoken.get_encoding("cl100k_base")
+
+    def estimate(text):
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return estimate
+
+
+TOKENIZERS = {
+    "heuristic": lambda: estimate_tokens_heuristic,
+    "tiktoken": tiktoken_estimator,
+}
+
+
+class TokenBudget:
+    """
+    Tracks estimated tokens for each file written against a maximum.
+
+    Files that would take the total over max_tokens are skipped, or if stop
+    is True, the run stops writing files at the first one that does not fit.
+    """
+
+    def __init__(self, max_tokens, estimate=estimate_tokens_heuristic, stop=False):
+        self.max_tokens = max_tokens
+        self.estimate = estimate
+        self.stop = stop
+        self.exhausted = False
+        self.total = 0
+        self.files = []
+
+    def admit(self, path, rendered):
+        """
+        Returns True if the rendered file fits in the remaining budget, and
+        records it in the summary either way.
+        """
+        if self.exhausted:
+            return False
+        if isinstance(rendered, list):
+            tokens = sum(self.estimate(text) for text in rendered)
+        else:
+            # Streamed files are too large to render ahead of time. Archive
+            # members carry their size, as their path cannot be stat'ed
+            size = getattr(rendered, "size", None)
+            if size is None:
+                size = os.path.getsize(path)
+            tokens = (size + 3) // 4
+        fits = self.total + tokens <= self.max_tokens
+        self.files.append((path, tokens, fits))
+        if fits:
+            self.total += tokens
+        elif self.stop:
+            self.exhausted = True
+        return fits
+
+    def summary(self):
+        lines = ["Tokens:"]
+        width = len(str(max((tokens for _, tokens, _ in self.files), default=0)))
+        for path, tokens, fits in self.files:
+            lines.append(f"  {tokens:>{width}}  {path}{'' if fits else ' (skipped)'}")
+        total = f"Total: {self.total} of {self.max_tokens} tokens"
+        skipped = sum(1 for _, _, fits in self.files if not fits)
+        if skipped:
+            total += f", {skipped} file{'' if skipped == 1 else 's'} skipped"
+        lines.append(total)
+        return "\n".join(lines)
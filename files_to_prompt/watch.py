@@ -0,0 +1,357 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import stat
+import struct
+import tempfile
+import time
+
+from .output import OutputWriter
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Prefix for the temporary files the output is written to before renaming
+TEMP_PREFIX = ".files-to-prompt-"
+
+
+class Changes:
+    """
+    Files that changed since a watcher was last asked. If rescan is true the
+    set of files may have changed in ways that were not tracked, such as a
+    directory being created, and everything has to be checked.
+    """
+
+    def __init__(self, rescan=False):
+        self.rescan = rescan
+        self.modified = set()
+        self.created = set()
+        self.deleted = set()
+
+    def __bool__(self):
+        return bool(self.rescan or self.modified or self.created or self.deleted)
+
+
+class InotifyWatcher:
+    "Watches directories for changes with Linux inotify, called through ctypes"
+
+    MASK = (
+        IN_MODIFY
+        | IN_CLOSE_WRITE
+        | IN_CREATE
+        | IN_DELETE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+    )
+
+    def __init__(self, ignore=()):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.ignore = {os.path.abspath(path) for path in ignore}
+        self._directories = {}
+        self._watched = set()
+
+    def watch(self, directories):
+        "Start watching any of directories that are not already watched"
+        for directory in directories:
+            if directory in self._watched:
+                continue
+            wd = self._add_watch(
+                self._fd, os.fsencode(directory or "."), ctypes.c_uint32(self.MASK)
+            )
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), directory)
+            self._directories[wd] = directory
+            self._watched.add(directory)
+
+    def _read_events(self, changes):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changes.rescan = True
+                    continue
+                directory = self._directories.get(wd)
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    self._watched.discard(directory)
+                    continue
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name)
+                if name.startswith(TEMP_PREFIX) or os.path.abspath(path) in self.ignore:
+                    continue
+                if name == ".gitignore" or mask & (
+                    IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF
+                ):
+                    # A changed .gitignore can include or exclude any file
+                    # below it, so list them all again
+                    changes.rescan = True
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    changes.created.add(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changes.deleted.add(path)
+                else:
+                    changes.modified.add(path)
+
+    def wait(self, timeout, settle=0.01):
+        """
+        Wait up to timeout seconds for a change, then keep collecting events
+        until there have been none for settle seconds, so that a burst of
+        writes leads to a single update. Returns Changes, or None.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return None
+        changes = Changes()
+        deadline = time.monotonic() + 0.5
+        while True:
+            self._read_events(changes)
+            remaining = min(settle, deadline - time.monotonic())
+            if remaining <= 0 or not select.select([self._fd], [], [], remaining)[0]:
+                break
+        return changes or None
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    "Checks everything every interval seconds, where inotify is not available"
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+    def watch(self, directories):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return Changes(rescan=True)
+
+    def close(self):
+        pass
+
+
+def make_watcher(directories, ignore=(), poll_interval=1.0):
+    "Return an InotifyWatcher for directories if possible, or a PollingWatcher"
+    try:
+        watcher = InotifyWatcher(ignore)
+    except (AttributeError, OSError, TypeError):
+        # Not Linux, or inotify is unavailable
+        return PollingWatcher(poll_interval)
+    try:
+        watcher.watch(directories)
+    except OSError:
+        # For example ENOSPC, when there are more directories than watches
+        watcher.close()
+        return PollingWatcher(poll_interval)
+    return watcher
+
+
+# Stored for results that can only be used once, such as streamed files
+RENDER_AGAIN = object()
+
+
+class DocumentIndex:
+    """
+    The rendered result for every file in the output, in order, so that the
+    output can be written again after only the changed files are rendered.
+
+    list_files() returns the paths of all files to include. render(path)
+    returns the encoded document for a file as bytes, without the --cxml
+    index tag, None if the file is skipped, or any other result to be
+    passed to write_documents(). Iterators, such as streamed large files,
+    can only be used once, so those files are rendered again for each write.
+
+    While every result is bytes the output is kept as a list of parts, with
+    a fixed index tag before each document, and a changed file only replaces
+    its own part. Anything else rebuilds the list, numbering from 1 again.
+    """
+
+    def __init__(self, list_files, render, claude_xml=False):
+        self.list_files = list_files
+        self.render = render
+        self.claude_xml = claude_xml
+        self.paths = []
+        self._results = {}
+        # The output, when every result is bytes or None, and the position
+        # in it of each file's document
+        self._parts = None
+        self._slots = {}
+
+    def _render(self, path, force=False):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        key = (stat.st_mtime_ns, stat.st_size)
+        previous = self._results.get(path)
+        if not force and previous is not None and previous[0] == key:
+            return False
+        rendered = self.render(path)
+        if hasattr(rendered, "__next__"):
+            rendered.close()
+            rendered = RENDER_AGAIN
+        self._results[path] = (key, rendered)
+        slots = self._slots.get(path)
+        if self._parts is not None and slots and isinstance(rendered, bytes):
+            for slot in slots:
+                self._parts[slot] = rendered
+        else:
+            # Skipped or no longer skipped, which moves later documents
+            self._parts = None
+        return True
+
+    def update(self, changes=None):
+        """
+        Bring the index up to date with changes, or check every file if
+        changes is None or needs a rescan. Returns the number of files that
+        were rendered again, added or removed.
+        """
+        if changes is not None and not changes.rescan:
+            if any(path not in self._results for path in changes.created):
+                # A new file, which may need to go anywhere in the order
+                return self.update()
+            updated = 0
+            deleted = changes.deleted & set(self._results)
+            if deleted:
+                self.paths = [p for p in self.paths if p not in deleted]
+                for path in deleted:
+                    del self._results[path]
+                self._parts = None
+                updated += len(deleted)
+            for path in changes.modified | changes.created:
+                if path in self._results and path not in deleted:
+                    # Changed files are always rendered again, in case a
+                    # write kept the same size within one mtime tick
+                    if self._render(path, force=True):
+                        updated += 1
+            return updated
+        paths = list(self.list_files())
+        current = set(paths)
+        removed = [p for p in self._results if p not in current]
+        for path in removed:
+            del self._results[path]
+        # New files are counted when they are rendered below
+        updated = len(removed)
+        if removed or paths != self.paths:
+            self._parts = None
+        self.paths = paths
+        for path in paths:
+            if self._render(path):
+                updated += 1
+        return updated
+
+    def items(self):
+        "Yield (path, rendered) for every file that is not skipped, in order"
+        for path in self.paths:
+            result = self._results.get(path)
+            if result is None or result[1] is None:
+                continue
+            rendered = result[1]
+            if rendered is RENDER_AGAIN:
+                rendered = self.render(path)
+            yield path, rendered
+
+    def _build_parts(self):
+        parts = [b"<documents>\n"] if self.claude_xml else []
+        slots = {}
+        for number, (path, rendered) in enumerate(self.items(), 1):
+            if not isinstance(rendered, bytes):
+                return None
+            if self.claude_xml:
+                parts.append(f'<document index="{number}">\n'.encode("utf-8"))
+            slots.setdefault(path, []).append(len(parts))
+            parts.append(rendered)
+        if self.claude_xml:
+            parts.append(b"</documents>\n")
+        self._slots = slots
+        return parts
+
+    def write(self, output_file, write_documents):
+        """
+        Write the output to a temporary file and rename it over output_file,
+        so readers never see a partial file. Unless the output is kept as a
+        list of parts, it is written with write_documents(fp, self.items()).
+        The output keeps its permissions, or gets the usual ones for a new
+        file, rather than those of the temporary file.
+        """
+        if self._parts is None:
+            self._parts = self._build_parts()
+        directory = os.path.dirname(os.path.abspath(output_file))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                if self._parts is not None:
+                    OutputWriter(fp).write_parts(self._parts)
+                else:
+                    write_documents(fp, self.items())
+            os.chmod(temp_path, output_mode(output_file))
+            os.replace(temp_path, output_file)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def output_mode(path):
+    "The permissions of path, or those open() would give a new file there"
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        # mkstemp() always uses 0600, so apply the umask ourselves
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def watch_changes(
+    index, watcher, output_file, write_documents, directories, on_update, stop
+):
+    """
+    Update index and rewrite output_file whenever watcher reports changes,
+    until stop (a threading.Event) is set. directories() returns the
+    directories to watch after the files have been listed again, and
+    on_update(count, seconds) is called after each rewrite.
+    """
+    while not stop.is_set():
+        changes = watcher.wait(timeout=0.2)
+        if changes is None:
+            continue
+        start = time.perf_counter()
+        updated = index.update(changes)
+        if changes.rescan or changes.created:
+            try:
+                watcher.watch(directories())
+            except OSError:
+                pass
+        if updated:
+            index.write(output_file, write_documents)
+            on_update(updated, time.perf_counter() - start)
@@ -1,10 +1,25 @@
+import asyncio
+import codecs
+import contextlib
+import io
+import json
 import os
 import pytest
 import re
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 
 from click.testing import CliRunner
 
-from files_to_prompt.cli import cli
+from files_to_prompt.cli import cli, render_file
+from files_to_prompt.output import OutputWriter
+from files_to_prompt.pipeline import run_pipeline
 
 
 def filenames_from_cxml(cxml_string):
@@ -90,6 +105,32 @@ def test_ignore_gitignore(tmpdir):
         }
 
 
+def test_gitignore_last_match_wins(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        for name in (
+            "regen.py",
+            "regen1.py",
+            "regen12.py",
+            "other.py",
+            "a/tmp/x.bak",
+            "keep/tmp/y.bak",
+        ):
+            os.makedirs(os.path.dirname(f"test_dir/{name}"), exist_ok=True)
+            with open(f"test_dir/{name}", "w") as f:
+                f.write(name)
+        with open("test_dir/.gitignore", "w") as f:
+            # Globs with no literal prefix share one combined regex
+            f.write("*gen*\n!*gen1*\n*gen12*\n**/tmp/*.bak\n!keep/tmp/*.bak\n")
+        result = runner.invoke(cli, ["test_dir", "-c"])
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/regen1.py",
+            "test_dir/other.py",
+            "test_dir/keep/tmp/y.bak",
+        }
+
+
 def test_multiple_paths(tmpdir):
     runner = CliRunner()
     with tmpdir.as_cwd():
@@ -175,6 +216,50 @@ def test_specific_extensions(tmpdir):
         assert "test_dir/three.md" in result.output
 
 
+def test_include_and_path_patterns(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        for name in (
+            "src/app.py",
+            "src/app_test.py",
+            "src/data.json",
+            "src/vendor/lib.py",
+            "docs/index.md",
+            "docs/build/index.md",
+            "setup.py",
+        ):
+            os.makedirs(os.path.dirname(f"test_dir/{name}"), exist_ok=True)
+            with open(f"test_dir/{name}", "w") as f:
+                f.write(name)
+
+        result = runner.invoke(
+            cli, ["test_dir", "--include", "*.py", "--include", "docs/*", "-c"]
+        )
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/src/app.py",
+            "test_dir/src/app_test.py",
+            "test_dir/src/vendor/lib.py",
+            "test_dir/docs/index.md",
+            "test_dir/docs/build/index.md",
+            "test_dir/setup.py",
+        }
+
+        # Patterns with a / match the path relative to the directory, and
+        # prune directories unless --ignore-files-only is used
+        args = ["test_dir", "--ignore", "src/vendor", "--ignore", "*_test.py"]
+        args += ["--ignore", "docs/build", "-c"]
+        result = runner.invoke(cli, args)
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/src/app.py",
+            "test_dir/src/data.json",
+            "test_dir/docs/index.md",
+            "test_dir/setup.py",
+        }
+        result = runner.invoke(cli, args + ["--ignore-files-only"])
+        assert "test_dir/src/vendor/lib.py" in filenames_from_cxml(result.output)
+
+
 def test_mixed_paths_with_options(tmpdir):
     runner = CliRunner()
     with tmpdir.as_cwd():
@@ -439,3 +524,1631 @@ def test_markdown(tmpdir, option):
             "`````\n"
         )
         assert expected.strip() == actual.strip()
+
+
+def test_gitignore_negation_anchoring_and_scoping(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/a/build")
+        os.makedirs("test_dir/b/build")
+        os.makedirs("test_dir/b/deep/logs")
+        with open("test_dir/.gitignore", "w") as f:
+            f.write("*.log\n!keep.log\n/a/build/\n**/logs/*.txt\n")
+        with open("test_dir/a/.gitignore", "w") as f:
+            f.write("secret.txt\n")
+        for name in (
+            "test_dir/debug.log",
+            "test_dir/keep.log",
+            "test_dir/a/build/out.txt",
+            "test_dir/a/secret.txt",
+            "test_dir/b/build/out.txt",
+            "test_dir/b/secret.txt",
+            "test_dir/b/deep/logs/x.txt",
+        ):
+            with open(name, "w") as f:
+                f.write(name)
+
+        result = runner.invoke(cli, ["test_dir", "-c"])
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/keep.log",
+            # Anchored /a/build/ does not match b/build
+            "test_dir/b/build/out.txt",
+            # Rules from test_dir/a/.gitignore do not leak into siblings
+            "test_dir/b/secret.txt",
+        }
+
+
+@pytest.mark.parametrize("format_args", ([], ["--cxml"], ["--markdown"], ["-n"]))
+def test_jobs_output_matches_serial(tmpdir, format_args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/nested")
+        for i in range(30):
+            with open(f"test_dir/file{i}.py", "w") as f:
+                f.write(f"Contents of file{i}\n```\nline two")
+            with open(f"test_dir/nested/file{i}.txt", "w") as f:
+                f.write(f"Nested {i}")
+        with open("test_dir/nested/binary.bin", "wb") as f:
+            f.write(b"\xff")
+
+        serial = runner.invoke(cli, ["test_dir"] + format_args)
+        parallel = runner.invoke(cli, ["test_dir", "--jobs", "4"] + format_args)
+        assert serial.exit_code == parallel.exit_code == 0
+        assert serial.stdout == parallel.stdout
+        assert serial.stderr == parallel.stderr
+        assert "binary.bin due to UnicodeDecodeError" in parallel.stderr
+
+
+@pytest.mark.parametrize(
+    "format_args", ([], ["--cxml"], ["--markdown"], ["-n"], ["--cxml", "-n"])
+)
+def test_streaming_matches_buffered(tmpdir, monkeypatch, format_args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        contents = {
+            "empty.txt": "",
+            "no_newline.py": "one\ntwo",
+            "backticks.md": "a ``` b\n`````` c\n" * 3,
+            "separators.txt": "a\r\nb\rc\x0cd e\n\n",
+            "long.txt": "".join(f"line {i}\n" for i in range(200)),
+        }
+        for name, content in contents.items():
+            with open(f"test_dir/{name}", "w", newline="") as f:
+                f.write(content)
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"text" * 20 + b"\xff")
+
+        buffered = runner.invoke(cli, ["test_dir"] + format_args)
+        monkeypatch.setattr("files_to_prompt.cli.STREAM_THRESHOLD", -1)
+        monkeypatch.setattr("files_to_prompt.cli.CHUNK_SIZE", 5)
+        streamed = runner.invoke(cli, ["test_dir"] + format_args)
+        assert buffered.exit_code == streamed.exit_code == 0
+        assert buffered.stdout == streamed.stdout
+        assert buffered.stderr == streamed.stderr
+        assert "binary.bin due to UnicodeDecodeError" in streamed.stderr
+
+
+@pytest.mark.parametrize("to_file", (False, True))
+def test_passthrough_matches_decoded(tmpdir, monkeypatch, to_file):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        contents = {
+            "ascii.txt": "".join(f"line {i}\n" for i in range(50)),
+            "unicode.txt": "caf\u00e9 \u2603 \U0001f600\n" * 20,
+            "carriage.txt": "a\r\nb\rc\n",
+        }
+        for name, content in contents.items():
+            with open(f"test_dir/{name}", "w", encoding="utf-8", newline="") as f:
+                f.write(content)
+        with open("test_dir/invalid.txt", "wb") as f:
+            f.write("caf\u00e9".encode("utf-8")[:-1] + b"\n")
+
+        def run():
+            args = ["test_dir", "--cxml"]
+            if to_file:
+                args += ["-o", "out.txt"]
+            result = runner.invoke(cli, args)
+            assert result.exit_code == 0
+            assert "invalid.txt due to UnicodeDecodeError" in result.stderr
+            if to_file:
+                with open("out.txt", "rb") as f:
+                    return f.read()
+            return result.stdout_bytes
+
+        decoded = run()
+        copied = []
+        original = OutputWriter.write_file
+        monkeypatch.setattr(
+            OutputWriter,
+            "write_file",
+            lambda self, path: copied.append(path) or original(self, path),
+        )
+        monkeypatch.setattr("files_to_prompt.cli.STREAM_THRESHOLD", -1)
+        # Split multi-byte characters across validation chunks
+        monkeypatch.setattr("files_to_prompt.cli.PASSTHROUGH_CHUNK_SIZE", 7)
+        assert run() == decoded
+        assert sorted(copied) == ["test_dir/ascii.txt", "test_dir/unicode.txt"]
+
+
+class SlowFilesystem:
+    "Wraps render_file() to add latency, like a network filesystem"
+
+    def __init__(self, render_file, latency):
+        self.render_file = render_file
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, path, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return self.render_file(path, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.mark.parametrize("format_args", ([], ["--cxml"], ["--markdown", "-n"]))
+def test_async_pipeline_matches_serial(tmpdir, monkeypatch, format_args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        for i in range(40):
+            os.makedirs(f"test_dir/dir{i % 4}", exist_ok=True)
+            with open(f"test_dir/dir{i % 4}/file{i}.txt", "w") as f:
+                f.write(f"Contents of file{i}\n")
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"\xff")
+        serial = runner.invoke(cli, ["test_dir"] + format_args)
+
+        slow = SlowFilesystem(render_file, latency=0.02)
+        monkeypatch.setattr("files_to_prompt.cli.render_file", slow)
+        start = time.perf_counter()
+        result = runner.invoke(cli, ["test_dir", "--async", "-j", "8"] + format_args)
+        elapsed = time.perf_counter() - start
+        assert result.exit_code == 0
+        assert result.stdout == serial.stdout
+        assert result.stderr == serial.stderr
+        assert slow.max_in_flight == 8
+        # 41 files at 20ms each take over 0.8s one at a time
+        assert elapsed < 0.6
+
+
+def test_async_pipeline_backpressure():
+    pulled = []
+    written = []
+
+    def file_paths():
+        for i in range(100):
+            # Never more than window paths ahead of the writer
+            assert len(pulled) - len(written) <= 6
+            pulled.append(i)
+            yield i
+
+    def render(i):
+        time.sleep(0.001 * (i % 3))
+        return i * 2
+
+    def write(i, result):
+        written.append((i, result))
+        return i < 49
+
+    asyncio.run(run_pipeline(file_paths(), render, write, concurrency=3, window=6))
+    assert written == [(i, i * 2) for i in range(50)]
+
+
+def test_stats(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/nested")
+        with open("test_dir/.gitignore", "w") as f:
+            f.write("ignored.txt\n")
+        for name in ("one.txt", "nested/two.txt", "ignored.txt", "skip.md"):
+            with open(f"test_dir/{name}", "w") as f:
+                f.write("contents")
+        with open("test_dir/binary.txt", "wb") as f:
+            f.write(b"\xff")
+        result = runner.invoke(
+            cli, ["test_dir", "-e", "txt", "--stats", "--stats-json", "stats.json"]
+        )
+        assert result.exit_code == 0
+        assert "Stats:" in result.stderr
+        assert re.search(r"Files written: +2", result.stderr)
+        with open("stats.json") as f:
+            stats = json.load(f)
+        assert stats["counts"] == {
+            "directories": 2,
+            "files_considered": 5,
+            "files_written": 2,
+            "bytes_read": 16,
+            "bytes_written": len(result.stdout.encode("utf-8")),
+        }
+        assert stats["skipped"] == {
+            "hidden": 1,
+            "extension": 1,
+            ".gitignore": 1,
+            "due to UnicodeDecodeError": 1,
+        }
+        assert set(stats["timings"]) == {
+            "walk",
+            "gitignore",
+            "read",
+            "format",
+            "write",
+            "total",
+        }
+
+
+@pytest.mark.parametrize("stream", (False, True))
+def test_encodings(tmpdir, monkeypatch, stream):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/bom8.txt", "wb") as f:
+            f.write(codecs.BOM_UTF8 + "utf-8 caf\u00e9".encode("utf-8"))
+        with open("test_dir/bom16.txt", "wb") as f:
+            f.write("utf-16 caf\u00e9".encode("utf-16"))
+        with open("test_dir/latin1.txt", "wb") as f:
+            f.write("latin-1 caf\u00e9".encode("latin-1"))
+        with open("test_dir/undefined.txt", "wb") as f:
+            # 0x81 is not defined in cp1252
+            f.write(b"text \x81 \xe9")
+        if stream:
+            monkeypatch.setattr("files_to_prompt.cli.STREAM_THRESHOLD", -1)
+
+        result = runner.invoke(cli, ["test_dir"])
+        assert result.exit_code == 0
+        assert "utf-8 caf\u00e9\n" in result.stdout
+        assert "\ufeff" not in result.stdout
+        assert "utf-16 caf\u00e9\n" in result.stdout
+        assert "latin1.txt due to UnicodeDecodeError" in result.stderr
+        assert "Encoding:" not in result.stderr
+
+        result = runner.invoke(cli, ["test_dir", "--fallback-encoding", "cp1252"])
+        assert "latin-1 caf\u00e9\n" in result.stdout
+        assert "undefined.txt due to UnicodeDecodeError" in result.stderr
+        assert "Encoding: 1 file recovered with a fallback, 1 skipped" in (
+            result.stderr
+        )
+
+        result = runner.invoke(
+            cli,
+            ["test_dir", "--fallback-encoding", "cp1252"]
+            + ["--fallback-encoding", "replace"],
+        )
+        assert "text \ufffd \ufffd\n" in result.stdout
+        assert "Encoding: 2 files recovered with a fallback, 0 skipped" in (
+            result.stderr
+        )
+
+        result = runner.invoke(cli, ["test_dir/latin1.txt", "--encoding", "latin-1"])
+        assert result.exit_code == 0
+        assert "latin-1 caf\u00e9\n" in result.stdout
+
+        # UTF-16 and UTF-32 text without a byte order mark looks binary
+        os.makedirs("wide")
+        with open("wide/utf16.txt", "wb") as f:
+            f.write("utf-16-le caf\u00e9\n".encode("utf-16-le"))
+        with open("wide/image.bin", "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR\0\0")
+        result = runner.invoke(cli, ["wide"])
+        assert "utf16.txt as it appears to be binary" in result.stderr
+        for args in (["--encoding", "utf-16-le"], ["--fallback-encoding", "utf-16-le"]):
+            result = runner.invoke(cli, ["wide"] + args)
+            assert result.exit_code == 0
+            assert "utf-16-le caf\u00e9\n" in result.stdout
+            assert "image.bin as it appears to be binary" in result.stderr
+        assert "Encoding: 1 file recovered with a fallback, 0 skipped" in (
+            result.stderr
+        )
+
+
+def test_unknown_encoding(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        result = runner.invoke(cli, ["test_dir", "--fallback-encoding", "nope"])
+        assert result.exit_code == 2
+        assert "Unknown encoding: nope" in result.stderr
+
+
+@pytest.mark.parametrize(
+    "extra_args", ([], ["--cxml"], ["--markdown", "-n"], ["--cxml", "--dedupe"])
+)
+def test_processes_match_serial(tmpdir, monkeypatch, extra_args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/nested")
+        for i in range(20):
+            with open(f"test_dir/file{i}.py", "w") as f:
+                f.write(f"Contents of file{i % 7}\n```\nline two")
+            with open(f"test_dir/nested/file{i}.txt", "w") as f:
+                f.write(f"Nested {i} caf\u00e9")
+        with open("test_dir/nested/binary.bin", "wb") as f:
+            # Not valid in cp1252 either
+            f.write(b"\x81")
+        with open("test_dir/nested/latin1.txt", "wb") as f:
+            f.write(b"caf\xe9")
+        args = ["test_dir", "--fallback-encoding", "cp1252"] + extra_args
+
+        serial = runner.invoke(cli, args)
+        monkeypatch.setattr("files_to_prompt.cli.SHARD_SIZE", 3)
+        sharded = runner.invoke(cli, args + ["--processes", "3"])
+        assert serial.exit_code == sharded.exit_code == 0
+        assert sharded.stdout == serial.stdout
+        assert sharded.stderr == serial.stderr
+        assert "binary.bin due to UnicodeDecodeError" in sharded.stderr
+        assert "Encoding: 1 file recovered with a fallback, 1 skipped" in (
+            sharded.stderr
+        )
+
+
+def test_processes_use_cache_and_one_pool(tmpdir, monkeypatch):
+    import concurrent.futures
+
+    pools = []
+
+    class CountingPool(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", CountingPool)
+    monkeypatch.setattr("files_to_prompt.cli.SHARD_SIZE", 3)
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        for directory in ("one", "two"):
+            os.makedirs(directory)
+            for i in range(5):
+                with open(f"{directory}/file{i}.txt", "w") as f:
+                    f.write(f"Contents of {directory}/file{i}")
+        args = ["one", "two", "--processes", "2", "--cache-dir", "cache"]
+
+        first = runner.invoke(cli, args)
+        assert first.exit_code == 0
+        assert len(pools) == 1
+        assert "Cache: 0 hits, 10 misses" in first.stderr
+        second = runner.invoke(cli, args)
+        assert "Cache: 10 hits, 0 misses" in second.stderr
+        assert (
+            second.stdout == first.stdout == runner.invoke(cli, ["one", "two"]).stdout
+        )
+
+        # Only the changed file is rendered again
+        with open("two/file3.txt", "w") as f:
+            f.write("Changed")
+        third = runner.invoke(cli, args)
+        assert "Cache: 9 hits, 1 misses" in third.stderr
+        assert "Changed" in third.stdout
+
+
+@pytest.mark.parametrize("archive_name", ("drop.zip", "drop.tar.gz", "drop.tar"))
+def test_archive_inputs(tmpdir, archive_name):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        members = {
+            "src/app.py": b"print('hello')",
+            "src/util.py": b"def util(): pass",
+            "src/notes.txt": b"notes",
+            "src/.hidden.py": b"hidden",
+            ".git/config.py": b"git",
+            "build/out.py": b"built",
+            "src/image.py": b"\x89PNG\r\n\x1a\n\0\0",
+        }
+        if archive_name.endswith(".zip"):
+            with zipfile.ZipFile(archive_name, "w") as archive:
+                for name, data in members.items():
+                    archive.writestr(name, data)
+        else:
+            mode = "w:gz" if archive_name.endswith(".gz") else "w"
+            with tarfile.open(archive_name, mode) as archive:
+                for name, data in members.items():
+                    info = tarfile.TarInfo(f"./{name}")
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+
+        result = runner.invoke(
+            cli, [archive_name, "-e", "py", "--ignore", "build", "--cxml"]
+        )
+        assert result.exit_code == 0
+        assert result.stdout == (
+            "<documents>\n"
+            '<document index="1">\n'
+            f"<source>{archive_name}/src/app.py</source>\n"
+            "<document_content>\n"
+            "print('hello')\n"
+            "</document_content>\n"
+            "</document>\n"
+            '<document index="2">\n'
+            f"<source>{archive_name}/src/util.py</source>\n"
+            "<document_content>\n"
+            "def util(): pass\n"
+            "</document_content>\n"
+            "</document>\n"
+            "</documents>\n"
+        )
+        assert (
+            f"Skipping file {archive_name}/src/image.py as it appears to be binary"
+            in result.stderr
+        )
+        assert not os.path.exists("src")
+
+        result = runner.invoke(cli, [archive_name, "--include-hidden"])
+        assert f"{archive_name}/.git/config.py\n---\ngit\n" in result.stdout
+        assert f"{archive_name}/build/out.py" in result.stdout
+
+
+@pytest.mark.parametrize("archive_name", ("big.zip", "big.tar.gz"))
+@pytest.mark.parametrize("args", ([], ["--cxml"], ["--markdown"]))
+def test_archive_members_are_streamed(tmpdir, monkeypatch, archive_name, args):
+    from files_to_prompt import cli as cli_module
+
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        members = {
+            "small.txt": b"small",
+            "big.txt": b"".join(b"line %d ```\n" % i for i in range(1000)),
+            "latin.txt": "caf\xe9 ".encode("latin-1") * 1000,
+            "binary.txt": b"\0" * 5000,
+        }
+        if archive_name.endswith(".zip"):
+            with zipfile.ZipFile(archive_name, "w") as archive:
+                for name, data in members.items():
+                    archive.writestr(name, data)
+        else:
+            with tarfile.open(archive_name, "w:gz") as archive:
+                for name, data in members.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+        args = [archive_name, "--fallback-encoding", "latin-1"] + args
+        expected = runner.invoke(cli, args)
+
+        def render_bytes(path, data, *args):
+            assert len(data) <= 100
+            return real_render_bytes(path, data, *args)
+
+        real_render_bytes = cli_module.render_bytes
+        monkeypatch.setattr(cli_module, "render_bytes", render_bytes)
+        monkeypatch.setattr(cli_module, "STREAM_THRESHOLD", 100)
+        # Large tar members are copied to temporary files
+        os.makedirs("tmp")
+        monkeypatch.setattr(tempfile, "tempdir", os.path.abspath("tmp"))
+        result = runner.invoke(cli, args + ["--stats-json", "stats.json"])
+        assert result.exit_code == 0
+        assert result.stdout == expected.stdout
+        assert "binary.txt as it appears to be binary" in result.stderr
+        assert "line 999 ```" in result.stdout and "café café" in result.stdout
+        with open("stats.json") as f:
+            assert json.load(f)["counts"]["bytes_read"] == sum(
+                len(members[name]) for name in ("small.txt", "big.txt", "latin.txt")
+            )
+        assert os.listdir("tmp") == []
+
+
+def test_unreadable_archives(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        with zipfile.ZipFile("encrypted.zip", "w") as archive:
+            archive.writestr("plain.txt", "plain")
+            archive.writestr("secret.txt", "secret")
+        # Mark secret.txt as encrypted in its local and central headers
+        data = bytearray(open("encrypted.zip", "rb").read())
+        for signature, offset in ((b"PK\x03\x04", 6), (b"PK\x01\x02", 8)):
+            data[data.rfind(signature) + offset] |= 1
+        with open("encrypted.zip", "wb") as f:
+            f.write(data)
+        with open("invalid.zip", "wb") as f:
+            f.write(b"PK not a zip file")
+        with open("invalid.tar.gz", "wb") as f:
+            f.write(b"not a tar file")
+        with open("notes.txt", "w") as f:
+            f.write("notes")
+
+        result = runner.invoke(
+            cli, ["invalid.zip", "encrypted.zip", "invalid.tar.gz", "notes.txt"]
+        )
+        assert result.exit_code == 0
+        assert result.stdout == (
+            "encrypted.zip/plain.txt\n---\nplain\n\n---\n"
+            "notes.txt\n---\nnotes\n\n---\n"
+        )
+        assert result.stderr.splitlines() == [
+            "Warning: Skipping archive invalid.zip as it could not be read: "
+            "File is not a zip file",
+            "Warning: Skipping file encrypted.zip/secret.txt as it is encrypted",
+            "Warning: Skipping archive invalid.tar.gz as it could not be read: "
+            "truncated header",
+        ]
+
+
+def test_cache_dir(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/file1.txt", "w") as f:
+            f.write("Contents of file1")
+        with open("test_dir/file2.txt", "w") as f:
+            f.write("Contents of file2")
+        args = ["test_dir", "--cxml", "--cache-dir", "cache"]
+
+        first = runner.invoke(cli, args)
+        assert first.exit_code == 0
+        assert "Cache: 0 hits, 2 misses" in first.stderr
+
+        second = runner.invoke(cli, args)
+        assert second.exit_code == 0
+        assert "Cache: 2 hits, 0 misses" in second.stderr
+        assert second.stdout == first.stdout
+
+        # A different format is cached separately
+        markdown = runner.invoke(cli, args + ["--markdown"])
+        assert "Cache: 0 hits, 2 misses" in markdown.stderr
+
+        with open("test_dir/file2.txt", "w") as f:
+            f.write("Updated contents of file2")
+        third = runner.invoke(cli, args)
+        assert "Cache: 1 hits, 1 misses" in third.stderr
+        assert "Updated contents of file2" in third.stdout
+
+        # --max-file-size applies to files that are already cached
+        limited = runner.invoke(cli, args + ["--max-file-size", "20"])
+        assert "Contents of file1" in limited.stdout
+        assert "Updated contents of file2" not in limited.stdout
+        assert "file2.txt as it is larger than 20 bytes" in limited.stderr
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    from files_to_prompt.cache import RenderCache
+
+    with tmpdir.as_cwd():
+        for name in ("a.txt", "b.txt", "c.txt"):
+            with open(name, "w") as f:
+                f.write(name)
+        cache = RenderCache("cache", max_size=20)
+        for name in ("a.txt", "b.txt", "c.txt"):
+            cache.get_or_render(name, "default", lambda: ["x" * 10])
+        cache.close()
+
+        cache = RenderCache("cache", max_size=20)
+        cache.get_or_render("c.txt", "default", lambda: ["x" * 10])
+        cache.get_or_render("b.txt", "default", lambda: ["x" * 10])
+        assert (cache.hits, cache.misses) == (2, 0)
+        cache.get_or_render("a.txt", "default", lambda: ["x" * 10])
+        assert cache.misses == 1
+        cache.close()
+
+
+def test_cache_shared_between_runs(tmpdir):
+    import sqlite3
+
+    from files_to_prompt.cache import RenderCache
+
+    with tmpdir.as_cwd():
+        for name in ("a.txt", "b.txt"):
+            with open(name, "w") as f:
+                f.write(name)
+        first = RenderCache("cache", max_size=1000, timeout=0.1)
+        second = RenderCache("cache", max_size=1000, timeout=0.1)
+        first.get_or_render("a.txt", "default", lambda: ["a"])
+        # Entries are visible to the other run straight away
+        assert second.get_or_render("a.txt", "default", lambda: ["x"]) == ["a"]
+        second.get_or_render("b.txt", "default", lambda: ["b"])
+        assert first.get_or_render("b.txt", "default", lambda: ["x"]) == ["b"]
+
+        # While another connection keeps the database locked, lookups still
+        # work and new entries are rendered without being stored
+        with open("c.txt", "w") as f:
+            f.write("c.txt")
+        blocker = sqlite3.connect("cache/files-to-prompt.db", isolation_level=None)
+        blocker.execute("begin exclusive")
+        assert first.get_or_render("a.txt", "default", lambda: ["x"]) == ["a"]
+        assert first.get_or_render("c.txt", "default", lambda: ["c"]) == ["c"]
+        first.close()
+        blocker.execute("rollback")
+        blocker.close()
+        assert second.get_or_render("c.txt", "default", lambda: ["c"]) == ["c"]
+        second.close()
+        assert (first.hits, first.misses) == (2, 2)
+        assert (second.hits, second.misses) == (1, 2)
+
+
+def test_max_tokens(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/a_small.txt", "w") as f:
+            f.write("small")
+        with open("test_dir/b_large.txt", "w") as f:
+            f.write("large " * 100)
+        with open("test_dir/c_small.txt", "w") as f:
+            f.write("small")
+
+        result = runner.invoke(cli, ["test_dir", "--max-tokens", "40"])
+        assert result.exit_code == 0
+        assert "test_dir/a_small.txt" in result.stdout
+        assert "test_dir/b_large.txt" not in result.stdout
+        assert "test_dir/c_small.txt" in result.stdout
+        assert "test_dir/b_large.txt (skipped)" in result.stderr
+        assert "Total: 18 of 40 tokens, 1 file skipped" in result.stderr
+
+        result = runner.invoke(
+            cli, ["test_dir", "--max-tokens", "40", "--stop-at-max-tokens"]
+        )
+        assert result.exit_code == 0
+        assert "test_dir/a_small.txt" in result.stdout
+        assert "test_dir/c_small.txt" not in result.stdout
+        assert "test_dir/c_small.txt" not in result.stderr
+
+        # Document indexes stay contiguous when files are skipped
+        result = runner.invoke(cli, ["test_dir", "--max-tokens", "60", "--cxml"])
+        assert '<document index="2">\n<source>test_dir/c_small.txt' in result.stdout
+
+
+def test_binary_sniffing_and_max_file_size(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/image.png", "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + b"IHDR" * 10)
+        with open("test_dir/nul.dat", "wb") as f:
+            f.write(b"looks like text\x00but is not")
+        with open("test_dir/control.dat", "wb") as f:
+            f.write(bytes(range(1, 7)) * 6)
+        with open("test_dir/big.txt", "w") as f:
+            f.write("x" * 100)
+        with open("test_dir/small.txt", "w") as f:
+            f.write("small")
+
+        result = runner.invoke(cli, ["test_dir", "--max-file-size", "50"])
+        assert result.exit_code == 0
+        assert "test_dir/small.txt" in result.stdout
+        for name in ("image.png", "nul.dat", "control.dat"):
+            assert f"test_dir/{name}" not in result.stdout
+            assert (
+                f"Warning: Skipping file test_dir/{name} as it appears to be binary"
+                in result.stderr
+            )
+        assert "test_dir/big.txt" not in result.stdout
+        assert (
+            "Warning: Skipping file test_dir/big.txt as it is larger than 50 bytes"
+            in result.stderr
+        )
+
+
+def test_follow_symlinks(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/real")
+        os.makedirs("elsewhere")
+        with open("test_dir/real/file.txt", "w") as f:
+            f.write("Real file")
+        with open("elsewhere/linked.txt", "w") as f:
+            f.write("Linked file")
+        os.symlink(os.path.abspath("elsewhere"), "test_dir/link")
+        # A loop back to the top of the tree
+        os.symlink(os.path.abspath("test_dir"), "test_dir/real/loop")
+
+        result = runner.invoke(cli, ["test_dir", "-c"])
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {"test_dir/real/file.txt"}
+
+        result = runner.invoke(cli, ["test_dir", "-c", "--follow-symlinks"])
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/real/file.txt",
+            "test_dir/link/linked.txt",
+        }
+
+
+def test_iter_documents(tmpdir):
+    from files_to_prompt import iter_documents
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/file1.txt", "w") as f:
+            f.write("Contents of file1")
+        with open("test_dir/file2.txt", "w") as f:
+            f.write("Contents of file2")
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"\x00")
+
+        skipped = []
+        first = iter_documents(
+            "test_dir",
+            claude_xml=True,
+            on_skip=lambda path, reason: skipped.append(path),
+        )
+        second = iter_documents(["test_dir"], claude_xml=True)
+        # Interleaving two runs does not mix up their numbering
+        pairs = list(zip(first, second))
+        assert [(a.index, b.index) for a, b in pairs] == [(1, 1), (2, 2)]
+        assert skipped == ["test_dir/binary.bin"]
+
+        document = pairs[0][0]
+        assert document.path == "test_dir/file1.txt"
+        assert document.size == 17
+        assert document.content == "Contents of file1"
+        assert document.rendered == (
+            '<document index="1">\n'
+            "<source>test_dir/file1.txt</source>\n"
+            "<document_content>\n"
+            "Contents of file1\n"
+            "</document_content>\n"
+            "</document>\n"
+        )
+
+
+def test_iter_documents_compact(tmpdir):
+    from files_to_prompt import iter_documents
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/a.py", "w") as f:
+            f.write(LICENSE + "a = 1  # one\n\n\n\nb = 2\n")
+        with open("test_dir/b.py", "w") as f:
+            f.write(LICENSE + "c = 3\n")
+        with zipfile.ZipFile("test_dir/archive.zip", "w") as archive:
+            archive.writestr("c.py", "d = 4")
+
+        skipped = []
+        documents = list(
+            iter_documents(
+                ["test_dir", "test_dir/archive.zip"],
+                compact=True,
+                on_skip=lambda path, reason: skipped.append((path, reason)),
+            )
+        )
+        assert [document.rendered for document in documents] == [
+            "test_dir/a.py\n---\n" + LICENSE + "a = 1  # one\n\nb = 2\n\n\n---\n",
+            "test_dir/b.py\n---\nc = 3\n\n\n---\n",
+        ]
+        assert documents[1].content == LICENSE + "c = 3\n"
+        assert ("test_dir/archive.zip", "as archives are not supported") in skipped
+
+        (document,) = iter_documents(["test_dir/a.py"], strip_comments=True)
+        assert document.rendered == "test_dir/a.py\n---\na = 1\n\nb = 2\n\n\n---\n"
+
+
+@pytest.mark.parametrize("streamed", (False, True))
+def test_iter_documents_encoding(tmpdir, monkeypatch, streamed):
+    from files_to_prompt import iter_documents
+
+    if streamed:
+        monkeypatch.setattr("files_to_prompt.cli.STREAM_THRESHOLD", -1)
+    with tmpdir.as_cwd():
+        with open("latin.txt", "wb") as f:
+            f.write("café".encode("latin-1"))
+        with open("bom.txt", "wb") as f:
+            f.write(codecs.BOM_UTF16_LE + "naïve".encode("utf-16-le"))
+        with open("broken.txt", "wb") as f:
+            f.write(b"caf\xe9")
+
+        (document,) = iter_documents(["latin.txt"], encoding="latin-1")
+        assert (document.encoding, document.errors) == ("iso8859-1", "strict")
+        assert document.content == "café"
+        (document,) = iter_documents(["latin.txt"], fallback_encodings=["cp1252"])
+        assert document.content == "café"
+        (document,) = iter_documents(["bom.txt"])
+        assert document.encoding == "utf-16"
+        assert document.content == "naïve"
+        (document,) = iter_documents(["broken.txt"], fallback_encodings=["replace"])
+        assert document.content == "caf\ufffd"
+
+
+def test_concurrent_runs_number_documents_independently(tmpdir):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from files_to_prompt import iter_documents
+    from files_to_prompt.cli import RunContext, process_path
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        for i in range(20):
+            with open(f"test_dir/file{i:02}.txt", "w") as f:
+                f.write(f"Contents of file{i}")
+
+        def run(_):
+            lines = []
+
+            def writer(s, nl=True):
+                lines.append(s + "\n" if nl else s)
+
+            process_path(
+                "test_dir",
+                (),
+                False,
+                False,
+                False,
+                (),
+                (),
+                writer,
+                True,
+                False,
+                context=RunContext(),
+            )
+            return "".join(lines)
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            outputs = list(executor.map(run, range(64)))
+        assert len(set(outputs)) == 1
+        indexes = re.findall(r'<document index="(\d+)">', outputs[0])
+        assert indexes == [str(i) for i in range(1, 21)]
+
+        async def collect():
+            indexes = []
+            for document in iter_documents("test_dir", claude_xml=True):
+                indexes.append(document.index)
+                await asyncio.sleep(0)
+            return indexes
+
+        async def main():
+            return await asyncio.gather(*(collect() for _ in range(16)))
+
+        for indexes in asyncio.run(main()):
+            assert indexes == list(range(1, 21))
+
+
+@pytest.mark.parametrize("buffer_size", (0, 10, 1024 * 1024))
+def test_output_writer(tmpdir, buffer_size):
+    expected = "".join(f"line {i} ✓\n" for i in range(2000)) + "end"
+    with open(str(tmpdir / "out.txt"), "wb") as fp:
+        writer = OutputWriter(fp, buffer_size)
+        for i in range(2000):
+            writer(f"line {i} ✓")
+        writer("end", nl=False)
+        writer.close()
+        assert writer.bytes_written == len(expected.encode("utf-8"))
+    with open(str(tmpdir / "out.txt"), encoding="utf-8") as fp:
+        assert fp.read() == expected
+
+    # Streams without a file descriptor are written to directly
+    stream = io.BytesIO()
+    writer = OutputWriter(stream, buffer_size)
+    writer("hello")
+    writer.close()
+    assert stream.getvalue() == b"hello\n"
+
+
+def test_output_writer_for_redirected_stdout(tmpdir):
+    from files_to_prompt.cli import render_paths
+
+    path = str(tmpdir / "file.txt")
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write("contents ✓")
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        writer = OutputWriter.for_stdout(buffer_size=0)
+        writer("hello ✓")
+        writer.write_file(path)
+        writer.close()
+    assert stdout.getvalue() == "hello ✓\ncontents ✓"
+
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        render_paths([path])
+    assert stdout.getvalue() == f"{path}\n---\ncontents ✓\n\n---\n"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_since_git_ref(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        os.makedirs("repo/src")
+        os.makedirs("repo/.hidden")
+        for name in ("src/unchanged.py", "src/modified.py", "src/notes.txt"):
+            with open(f"repo/{name}", "w") as f:
+                f.write(name)
+        git = ["git", "-C", "repo", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + ["init", "-q"], check=True)
+        subprocess.run(git + ["add", "."], check=True)
+        subprocess.run(git + ["commit", "-qm", "initial"], check=True)
+
+        with open("repo/src/modified.py", "w") as f:
+            f.write("modified")
+        with open("repo/src/notes.txt", "w") as f:
+            f.write("modified notes")
+        with open("repo/src/added.py", "w") as f:
+            f.write("added")
+        with open("repo/.hidden/added.py", "w") as f:
+            f.write("hidden")
+
+        result = runner.invoke(cli, ["repo", "--since", "HEAD", "-c", "-e", "py"])
+        assert result.exit_code == 0, result.output
+        assert filenames_from_cxml(result.output) == {
+            "repo/src/added.py",
+            "repo/src/modified.py",
+        }
+
+        result = runner.invoke(cli, ["repo", "--since", "no-such-ref"])
+        assert result.exit_code == 1
+        assert "git diff" in result.output
+
+
+def test_manifest(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        for name in ("keep.txt", "modify.txt", "touch.txt", "delete.txt"):
+            with open(f"test_dir/{name}", "w") as f:
+                f.write(name)
+        args = ["test_dir", "-c", "--manifest", "manifest.json"]
+
+        result = runner.invoke(cli, args)
+        assert len(filenames_from_cxml(result.output)) == 4
+
+        result = runner.invoke(cli, args)
+        assert filenames_from_cxml(result.output) == set()
+
+        with open("test_dir/modify.txt", "w") as f:
+            f.write("modified contents")
+        os.utime("test_dir/touch.txt", ns=(1, 1))
+        os.remove("test_dir/delete.txt")
+        with open("test_dir/new.txt", "w") as f:
+            f.write("new")
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.output) == {
+            "test_dir/modify.txt",
+            "test_dir/new.txt",
+            "test_dir/delete.txt",
+        }
+        assert (
+            '<document index="3">\n<source>test_dir/delete.txt</source>\n<deleted />'
+            in result.output
+        )
+
+
+@pytest.mark.parametrize("stop", (False, True))
+def test_manifest_keeps_files_that_were_not_written(tmpdir, stop):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        names = [f"test_dir/{name}.txt" for name in "abcd"]
+        for name in names:
+            with open(name, "w") as f:
+                f.write(name * 30)
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"\xff")
+        args = ["test_dir", "-c", "--manifest", "manifest.json"]
+        args += ["--max-tokens", "150"] + (["--stop-at-max-tokens"] if stop else [])
+
+        seen = []
+        for _ in names:
+            result = runner.invoke(cli, args)
+            assert result.exit_code == 0
+            written = filenames_from_cxml(result.stdout)
+            assert len(written) == 1
+            assert "<deleted />" not in result.stdout
+            seen.extend(written)
+        assert sorted(seen) == names
+        assert filenames_from_cxml(runner.invoke(cli, args).stdout) == set()
+
+        # A file that could not be decoded is written once it can be
+        with open("test_dir/binary.bin", "w") as f:
+            f.write("fixed")
+        result = runner.invoke(cli, args)
+        assert filenames_from_cxml(result.stdout) == {"test_dir/binary.bin"}
+
+
+@pytest.mark.parametrize("jobs", ("1", "4"))
+def test_dedupe(tmpdir, jobs):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/vendor")
+        for name, content in (
+            ("a.txt", "shared"),
+            ("b.txt", "unique"),
+            ("c.txt", "shared"),
+            ("vendor/a.txt", "shared"),
+            ("vendor/same_size.txt", "sharee"),
+            ("vendor/binary.bin", "\xff"),
+            ("vendor/binary2.bin", "\xff"),
+        ):
+            with open(f"test_dir/{name}", "w", encoding="latin-1") as f:
+                f.write(content)
+        result = runner.invoke(
+            cli, ["test_dir", "test_dir/vendor", "--cxml", "--dedupe", "-j", jobs]
+        )
+        assert result.exit_code == 0
+        assert filenames_from_cxml(result.stdout) == {
+            "test_dir/a.txt",
+            "test_dir/b.txt",
+            "test_dir/c.txt",
+            "test_dir/vendor/a.txt",
+            "test_dir/vendor/same_size.txt",
+        }
+        assert result.stdout.count("shared") == 1
+        assert (
+            '<document index="3">\n<source>test_dir/c.txt</source>\n'
+            '<duplicate_of index="1">test_dir/a.txt</duplicate_of>\n</document>'
+        ) in result.stdout
+        # A duplicate of a skipped file is skipped as well
+        assert "binary2.bin due to UnicodeDecodeError" in result.stderr
+        assert "Dedupe: 3 duplicate files, 4 repeated paths" in result.stderr
+
+        result = runner.invoke(cli, ["test_dir", "--dedupe"])
+        assert "test_dir/c.txt\n---\n(duplicate of test_dir/a.txt)\n---" in (
+            result.stdout
+        )
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_git_enumeration(tmpdir):
+    runner = CliRunner()
+    with tmpdir.as_cwd():
+        os.makedirs("repo/src")
+        os.makedirs("repo/node_modules/pkg")
+        with open("repo/.gitignore", "w") as f:
+            f.write("node_modules/\n")
+        for name in ("src/app.py", "src/readme.txt", "node_modules/pkg/index.js"):
+            with open(f"repo/{name}", "w") as f:
+                f.write(name)
+        git = ["git", "-C", "repo", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + ["init", "-q"], check=True)
+        subprocess.run(git + ["add", "."], check=True)
+        subprocess.run(git + ["commit", "-qm", "initial"], check=True)
+        with open("repo/src/untracked.py", "w") as f:
+            f.write("untracked")
+
+        result = runner.invoke(cli, ["repo", "--git", "-c"])
+        assert result.exit_code == 0, result.output
+        assert filenames_from_cxml(result.output) == {
+            "repo/src/app.py",
+            "repo/src/readme.txt",
+        }
+
+        result = runner.invoke(
+            cli, ["repo", "--git", "--include-untracked", "-c", "-e", "py"]
+        )
+        assert filenames_from_cxml(result.output) == {
+            "repo/src/app.py",
+            "repo/src/untracked.py",
+        }
+
+        result = runner.invoke(cli, ["repo", "--git", "--include-hidden", "-c"])
+        assert "repo/.gitignore" in filenames_from_cxml(result.output)
+
+
+@pytest.mark.parametrize("backend", ("inotify", "poll"))
+def test_watch(tmpdir, monkeypatch, backend):
+    from files_to_prompt import cli as cli_module
+    from files_to_prompt import watch as watch_module
+    from files_to_prompt.filters import PathFilter
+
+    if backend == "poll":
+        monkeypatch.setattr(watch_module, "InotifyWatcher", None)
+    rendered = []
+    real_render_file = cli_module.render_file
+
+    def counting_render_file(path, *args, **kwargs):
+        rendered.append(path)
+        return real_render_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(cli_module, "render_file", counting_render_file)
+
+    def wait_for(text):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if os.path.exists("output.txt"):
+                with open("output.txt") as f:
+                    output = f.read()
+                if text in output:
+                    return output
+            time.sleep(0.05)
+        raise AssertionError(f"{text!r} not written, got {output!r}")
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/b")
+        for name in ("a.txt", "b/one.txt", "c.txt"):
+            with open(f"test_dir/{name}", "w") as f:
+                f.write(f"Contents of {name}")
+        with open("test_dir/.gitignore", "w") as f:
+            f.write("*.log\n")
+        umask = os.umask(0o022)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=cli_module.watch_paths,
+            args=(["test_dir"], PathFilter(), False, "output.txt", True, False),
+            kwargs={"stop": stop, "poll_interval": 0.05},
+        )
+        thread.start()
+        try:
+            wait_for("</documents>")
+            # Not the 0600 of the temporary file it was written to
+            assert stat.S_IMODE(os.stat("output.txt").st_mode) == 0o644
+            os.chmod("output.txt", 0o640)
+            assert sorted(rendered) == [
+                "test_dir/a.txt",
+                "test_dir/b/one.txt",
+                "test_dir/c.txt",
+            ]
+            rendered.clear()
+
+            # Only the changed file is rendered again
+            time.sleep(0.05)
+            with open("test_dir/c.txt", "w") as f:
+                f.write("Changed contents of c.txt")
+            wait_for("Changed contents")
+            assert rendered == ["test_dir/c.txt"]
+            assert stat.S_IMODE(os.stat("output.txt").st_mode) == 0o640
+
+            # New files, in a new directory and before an existing file
+            os.makedirs("test_dir/b/sub")
+            with open("test_dir/b/sub/two.txt", "w") as f:
+                f.write("Contents of two.txt")
+            wait_for("two.txt")
+            with open("test_dir/b/new.txt", "w") as f:
+                f.write("Contents of new.txt")
+            output = wait_for("new.txt")
+            assert re.findall(r"<source>(.*?)</source>", output) == [
+                "test_dir/a.txt",
+                "test_dir/c.txt",
+                "test_dir/b/new.txt",
+                "test_dir/b/one.txt",
+                "test_dir/b/sub/two.txt",
+            ]
+            assert re.findall(r'<document index="(\d+)">', output) == [
+                "1",
+                "2",
+                "3",
+                "4",
+                "5",
+            ]
+
+            os.remove("test_dir/a.txt")
+            output = wait_for('<document index="1">\n<source>test_dir/c.txt')
+            assert "a.txt" not in output
+
+            # Editing an existing .gitignore applies it to every file
+            with open("test_dir/.gitignore", "a") as f:
+                f.write("c.txt\n")
+            output = wait_for('<document index="1">\n<source>test_dir/b/new.txt')
+            assert "c.txt" not in output
+            assert not [name for name in os.listdir() if name.startswith(".")]
+        finally:
+            stop.set()
+            thread.join()
+            os.umask(umask)
+
+
+@pytest.mark.parametrize("args", ([], ["--cxml"], ["--markdown", "-n"]))
+def test_watch_output_matches_cli(tmpdir, args):
+    from files_to_prompt.cli import watch_paths
+    from files_to_prompt.filters import PathFilter
+
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/sub")
+        with open("test_dir/a.py", "w") as f:
+            f.write("print('a')\n")
+        with open("test_dir/sub/b.txt", "w") as f:
+            f.write("line one\nline two")
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"\xff\xfe\x00")
+        stop = threading.Event()
+        stop.set()
+        watch_paths(
+            ["test_dir"],
+            PathFilter(),
+            False,
+            "watched.txt",
+            "--cxml" in args,
+            "--markdown" in args,
+            "-n" in args,
+            stop=stop,
+        )
+        result = runner.invoke(cli, ["test_dir", "-o", "expected.txt"] + args)
+        assert result.exit_code == 0
+        with open("watched.txt") as watched, open("expected.txt") as expected:
+            assert watched.read() == expected.read()
+
+
+def test_watch_requires_output(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        result = runner.invoke(cli, ["test_dir", "--watch"])
+        assert result.exit_code == 2
+        assert "--watch requires --output" in result.stderr
+
+
+@pytest.mark.parametrize("transport", ("socket", "http"))
+def test_serve(tmpdir, transport):
+    import socket
+    import sys
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/sub")
+        with open("test_dir/a.txt", "w") as f:
+            f.write("Contents of a.txt")
+        with open("test_dir/sub/b.py", "w") as f:
+            f.write("print('b')")
+        if transport == "socket":
+            address = str(tmpdir / "files-to-prompt.sock")
+            serve_args = ["--socket", address]
+        else:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            serve_args = ["--port", str(port)]
+        command = [sys.executable, "-m", "files_to_prompt"]
+        server = subprocess.Popen(
+            command + ["serve"] + serve_args, stderr=subprocess.PIPE
+        )
+        try:
+            listening = server.stderr.readline().decode().strip()
+            assert listening.startswith("Listening on ")
+            if transport == "socket":
+                assert listening == f"Listening on {address}"
+                assert os.stat(address).st_mode & 0o077 == 0
+            else:
+                address = listening.split(" ", 2)[2]
+                assert address.startswith(f"http://localhost:{port}/")
+            env = dict(os.environ, FILES_TO_PROMPT_SERVER=address)
+
+            def run(*args, stdin=subprocess.DEVNULL, env=env):
+                return subprocess.run(
+                    command + list(args), stdin=stdin, capture_output=True, env=env
+                )
+
+            for args in (["test_dir", "-c"], ["test_dir", "-m", "-n"]):
+                remote = run(*args)
+                local = run(*args, env=dict(os.environ, FILES_TO_PROMPT_SERVER=""))
+                assert remote.returncode == 0
+                assert remote.stdout == local.stdout
+            assert filenames_from_cxml(run("test_dir", "-c").stdout.decode()) == {
+                "test_dir/a.txt",
+                "test_dir/sub/b.py",
+            }
+
+            # New and changed files are seen by the warm listing and cache
+            time.sleep(0.01)
+            with open("test_dir/sub/c.txt", "w") as f:
+                f.write("Contents of c.txt")
+            with open("test_dir/a.txt", "w") as f:
+                f.write("Changed contents of a.txt")
+            remote = run("test_dir", "-e", "txt").stdout.decode()
+            assert "Changed contents of a.txt" in remote
+            assert "test_dir/sub/c.txt" in remote
+
+            # Paths from stdin, errors and exit codes come back unchanged
+            remote = subprocess.run(
+                command,
+                input=b"test_dir/sub/b.py\n",
+                capture_output=True,
+                env=env,
+            )
+            assert remote.stdout == b"test_dir/sub/b.py\n---\nprint('b')\n\n---\n"
+            remote = run("missing")
+            assert remote.returncode == 2
+            assert b"Path 'missing' does not exist" in remote.stderr
+
+            if transport == "http":
+                import http.client
+
+                body = json.dumps(
+                    {"args": ["test_dir", "-o", "out.txt"], "cwd": str(tmpdir)}
+                )
+                token_path = address[len(f"http://localhost:{port}") :]
+                for path, headers, status in (
+                    ("/", {"Content-Type": "application/json"}, 403),
+                    (token_path + "x", {"Content-Type": "application/json"}, 403),
+                    (token_path, {"Content-Type": "text/plain"}, 415),
+                    (
+                        token_path,
+                        {
+                            "Content-Type": "application/json",
+                            "Origin": "http://evil.example",
+                        },
+                        403,
+                    ),
+                ):
+                    connection = http.client.HTTPConnection("127.0.0.1", port)
+                    connection.request("POST", path, body, headers)
+                    assert connection.getresponse().status == status
+                    connection.close()
+                assert not os.path.exists("out.txt")
+                remote = run(
+                    "test_dir",
+                    env=dict(env, FILES_TO_PROMPT_SERVER=f"http://localhost:{port}"),
+                )
+                assert remote.returncode == 1
+                assert remote.stderr == b"Error: Server responded with 403\n"
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def test_serve_does_not_replace_other_files(tmpdir):
+    from files_to_prompt.server import serve
+
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        with open("notes.txt", "w") as f:
+            f.write("Notes")
+        result = runner.invoke(serve, ["--socket", "notes.txt"])
+        assert result.exit_code == 2
+        assert "notes.txt exists and is not a socket" in result.stderr
+        with open("notes.txt") as f:
+            assert f.read() == "Notes"
+
+
+def test_client_runs_locally_without_server(tmpdir):
+    import sys
+
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/a.txt", "w") as f:
+            f.write("Contents of a.txt")
+        env = dict(os.environ, FILES_TO_PROMPT_SERVER=str(tmpdir / "missing.sock"))
+        result = subprocess.run(
+            [sys.executable, "-m", "files_to_prompt", "test_dir"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            env=env,
+        )
+        assert result.returncode == 0
+        assert result.stdout == b"test_dir/a.txt\n---\nContents of a.txt\n\n---\n"
+
+
+def run_module(args, tmpdir, *python_args):
+    import sys
+
+    env = {k: v for k, v in os.environ.items() if k != "FILES_TO_PROMPT_SERVER"}
+    # Cached bytecode, outside the source tree, so that imports are timed as
+    # they would be for an installed package
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return subprocess.run(
+        [sys.executable, "-X", f"pycache_prefix={tmpdir / 'pycache'}"]
+        + list(python_args)
+        + ["-m", "files_to_prompt"]
+        + list(args),
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        env=env,
+    )
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        [],
+        ["-c"],
+        ["--markdown", "-n"],
+        ["-e", "py", "--include-hidden"],
+        ["--ignore", "*.txt", "--ignore-gitignore", "-c"],
+        ["--include", "sub/*", "--ignore-files-only"],
+    ),
+)
+def test_fast_path_matches_click_command(tmpdir, args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir/sub")
+        with open("test_dir/.gitignore", "w") as f:
+            f.write("ignored.py\n")
+        for name in ("a.py", "b.txt", "ignored.py", ".hidden.py", "sub/c.py"):
+            with open(f"test_dir/{name}", "w") as f:
+                f.write(f"Contents of {name}\n")
+        with open("test_dir/binary.bin", "wb") as f:
+            f.write(b"\xff\xfe\x00")
+        expected = runner.invoke(cli, ["test_dir"] + args)
+        result = run_module(["test_dir"] + args, tmpdir, "-X", "importtime")
+        assert result.returncode == expected.exit_code == 0
+        assert result.stdout.decode() == expected.stdout
+        stderr = result.stderr.decode()
+        for line in expected.stderr.splitlines():
+            assert line in stderr
+        assert not re.search(r"\| +click$", stderr, re.MULTILINE)
+
+
+def test_fast_path_falls_back_to_click_command(tmpdir):
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        result = run_module(["test_dir", "missing"], tmpdir)
+        assert result.returncode == 2
+        assert b"Path 'missing' does not exist" in result.stderr
+        result = run_module(["--version"], tmpdir)
+        assert result.returncode == 0
+        assert b", version " in result.stdout
+
+
+# Budget for importing files_to_prompt to render files, in milliseconds
+IMPORT_TIME_BUDGET = 50
+
+# Modules only imported for the options that need them
+DEFERRED_MODULES = (
+    "asyncio",
+    "click",
+    "concurrent.futures",
+    "ctypes",
+    "sqlite3",
+    "subprocess",
+    "tarfile",
+    "zipfile",
+)
+
+
+def test_import_time(tmpdir):
+    with tmpdir.as_cwd():
+        with open("file.txt", "w") as f:
+            f.write("Contents of file.txt")
+        # The first run writes the cached bytecode
+        assert run_module(["file.txt"], tmpdir).returncode == 0
+        result = run_module(["file.txt"], tmpdir, "-X", "importtime")
+        assert result.returncode == 0
+    imports = re.findall(
+        r"^import time: +\d+ \| +(\d+) \|( *)(\S+)$",
+        result.stderr.decode(),
+        re.MULTILINE,
+    )
+    imported = {name for _, _, name in imports}
+    assert not imported.intersection(DEFERRED_MODULES)
+    total = sum(
+        int(cumulative)
+        for cumulative, indent, name in imports
+        if indent == " " and name.split(".")[0] == "files_to_prompt"
+    )
+    assert total / 1000 < IMPORT_TIME_BUDGET, f"{total / 1000:.1f}ms"
+
+
+LICENSE = "# Copyright 2024 Example Corp\n# Licensed under the Apache License\n"
+
+
+def test_compact(tmpdir):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        with open("test_dir/one.py", "w") as f:
+            f.write(
+                "#!/usr/bin/env python\n" + LICENSE + "\n\n\nx = 1   \n\n\n\ny = 2\n\n"
+            )
+        with open("test_dir/two.py", "w") as f:
+            f.write(LICENSE + "z = 3\t\n")
+        with open("test_dir/three.py", "w") as f:
+            f.write("# Copyright 2024 Someone Else\n\nw = 4\n")
+
+        result = runner.invoke(cli, ["test_dir", "--compact"])
+        assert result.exit_code == 0
+        assert result.stdout == (
+            "test_dir/one.py\n---\n#!/usr/bin/env python\n"
+            + LICENSE
+            + "\nx = 1\n\ny = 2\n\n\n---\n"
+            "test_dir/three.py\n---\n# Copyright 2024 Someone Else\n\nw = 4\n\n\n---\n"
+            "test_dir/two.py\n---\nz = 3\n\n\n---\n"
+        )
+        assert "Compaction: 75 of 220 bytes saved (34.1%) in 3 files" in result.stderr
+
+        # Line numbers count the compacted lines
+        result = runner.invoke(
+            cli, ["test_dir/two.py", "test_dir/one.py", "-n", "--compact"]
+        )
+        assert result.stdout.startswith(
+            "test_dir/two.py\n---\n1  # Copyright 2024 Example Corp\n"
+        )
+        assert "test_dir/one.py\n---\n1  #!/usr/bin/env python\n4  \n5  x = 1\n" in (
+            result.stdout
+        )
+
+        # A file that is only a license header, with no newline at the end
+        with open("test_dir/__init__.py", "w") as f:
+            f.write(LICENSE.rstrip("\n"))
+        for args in ([], ["-n"]):
+            result = runner.invoke(
+                cli, ["test_dir/two.py", "test_dir/__init__.py", "--compact"] + args
+            )
+            assert result.stdout.endswith("test_dir/__init__.py\n---\n\n---\n")
+
+
+@pytest.mark.parametrize(
+    "name,content,expected",
+    (
+        (
+            "code.py",
+            '#!/usr/bin/env python\n"""Module docstring."""\n'
+            "import os  # why\n\n\n"
+            'def f():\n    """Docstring\n    over lines"""\n\n'
+            'def g():\n    """Docstring"""\n    # comment\n'
+            "    return '# not a comment'\n"
+            "s = '''\n# kept\n'''\n",
+            "#!/usr/bin/env python\nimport os\n\ndef f():\n    ...\n\n"
+            "def g():\n    return '# not a comment'\n"
+            "s = '''\n# kept\n'''\n",
+        ),
+        # Comments after the tokenizer fails are left alone
+        (
+            "broken.py",
+            "if x:\n        a = 1  # removed\n    b = 2  # kept\n",
+            "if x:\n        a = 1\n    b = 2  # kept\n",
+        ),
+        (
+            "code.js",
+            "// comment\nconst url = 'http://example.com'; // comment\n"
+            "const re = /\\/\\/[\"']/g, half = a / b / c;\n"
+            "const t = `// ${ {a: '/*'}.a } /* kept */`;\n"
+            "/* block\n   comment */ let x/**/= 1;\n",
+            "const url = 'http://example.com';\n"
+            "const re = /\\/\\/[\"']/g, half = a / b / c;\n"
+            "const t = `// ${ {a: '/*'}.a } /* kept */`;\n"
+            " let x= 1;\n",
+        ),
+        (
+            "code.c",
+            '/* header */\nint/**/x = 1; // one\nchar *s = "/* kept */";\n',
+            'int x = 1;\nchar *s = "/* kept */";\n',
+        ),
+        (
+            "style.css",
+            "a { background: url(//example.com/x.png); } /* comment */\n",
+            "a { background: url(//example.com/x.png); }\n",
+        ),
+        (
+            "page.html",
+            "<p>It's <!-- a\ncomment --></p>\n",
+            "<p>It's\n</p>\n",
+        ),
+        # Comments only start in text, not in tags, scripts or CDATA
+        (
+            "markup.html",
+            "<a title=\"<!-- kept -->\" href='x'>link</a><!-- gone -->\n"
+            '<div data-x="multiple\n<!-- lines -->">text</div>\n'
+            '<SCRIPT>\nvar s = "<!--";\n</script>\n'
+            "<style>/* <!-- kept --> */</style><!-- gone -->\n"
+            "<![CDATA[ <!-- kept --> ]]>\n",
+            "<a title=\"<!-- kept -->\" href='x'>link</a>\n"
+            '<div data-x="multiple\n<!-- lines -->">text</div>\n'
+            '<SCRIPT>\nvar s = "<!--";\n</script>\n'
+            "<style>/* <!-- kept --> */</style>\n"
+            "<![CDATA[ <!-- kept --> ]]>\n",
+        ),
+        # Not supported, so only compacted
+        ("script.sh", "echo hi  # comment\n", "echo hi  # comment\n"),
+    ),
+)
+def test_strip_comments(tmpdir, name, content, expected):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        with open(name, "w") as f:
+            f.write(content)
+        result = runner.invoke(cli, [name, "--strip-comments"])
+        assert result.exit_code == 0
+        assert result.stdout == f"{name}\n---\n{expected}\n\n---\n"
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ["--compact"],
+        ["--compact", "--cxml", "-n"],
+        ["--strip-comments", "--markdown", "-n"],
+    ),
+)
+def test_compact_matches_across_modes(tmpdir, monkeypatch, args):
+    runner = CliRunner(mix_stderr=False)
+    with tmpdir.as_cwd():
+        os.makedirs("test_dir")
+        for i in range(8):
+            with open(f"test_dir/file{i}.py", "w") as f:
+                f.write(
+                    ("#!/bin/python\n" if i % 3 == 0 else "")
+                    + (LICENSE if i % 2 else "")
+                    + "\n\n".join(f"def f{j}():  # c\n    'doc'\n" for j in range(i))
+                    + "\n\n\n"
+                )
+        with open("test_dir/page.html", "w") as f:
+            f.write("<!-- Copyright 2024 -->\n<p>  \n\n\n</p><!-- x -->\n")
+        with open("test_dir/z__init__.py", "w") as f:
+            f.write(LICENSE.rstrip("\n"))
+        args = ["test_dir"] + args
+
+        serial = runner.invoke(cli, args)
+        assert serial.exit_code == 0
+        assert serial.stdout.count("Copyright 2024 Example") == (
+            0 if "--strip-comments" in args else 1
+        )
+        cached = runner.invoke(cli, args + ["--cache-dir", "cache"])
+        cached_again = runner.invoke(cli, args + ["--cache-dir", "cache"])
+        threaded = runner.invoke(cli, args + ["--jobs", "3"])
+        monkeypatch.setattr("files_to_prompt.cli.SHARD_SIZE", 3)
+        sharded = runner.invoke(cli, args + ["--processes", "2"])
+        monkeypatch.setattr("files_to_prompt.cli.STREAM_THRESHOLD", -1)
+        monkeypatch.setattr("files_to_prompt.cli.CHUNK_SIZE", 5)
+        streamed = runner.invoke(cli, args)
+        for result in (cached, cached_again, threaded, sharded, streamed):
+            assert result.exit_code == 0
+        for result in (cached, cached_again, threaded, sharded):
+            assert result.stdout == serial.stdout
+        if "-n" not in args:
+            # Streamed files pad line numbers to the uncompacted line count
+            assert streamed.stdout == serial.stdout
+        summary = serial.stderr.splitlines()[-1]
+        assert summary.startswith("Compaction: ")
+        for result in (threaded, sharded, streamed):
+            assert result.stderr.splitlines()[-1] == summary